@@ -10,10 +10,12 @@ entry_points = {
         "nti_metadata_processor = nti.app.metadata.scripts.nti_metadata_processor:main",
         "nti_metadata_reindexer = nti.app.metadata.scripts.nti_metadata_reindexer:main",
         "nti_rebuild_metadata_catalog = nti.app.metadata.scripts.nti_rebuild_metadata_catalog:main",
+        "nti_replay_failed_jobs = nti.app.metadata.scripts.nti_replay_failed_jobs:main",
     ],
 }
 
 TESTS_REQUIRE = [
+    'fakeredis',
     'nti.app.testing',
     'nti.testing',
     'zope.dottedname',
@@ -58,6 +60,7 @@ setup(
         'setuptools',
         'BTrees',
         'nti.app.asynchronous',
+        'nti.asynchronous',
         'nti.base',
         'nti.common',
         'nti.contentfragments',
@@ -65,9 +68,11 @@ setup(
         'nti.metadata',
         'nti.ntiids',
         'nti.zope_catalog',
+        'persistent',
         'pyramid',
         'requests',
         'six',
+        'transaction',
         'z3c.autoinclude',
         'zc.catalog',
         'ZODB',
@@ -0,0 +1,546 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Batched execution of the metadata queue jobs.
+
+.. $Id$
+"""
+
+from __future__ import division
+from __future__ import print_function
+from __future__ import absolute_import
+
+import os
+import sys
+import time
+import signal
+import functools
+
+from six.moves import queue as Queue
+
+import transaction
+
+from ZODB.POSException import ConflictError
+
+from zope.cachedescriptors.property import Lazy
+
+from nti.app.metadata.parallel import POLL_INTERVAL
+from nti.app.metadata.parallel import DEFAULT_RETRIES
+
+from nti.app.metadata.parallel import mp_context
+
+from nti.app.metadata.processing import BULK_QUEUE_NAMES
+
+from nti.app.metadata.processing import PendingIntids
+
+from nti.app.metadata.processing import event_doc_id
+
+from nti.metadata import QUEUE_NAMES
+
+from nti.metadata.processing import get_job_queue
+
+#: Default number of jobs executed in a single transaction
+DEFAULT_BATCH_SIZE = 100
+
+#: Default seconds to wait for a partial batch to fill up
+DEFAULT_MAX_LATENCY = 1
+
+#: Default maximum seconds to sleep when the queues are empty
+DEFAULT_MAX_SLEEP_TIME = 30
+
+#: Seconds between claims while a partial batch fills up
+CLAIM_INTERVAL = 0.1
+
+#: Default number of times a dead worker is restarted
+DEFAULT_MAX_RESTARTS = 10
+
+#: Seconds the workers are given to finish their batch on shutdown
+SHUTDOWN_TIMEOUT = 60
+
+#: Seconds between logs of the aggregated worker stats
+STATS_INTERVAL = 60
+
+#: The process name of a worker, by its index
+WORKER_NAME = 'metadata-worker-%s'
+
+#: The counters of a :class:`BatchProcessor`
+COUNTERS = ('Jobs', 'Failed', 'Splits', 'Batches', 'Coalesced', 'Retries')
+
+logger = __import__('logging').getLogger(__name__)
+
+
+def _record_error(job, error):
+    # so the failed queue keeps the error of this run
+    try:
+        job.error = error
+    except Exception:  # pylint: disable=broad-except
+        logger.debug("Cannot record the error of job %s", job)
+
+
+def execute_job(job):
+    """
+    Run the given job in a savepoint, rolling back its changes if it
+    fails. The exception of a job that raises is recorded as its
+    ``error``.
+
+    :return: True if the job was executed.
+    """
+    savepoint = transaction.savepoint(optimistic=True)
+    try:
+        job()
+    except ConflictError:
+        raise
+    except Exception as e:  # pylint: disable=broad-except
+        logger.exception("Cannot execute job %s", job)
+        savepoint.rollback()
+        _record_error(job, e)
+        return False
+    has_failed = getattr(job, 'has_failed', None)
+    if has_failed is not None and has_failed():
+        logger.error("Job %s failed", job)
+        savepoint.rollback()
+        return False
+    return True
+
+
+class RateLimiter(object):
+    """
+    A token bucket that allows ``rate`` events per second on average,
+    with bursts of up to ``burst`` events.
+    """
+
+    def __init__(self, rate, burst=None, clock=time.time):
+        self.rate = rate
+        self.clock = clock
+        self.burst = max(1, burst or rate)
+        self.tokens = self.burst
+        self.updated = clock()
+
+    def ready(self):
+        now = self.clock()
+        elapsed = max(now - self.updated, 0)
+        self.tokens = min(self.burst, self.tokens + elapsed * self.rate)
+        self.updated = now
+        return self.tokens >= 1
+
+    def consume(self):
+        self.tokens -= 1
+
+    def delay(self):
+        """
+        Return the seconds until the next event is allowed.
+        """
+        return 0 if self.ready() else (1 - self.tokens) / self.rate
+
+
+class BatchProcessor(object):
+    """
+    Execute the jobs of the metadata queues in batches of up to
+    ``batch_size`` jobs, with a single commit per batch.
+
+    The queues of the bulk lane are only claimed from when there is
+    nothing in the interactive ones, at most ``bulk_rate`` jobs per
+    second if given.
+
+    A partial batch is executed once it has waited ``max_latency``
+    seconds for more jobs. A batch that conflicts is split in half and
+    each half is retried; a single job is retried up to ``retries``
+    times before it is put in the failed queue.
+
+    Jobs queued for an event on an object are coalesced: they are
+    dropped if a later job of the batch is for the same object, or if
+    the object is pending in a bulk indexing job.
+
+    The :meth:`stats` are recorded by ``metrics``, if set, after each
+    batch, along with the queue and duration of each committed job.
+    """
+
+    stop = False
+    report = None
+    metrics = None
+    throttled = False
+
+    def __init__(self, queue_names=QUEUE_NAMES, batch_size=DEFAULT_BATCH_SIZE,
+                 max_latency=DEFAULT_MAX_LATENCY,
+                 max_sleep_time=DEFAULT_MAX_SLEEP_TIME,
+                 retries=DEFAULT_RETRIES, sleep=time.sleep,
+                 bulk_queue_names=BULK_QUEUE_NAMES, bulk_rate=None):
+        self.sleep = sleep
+        self.bulk_queue_names = tuple(bulk_queue_names)
+        self.limiter = RateLimiter(bulk_rate) if bulk_rate else None
+        self.retries = retries
+        self.max_latency = max_latency
+        self.max_sleep_time = max_sleep_time
+        self.batch_size = max(1, batch_size)
+        self.queue_names = tuple(queue_names)
+        self.jobs = 0
+        self.failed = 0
+        self.splits = 0
+        self.batches = 0
+        self.retried = 0
+        self.coalesced = 0
+
+    @Lazy
+    def pending(self):
+        return PendingIntids()
+
+    @Lazy
+    def queues(self):
+        return [get_job_queue(name) for name in self.queue_names]
+
+    @Lazy
+    def bulk_queues(self):
+        return [get_job_queue(name) for name in self.bulk_queue_names]
+
+    def _claim(self, queues, batch, limiter=None):
+        claimed = False
+        for queue in queues:
+            if len(batch) >= self.batch_size:
+                break
+            if limiter is not None and not limiter.ready():
+                self.throttled = True
+                break
+            job = queue.claim()
+            if job is not None:
+                claimed = True
+                batch.append((queue, job))
+                if limiter is not None:
+                    limiter.consume()
+        return claimed
+
+    def claim(self):
+        """
+        Return a list of up to ``batch_size`` (queue, job) pairs.
+        """
+        batch = []
+        started = None
+        self.throttled = False
+        while len(batch) < self.batch_size:
+            # the interactive lane is always drained first
+            claimed = self._claim(self.queues, batch) \
+                   or self._claim(self.bulk_queues, batch, self.limiter)
+            if claimed:
+                started = time.time() if started is None else started
+                continue
+            if not batch:
+                break
+            remaining = self.max_latency - (time.time() - started)
+            if remaining <= 0:
+                break
+            self.sleep(min(remaining, CLAIM_INTERVAL))
+        return batch
+
+    def _pending(self, doc_ids):
+        try:
+            return set(doc_ids) - set(self.pending.missing(doc_ids))
+        except Exception:  # pylint: disable=broad-except
+            logger.exception("Cannot read the pending intids")
+            return set()
+
+    def coalesce(self, batch):
+        """
+        Return the given (queue, job) pairs without the event jobs that
+        are coalesced, since indexing always reads the latest state of
+        an object.
+        """
+        last = {}
+        for idx, (_, job) in enumerate(batch):
+            doc_id = event_doc_id(job)
+            if doc_id is not None:
+                last[doc_id] = idx
+        if not last:
+            return batch
+        pending = self._pending(sorted(last))
+        result = []
+        for idx, (queue, job) in enumerate(batch):
+            doc_id = event_doc_id(job)
+            if doc_id is None \
+                or (doc_id not in pending and last[doc_id] == idx):
+                result.append((queue, job))
+        self.coalesced += len(batch) - len(result)
+        return result
+
+    def queue_name(self, queue):
+        # the queues are loaded once claimed from
+        for names, attr in ((self.queue_names, 'queues'),
+                            (self.bulk_queue_names, 'bulk_queues')):
+            for name, other in zip(names, self.__dict__.get(attr, ())):
+                if other is queue:
+                    return name
+        return getattr(queue, 'name', None) or u'unknown'
+
+    def _put_failed(self, failed):
+        if not failed:
+            return
+        transaction.begin()
+        for queue, job in failed:
+            logger.error("Job %s failed", job)
+            queue.put_failed(job)
+        transaction.commit()
+        self.failed += len(failed)
+        if self.metrics is not None:
+            for queue, _ in failed:
+                self.metrics.observe_failed(self.queue_name(queue))
+
+    def _observe(self, executed):
+        if self.metrics is not None:
+            for queue, done, duration in executed:
+                if done:
+                    self.metrics.observe_job(self.queue_name(queue), duration)
+
+    def _split(self, batch):
+        self.splits += 1
+        self.retried += 1
+        middle = len(batch) // 2
+        return self.process(batch[:middle]) + self.process(batch[middle:])
+
+    def process(self, batch, attempt=1):
+        """
+        Execute the given (queue, job) pairs in a single transaction.
+
+        A batch that cannot be committed for any other reason than a
+        conflict is split until the jobs that break the commit are
+        found, and these are put in the failed queue.
+
+        :return: The number of jobs executed successfully.
+        """
+        executed = []
+        transaction.begin()
+        try:
+            for queue, job in batch:
+                started = time.time()
+                done = execute_job(job)
+                executed.append((queue, done, time.time() - started))
+            transaction.commit()
+        except ConflictError:
+            transaction.abort()
+            if len(batch) > 1:
+                logger.warning("Conflict executing %s job(s), splitting batch",
+                               len(batch))
+                return self._split(batch)
+            if attempt < self.retries:
+                self.retried += 1
+                return self.process(batch, attempt + 1)
+            self._put_failed(batch)
+            return 0
+        except Exception:  # pylint: disable=broad-except
+            transaction.abort()
+            logger.exception("Cannot commit %s job(s)", len(batch))
+            if len(batch) > 1:
+                return self._split(batch)
+            self._put_failed(batch)
+            return 0
+        self._observe(executed)
+        failed = [x for x, y in zip(batch, executed) if not y[1]]
+        self._put_failed(failed)
+        count = len(batch) - len(failed)
+        self.jobs += count
+        return count
+
+    def stats(self):
+        return dict(zip(COUNTERS,
+                        (self.jobs, self.failed, self.splits, self.batches,
+                         self.coalesced, self.retried)))
+
+    def wait(self, seconds):
+        """
+        Sleep for the given seconds or until stopped.
+        """
+        end = time.time() + seconds
+        while not self.stop:
+            remaining = end - time.time()
+            if remaining <= 0:
+                break
+            self.sleep(min(remaining, 1))
+
+    def __call__(self):
+        idle = 0
+        while not self.stop:
+            batch = self.claim()
+            if not batch and self.throttled:
+                self.wait(self.limiter.delay())
+                continue
+            if not batch:
+                idle += 1
+                self.wait(min(idle, self.max_sleep_time))
+                continue
+            idle = 0
+            now = time.time()
+            claimed = len(batch)
+            batch = self.coalesce(batch)
+            count = self.process(batch) if batch else 0
+            self.batches += 1
+            logger.info("%s of %s job(s) executed in %.3f(s)",
+                        count, claimed, time.time() - now)
+            if self.metrics is not None:
+                self.metrics.record(self.stats())
+            if self.report is not None:
+                self.report(self.stats())
+        return self.jobs
+
+
+def partition_queues(queue_names, workers):
+    """
+    Split the given queue names in at most ``workers`` disjoint
+    partitions.
+    """
+    queue_names = tuple(queue_names)
+    workers = max(1, min(workers, len(queue_names)))
+    return [queue_names[idx::workers] for idx in range(workers)]
+
+
+def _batch_worker(runner, factory, index, messages):
+    processor = factory()
+
+    def stop(unused_signum, unused_frame):
+        processor.stop = True
+    signal.signal(signal.SIGTERM, stop)
+    signal.signal(signal.SIGINT, stop)
+
+    def report(stats):
+        messages.put(('stats', index, stats))
+    processor.report = report
+    try:
+        runner(processor)
+        messages.put(('done', index, processor.stats()))
+    except Exception as e:  # pylint: disable=broad-except
+        logger.exception("Worker %s failed", index)
+        messages.put(('failed', index, repr(e)))
+        # a non-zero exit code gets the worker restarted
+        sys.exit(1)
+
+
+class WorkerSupervisor(object):
+    """
+    Run a :class:`BatchProcessor` over each partition of the queue
+    names in its own process, restarting the workers that die, until
+    SIGTERM or SIGINT is received. The workers are then asked to finish
+    their current batch and stop.
+
+    Since a pending intid is in a single bulk job, workers on disjoint
+    queues do not index the same objects at the same time.
+
+    :param runner: A picklable callable that runs a function with its
+        own database connection in the worker process, e.g.
+        :class:`nti.app.metadata.parallel.DataserverRunner`
+    :param bulk_partitions: The partitions of the bulk lane queues, one
+        per worker.
+    :param options: Keyword arguments for the :class:`BatchProcessor`
+        of each worker.
+    """
+
+    stop = False
+
+    def __init__(self, runner, partitions, bulk_partitions=(),
+                 max_restarts=DEFAULT_MAX_RESTARTS, **options):
+        self.runner = runner
+        self.options = options
+        self.partitions = list(partitions)
+        self.bulk_partitions = list(bulk_partitions)
+        self.max_restarts = max_restarts
+        self.processes = {}
+        self.current = {}
+        self.finished = dict.fromkeys(COUNTERS, 0)
+        self.restarts = dict.fromkeys(range(len(self.partitions)), 0)
+        self.context = mp_context()
+        self.messages = self.context.Queue()
+
+    def start(self, index):
+        bulk = self.bulk_partitions[index] \
+            if index < len(self.bulk_partitions) else ()
+        factory = functools.partial(BatchProcessor,
+                                    queue_names=self.partitions[index],
+                                    bulk_queue_names=bulk,
+                                    **self.options)
+        process = self.context.Process(target=_batch_worker,
+                                       args=(self.runner, factory, index,
+                                             self.messages),
+                                       name=WORKER_NAME % index)
+        process.start()
+        self.processes[index] = process
+        logger.info("Worker %s started (pid %s) for %s",
+                    index, process.pid, self.partitions[index])
+
+    def shutdown(self, unused_signum=None, unused_frame=None):
+        self.stop = True
+
+    def totals(self):
+        result = dict(self.finished)
+        for stats in self.current.values():
+            for name in COUNTERS:
+                result[name] += stats.get(name, 0)
+        result['Restarts'] = sum(self.restarts.values())
+        result['Workers'] = len(self.partitions)
+        return result
+
+    def _retire(self, index):
+        stats = self.current.pop(index, {})
+        for name in COUNTERS:
+            self.finished[name] += stats.get(name, 0)
+
+    def _receive(self, timeout=None):
+        try:
+            if timeout is None:
+                kind, index, value = self.messages.get_nowait()
+            else:
+                kind, index, value = self.messages.get(timeout=timeout)
+        except Queue.Empty:
+            return False
+        if kind == 'failed':
+            logger.error("Worker %s failed: %s", index, value)
+        else:
+            self.current[index] = value
+        return True
+
+    def _check(self):
+        for index, process in list(self.processes.items()):
+            if process.is_alive():
+                continue
+            process.join()
+            del self.processes[index]
+            while self._receive():
+                pass
+            self._retire(index)
+            if self.stop or process.exitcode == 0:
+                continue
+            self.restarts[index] += 1
+            if self.restarts[index] > self.max_restarts:
+                logger.error("Worker %s exited with code %s, giving up",
+                             index, process.exitcode)
+                continue
+            logger.warning("Worker %s exited with code %s, restarting",
+                           index, process.exitcode)
+            self.start(index)
+
+    def _stop_workers(self, timeout):
+        for process in self.processes.values():
+            process.terminate()
+        deadline = time.time() + timeout
+        for index, process in list(self.processes.items()):
+            process.join(max(deadline - time.time(), 0))
+            if process.is_alive():
+                logger.warning("Worker %s did not stop, killing it", index)
+                os.kill(process.pid, signal.SIGKILL)
+                process.join()
+        while self._receive():
+            pass
+        for index in list(self.processes):
+            self._retire(index)
+        self.processes.clear()
+
+    def __call__(self, timeout=SHUTDOWN_TIMEOUT):
+        signal.signal(signal.SIGTERM, self.shutdown)
+        signal.signal(signal.SIGINT, self.shutdown)
+        for index in range(len(self.partitions)):
+            self.start(index)
+        logged = time.time()
+        while not self.stop and self.processes:
+            self._receive(POLL_INTERVAL)
+            self._check()
+            if time.time() - logged >= STATS_INTERVAL:
+                logged = time.time()
+                logger.info("Workers stats %s", self.totals())
+        self._stop_workers(timeout)
+        result = self.totals()
+        logger.info("Workers stopped %s", result)
+        return result
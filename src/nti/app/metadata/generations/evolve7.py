@@ -10,10 +10,6 @@ from __future__ import absolute_import
 
 # pylint: disable=W0212,W0621,W0703
 
-import zlib
-import pickle
-from io import BytesIO
-
 from zope import component
 from zope import interface
 
@@ -21,6 +17,13 @@ from zope.component.hooks import getSite
 from zope.component.hooks import setHooks
 from zope.component.hooks import site as current_site
 
+from nti.app.metadata.processing import PendingIntids
+
+from nti.app.metadata.queues import clear_queue
+
+from nti.app.metadata.replay import replay_queue
+from nti.app.metadata.replay import checkpoint_key
+
 from nti.metadata import QUEUE_NAMES
 
 from nti.dataserver.interfaces import IDataserver
@@ -32,23 +35,6 @@ generation = 7
 logger = __import__('logging').getLogger(__name__)
 
 
-def _unpickle(data):
-    data = zlib.decompress(data)
-    bio = BytesIO(data)
-    bio.seek(0)
-    result = pickle.load(bio)
-    return result
-
-
-def _reset(redis, name, hash_key):
-    keys = redis.pipeline().delete(name) \
-                .hkeys(hash_key).execute()
-    if keys and keys[1]:
-        redis.hdel(hash_key, *keys[1])
-        return keys[1]
-    return ()
-
-
 @interface.implementer(IDataserver)
 class MockDataserver(object):
 
@@ -82,20 +68,14 @@ def do_evolve(context, generation=generation):
 
         _redis = component.queryUtility(IRedisClient)
         for name in QUEUE_NAMES:
-            # process jobs
-            hash_key = name + '/hash'
-            data = _redis.lrange(name, 0, -1)
-            for job in (_unpickle(x) for x in data or ()):
-                try:
-                    job()
-                except Exception:
-                    logger.error("Cannot execute job %s", job)
-            _reset(_redis, name, hash_key)
-
-            # reset failed
-            name += "/failed"
-            hash_key = name + '/hash'
-            _reset(_redis, name, hash_key)
+            # process jobs in committed windows
+            stats = replay_queue(_redis, name)
+            logger.info("Queue %s replayed %s", name, stats)
+            # reset the queue and its failed queue
+            clear_queue(_redis, name)
+            _redis.delete(checkpoint_key(name))
+        # the coalesced intids were in the cleared jobs
+        PendingIntids(redis=_redis).clear()
 
     component.getGlobalSiteManager().unregisterUtility(mock_ds, IDataserver)
     logger.info('Metadata evolution %s done', generation)
@@ -0,0 +1,275 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Admin operations that run as jobs in the metadata queue, with a
+status kept in redis that can be polled.
+
+.. $Id$
+"""
+
+from __future__ import division
+from __future__ import print_function
+from __future__ import absolute_import
+
+import os
+import json
+import time
+import uuid
+import functools
+
+import six
+
+import transaction
+
+from zope import component
+
+from nti.app.metadata.parallel import DataserverRunner
+
+from nti.app.metadata.parallel import run_partitions
+
+from nti.app.metadata.processing import BULK_LANE
+from nti.app.metadata.processing import ALL_QUEUE_NAMES
+
+from nti.app.metadata.processing import PendingIntids
+
+from nti.app.metadata.processing import lane_queue_names
+
+from nti.app.metadata.queues import purge_queues
+
+from nti.app.metadata.reindexer import reindex
+from nti.app.metadata.reindexer import parallel_reindex
+from nti.app.metadata.reindexer import rebuild_metadata_catalog
+
+from nti.app.metadata.replay import replay_failed_jobs
+from nti.app.metadata.replay import parallel_replay_failed_jobs
+
+from nti.app.metadata.utils import check_indices
+from nti.app.metadata.utils import parallel_check_indices
+from nti.app.metadata.utils import parallel_check_structures
+from nti.app.metadata.utils import incremental_check_indices
+
+from nti.asynchronous.job import create_job
+
+from nti.dataserver.interfaces import IRedisClient
+
+from nti.metadata.processing import get_job_queue
+
+from nti.zope_catalog.interfaces import IMetadataCatalog
+
+#: Prefix of the redis keys that keep the status of the admin jobs
+JOB_STATUS_PREFIX = 'nti/app/metadata/jobs/'
+
+#: Seconds the status of a job is kept after its last update
+JOB_STATUS_EXPIRATION = 7 * 24 * 3600
+
+PENDING = u'Pending'
+RUNNING = u'Running'
+SUCCESS = u'Success'
+FAILED = u'Failed'
+
+logger = __import__('logging').getLogger(__name__)
+
+
+def _rebuild(report=None, lane=None, **kwargs):  # pylint: disable=unused-argument
+    count = rebuild_metadata_catalog(report=report, **kwargs)
+    return {'Total': count}
+
+
+def _replay(report=None, lane=None, **kwargs):  # pylint: disable=unused-argument
+    return replay_failed_jobs(report=report, **kwargs)
+
+
+def purge_metadata_queues(names=ALL_QUEUE_NAMES, jobs=True, report=None,
+                          lane=None, **kwargs):  # pylint: disable=unused-argument
+    """
+    Purge the named metadata queues with
+    :func:`nti.app.metadata.queues.purge_queues`. The pending intids are
+    cleared once the jobs of all the queues are purged, since the jobs
+    that have them may be in any of them.
+    """
+    result = purge_queues(names, jobs=jobs, report=report, **kwargs)
+    if jobs and set(ALL_QUEUE_NAMES).issubset(names):
+        PendingIntids().clear()
+    return result
+
+
+def _runner():
+    """
+    Return a runner for the worker processes of the parallel operations,
+    which are only started by jobs executed in the metadata processor.
+    """
+    env_dir = os.getenv('DATASERVER_DIR')
+    if not env_dir or not os.path.isdir(env_dir):
+        raise IOError("Invalid dataserver environment root directory")
+    return DataserverRunner(env_dir,
+                            xmlconfig_packages=('nti.appserver',
+                                                'nti.app.metadata'),
+                            with_library=True)
+
+
+def _parallel_reindex(report=None, **kwargs):  # pylint: disable=unused-argument
+    return parallel_reindex(_runner(), **kwargs)
+
+
+def _parallel_check(report=None, lane=None, workers=2,  # pylint: disable=unused-argument
+                    catalog_interface=IMetadataCatalog, test_broken=False,
+                    inspect_btrees=False, inspect_treesets=False):
+    runner = _runner()
+    result = parallel_check_indices(runner,
+                                    workers=workers,
+                                    test_broken=test_broken,
+                                    catalog_interface=catalog_interface)
+    if inspect_btrees:
+        result['Structures'] = parallel_check_structures(runner,
+                                                         workers=workers,
+                                                         inspect_treesets=inspect_treesets,
+                                                         catalog_interface=catalog_interface)
+    return result
+
+
+def _rebuild_worker(unused_partition, report, **kwargs):
+    return rebuild_metadata_catalog(report=report, commit=True, **kwargs)
+
+
+def _batched_rebuild(report=None, lane=None, **kwargs):  # pylint: disable=unused-argument
+    # a worker process owns its transactions, so each batch and the
+    # cursor are committed and the rebuild can be resumed
+    target = functools.partial(_rebuild_worker, **kwargs)
+    stats = run_partitions(target, [None], _runner(), 1)[0]
+    if stats['Status'] != 'done':
+        raise ValueError("Rebuild failed: %s" % stats.get('Result'))
+    return {'Total': stats['Result']}
+
+
+def _parallel_replay(report=None, lane=None, **kwargs):  # pylint: disable=unused-argument
+    return parallel_replay_failed_jobs(_runner(), **kwargs)
+
+
+#: The operations that can be run as admin jobs, by name
+OPERATIONS = {
+    'reindex': reindex,
+    'check_indices': check_indices,
+    'incremental_check_indices': incremental_check_indices,
+    'rebuild_metadata_catalog': _rebuild,
+    'batched_rebuild_metadata_catalog': _batched_rebuild,
+    'purge_queues': purge_metadata_queues,
+    'replay_failed_jobs': _replay,
+    'parallel_reindex': _parallel_reindex,
+    'parallel_check_indices': _parallel_check,
+    'parallel_replay_failed_jobs': _parallel_replay,
+}
+
+
+def _text(value):
+    return value.decode('utf-8') if isinstance(value, bytes) else value
+
+
+class JobStatus(object):
+    """
+    The status of an admin job, stored as a redis hash.
+    """
+
+    def __init__(self, jobid, redis=None):
+        self.jobid = jobid
+        self.redis = redis
+
+    @property
+    def key(self):
+        return JOB_STATUS_PREFIX + self.jobid
+
+    def _redis(self):
+        if self.redis is None:
+            self.redis = component.getUtility(IRedisClient)
+        return self.redis
+
+    def update(self, **values):
+        redis = self._redis()
+        redis.pipeline() \
+             .hmset(self.key, values) \
+             .expire(self.key, JOB_STATUS_EXPIRATION) \
+             .execute()
+
+    def report(self, progress):
+        self.update(Progress=progress, Updated=time.time())
+
+    def get(self):
+        data = self._redis().hgetall(self.key)
+        if not data:
+            return None
+        data = {_text(k): _text(v) for k, v in data.items()}
+        result = {
+            'JobId': self.jobid,
+            'Name': data.get('Name'),
+            'Status': data.get('Status'),
+            'Progress': int(data.get('Progress') or 0),
+        }
+        for name in ('Created', 'Started', 'Finished'):
+            if data.get(name):
+                result[name] = float(data[name])
+        if 'Started' in result:
+            end = result.get('Finished') or time.time()
+            elapsed = result['Elapsed'] = max(end - result['Started'], 0)
+            if elapsed:
+                result['Throughput'] = result['Progress'] / elapsed
+        if data.get('Result'):
+            result['Result'] = json.loads(data['Result'])
+        if data.get('Error'):
+            result['Error'] = data['Error']
+        return result
+
+
+def run_admin_job(jobid, name, **kwargs):
+    """
+    Execute the named admin operation, keeping its status up to date.
+    """
+    return _run(JobStatus(jobid), name, **kwargs)
+
+
+def _run(status, name, **kwargs):
+    jobid = status.jobid
+    status.update(Status=RUNNING, Started=time.time(), Progress=0)
+    try:
+        result = OPERATIONS[name](report=status.report, **kwargs)
+    except Exception as e:
+        logger.exception("Admin job %s (%s) failed", jobid, name)
+        status.update(Status=FAILED,
+                      Finished=time.time(),
+                      Error=six.text_type(repr(e)))
+        raise
+    status.update(Status=SUCCESS,
+                  Finished=time.time(),
+                  Result=json.dumps(result))
+    return result
+
+
+def _queue_job(success, status, name, job, queue_name):
+    if not success:
+        return
+    # the status is written before the job can be run
+    status.update(Name=name, Status=PENDING, Created=time.time())
+    get_job_queue(queue_name).put(job, use_transactions=False)
+    logger.info("Admin job %s (%s) queued", status.jobid, name)
+
+
+def queue_admin_job(name, **kwargs):
+    """
+    Put the named admin operation in the metadata queue of the lane
+    given in ``lane`` (bulk by default), which is also passed on to the
+    operation. The job and its status are only written once the current
+    transaction commits.
+
+    :return: The :class:`JobStatus` of the new job.
+    """
+    if name not in OPERATIONS:
+        raise KeyError(name)
+    jobid = uuid.uuid4().hex
+    status = JobStatus(jobid)
+    job = create_job(run_admin_job,
+                     jargs=(jobid, name),
+                     jkwargs=kwargs,
+                     jobid=jobid)
+    lane = kwargs.get('lane') or BULK_LANE
+    transaction.get().addAfterCommitHook(_queue_job,
+                                         args=(status, name, job,
+                                               lane_queue_names(lane)[0]))
+    return status
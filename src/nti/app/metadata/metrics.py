@@ -0,0 +1,362 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Metadata processor metrics.
+
+.. $Id$
+"""
+
+from __future__ import division
+from __future__ import print_function
+from __future__ import absolute_import
+
+import os
+import json
+import time
+import socket
+
+from transaction.interfaces import ISynchronizer
+
+from zope import interface
+
+from zope.interface.interfaces import ComponentLookupError
+
+from nti.app.metadata.processing import ALL_QUEUE_NAMES
+
+from nti.app.metadata.queues import get_redis
+from nti.app.metadata.queues import queue_stats
+
+#: Upper bounds, in seconds, of the latency histogram buckets
+LATENCY_BUCKETS = (0.01, 0.05, 0.1, 0.5, 1, 5, 10, 30, 60)
+
+#: Prefix of the redis keys where processors publish their metrics
+METRICS_PREFIX = 'nti/app/metadata/metrics/'
+
+#: Seconds the metrics of a processor are kept after it publishes them
+METRICS_EXPIRATION = 300
+
+#: The ``status`` of a committed transaction
+COMMITTED = 'Committed'
+
+#: The ``status`` of a transaction while it commits
+COMMITTING = 'Committing'
+
+#: The ``status`` of a transaction whose commit failed
+COMMIT_FAILED = 'Commit failed'
+
+logger = __import__('logging').getLogger(__name__)
+
+
+def _histogram():
+    return {'Counts': [0] * (len(LATENCY_BUCKETS) + 1), 'Sum': 0.0}
+
+
+def _observe(histogram, duration):
+    histogram['Sum'] += duration
+    for idx, bound in enumerate(LATENCY_BUCKETS):
+        if duration <= bound:
+            histogram['Counts'][idx] += 1
+            break
+    else:
+        histogram['Counts'][-1] += 1
+
+
+@interface.implementer(ISynchronizer)
+class ProcessorMetrics(object):
+    """
+    A transaction synchronizer that instruments the metadata processor,
+    which runs each batch of jobs in its own transaction.
+
+    The duration of the committed transactions is the batch latency.
+    Failed commits are mostly conflicts. The time between transactions
+    is time spent sleeping or polling the queues. The job counts and
+    retries are those of the
+    :class:`nti.app.metadata.consumer.BatchProcessor`, given to
+    :meth:`record`, which also gives the queue and duration of each
+    job to :meth:`observe_job` and :meth:`observe_failed`.
+
+    The metrics are published periodically to redis and, optionally,
+    written to a file in the Prometheus text format.
+    """
+
+    def __init__(self, name=None, queue_names=ALL_QUEUE_NAMES, interval=10,
+                 path=None):
+        self.path = path
+        self.interval = interval
+        self.queue_names = tuple(queue_names)
+        self.name = name or '%s:%s' % (socket.gethostname(), os.getpid())
+        self.started = time.time()
+        self.jobs = 0
+        self.failed = 0
+        self.splits = 0
+        self.batches = 0
+        self.retries = 0
+        self.commits = 0
+        self.aborts = 0
+        self.conflicts = 0
+        self.sleep_time = 0.0
+        self.latency = _histogram()
+        self.queue_jobs = {}
+        self._depths = {}
+        self._begin = None
+        self._end = None
+        self._published = self.started
+
+    # synchronizer
+
+    def newTransaction(self, unused_txn):
+        now = time.time()
+        if self._end is not None:
+            self.sleep_time += max(now - self._end, 0)
+        self._begin = now
+
+    def beforeCompletion(self, unused_txn):
+        pass
+
+    def afterCompletion(self, txn):
+        status = getattr(txn, 'status', None)
+        if status == COMMITTING:
+            # a failed commit, counted when the transaction is aborted
+            return
+        now = time.time()
+        duration = now - self._begin if self._begin is not None else 0
+        self._begin = None
+        self._end = now
+        if status == COMMITTED:
+            self.observe(duration)
+        elif status == COMMIT_FAILED:
+            self.conflicts += 1
+        else:
+            self.aborts += 1
+        if now - self._published >= self.interval:
+            self.publish(now)
+
+    # metrics
+
+    def record(self, stats):
+        """
+        Record the counters of a batch processor.
+        """
+        self.jobs = stats.get('Jobs', 0)
+        self.failed = stats.get('Failed', 0)
+        self.splits = stats.get('Splits', 0)
+        self.batches = stats.get('Batches', 0)
+        self.retries = stats.get('Retries', 0)
+
+    def observe(self, duration):
+        self.commits += 1
+        _observe(self.latency, duration)
+
+    def _queue(self, name):
+        result = self.queue_jobs.get(name)
+        if result is None:
+            result = self.queue_jobs[name] = {
+                'Jobs': 0, 'FailedJobs': 0, 'Latency': _histogram()
+            }
+        return result
+
+    def observe_job(self, queue_name, duration):
+        """
+        Record a job of the named queue committed after running for the
+        given seconds.
+        """
+        stats = self._queue(queue_name)
+        stats['Jobs'] += 1
+        _observe(stats['Latency'], duration)
+
+    def observe_failed(self, queue_name):
+        """
+        Record a job of the named queue put in its failed queue.
+        """
+        self._queue(queue_name)['FailedJobs'] += 1
+
+    def _queues(self, now):
+        result = {}
+        elapsed = now - self._published
+        redis = get_redis()
+        for name in self.queue_names:
+            stats = result[name] = queue_stats(redis, name)
+            previous = self._depths.get(name)
+            if previous is not None and elapsed > 0:
+                drained = max(previous - stats['Depth'], 0)
+                stats['DrainRate'] = drained / elapsed
+            self._depths[name] = stats['Depth']
+        return result
+
+    def snapshot(self, now=None, queues=None):
+        now = time.time() if now is None else now
+        uptime = max(now - self.started, 0)
+        finished = self.commits + self.conflicts + self.aborts
+        queue_jobs = {}
+        for name, stats in self.queue_jobs.items():
+            queue_jobs[name] = {
+                'Jobs': stats['Jobs'],
+                'JobsPerSecond': stats['Jobs'] / uptime if uptime else 0,
+                'FailedJobs': stats['FailedJobs'],
+                'Latency': {
+                    'Buckets': list(LATENCY_BUCKETS),
+                    'Counts': list(stats['Latency']['Counts']),
+                    'Sum': stats['Latency']['Sum'],
+                },
+            }
+        return {
+            'Name': self.name,
+            'Timestamp': now,
+            'Uptime': uptime,
+            'Jobs': self.jobs,
+            'JobsPerSecond': self.jobs / uptime if uptime else 0,
+            'FailedJobs': self.failed,
+            'Batches': self.batches,
+            'Splits': self.splits,
+            'Retries': self.retries,
+            'Aborts': self.aborts,
+            'Conflicts': self.conflicts,
+            'ConflictRate': self.conflicts / finished if finished else 0,
+            'SleepTime': self.sleep_time,
+            'Latency': {
+                'Buckets': list(LATENCY_BUCKETS),
+                'Counts': list(self.latency['Counts']),
+                'Sum': self.latency['Sum'],
+            },
+            'QueueJobs': queue_jobs,
+            'Queues': queues or {},
+        }
+
+    def publish(self, now=None):
+        now = time.time() if now is None else now
+        try:
+            snapshot = self.snapshot(now, self._queues(now))
+            get_redis().setex(METRICS_PREFIX + self.name,
+                              METRICS_EXPIRATION,
+                              json.dumps(snapshot))
+        except ComponentLookupError:
+            return None
+        except Exception:  # pylint: disable=broad-except
+            logger.exception("Cannot publish metadata processor metrics")
+            return None
+        finally:
+            self._published = now
+        if self.path:
+            write_prometheus(self.path, [snapshot])
+        return snapshot
+
+
+def get_processor_metrics(redis=None):
+    """
+    Return the metrics published by the running processors.
+    """
+    result = []
+    redis = get_redis() if redis is None else redis
+    for key in redis.scan_iter(match=METRICS_PREFIX + '*'):
+        data = redis.get(key)
+        if data:
+            if isinstance(data, bytes):
+                data = data.decode('utf-8')
+            result.append(json.loads(data))
+    return sorted(result, key=lambda x: x['Name'])
+
+
+def _line(name, labels, value):
+    labels = ','.join('%s="%s"' % (k, v) for k, v in sorted(labels.items()))
+    return '%s{%s} %s' % (name, labels, value)
+
+
+def _histogram_lines(name, labels, latency):
+    lines = []
+    total = 0
+    bounds = [str(x) for x in latency['Buckets']] + ['+Inf']
+    for bound, count in zip(bounds, latency['Counts']):
+        total += count
+        lines.append(_line(name + '_bucket', dict(labels, le=bound), total))
+    lines.append(_line(name + '_sum', labels, latency['Sum']))
+    lines.append(_line(name + '_count', labels, total))
+    return lines
+
+
+def render_prometheus(snapshots):
+    """
+    Render the given processor metrics in the Prometheus text format.
+    """
+    lines = []
+    counters = (
+        ('jobs_total', 'counter', 'Jobs executed', 'Jobs'),
+        ('failed_jobs_total', 'counter',
+         'Jobs put in the failed queues', 'FailedJobs'),
+        ('batches_total', 'counter', 'Batches of jobs executed', 'Batches'),
+        ('batch_splits_total', 'counter',
+         'Batches split after a failed commit', 'Splits'),
+        ('transaction_retries_total', 'counter',
+         'Jobs executed again after an aborted transaction', 'Retries'),
+        ('aborts_total', 'counter', 'Aborted transactions', 'Aborts'),
+        ('conflicts_total', 'counter', 'Failed commits', 'Conflicts'),
+        ('conflict_rate', 'gauge',
+         'Ratio of failed commits to transactions', 'ConflictRate'),
+        ('sleep_seconds_total', 'counter',
+         'Time spent between transactions', 'SleepTime'),
+        ('jobs_per_second', 'gauge', 'Average job throughput', 'JobsPerSecond'),
+    )
+    for suffix, kind, doc, key in counters:
+        name = 'nti_metadata_processor_' + suffix
+        lines.append('# HELP %s %s' % (name, doc))
+        lines.append('# TYPE %s %s' % (name, kind))
+        for snapshot in snapshots:
+            lines.append(_line(name, {'processor': snapshot['Name']},
+                               snapshot.get(key, 0)))
+
+    name = 'nti_metadata_processor_batch_latency_seconds'
+    lines.append('# HELP %s Duration of the committed batches' % name)
+    lines.append('# TYPE %s histogram' % name)
+    for snapshot in snapshots:
+        lines.extend(_histogram_lines(name, {'processor': snapshot['Name']},
+                                      snapshot['Latency']))
+
+    queue_counters = (
+        ('queue_jobs_total', 'counter', 'Jobs executed', 'Jobs'),
+        ('queue_failed_jobs_total', 'counter',
+         'Jobs put in the failed queue', 'FailedJobs'),
+        ('queue_jobs_per_second', 'gauge',
+         'Average job throughput', 'JobsPerSecond'),
+    )
+    for suffix, kind, doc, key in queue_counters:
+        name = 'nti_metadata_processor_' + suffix
+        lines.append('# HELP %s %s' % (name, doc))
+        lines.append('# TYPE %s %s' % (name, kind))
+        for snapshot in snapshots:
+            for queue, stats in sorted(snapshot.get('QueueJobs', {}).items()):
+                labels = {'processor': snapshot['Name'], 'queue': queue}
+                lines.append(_line(name, labels, stats[key]))
+
+    name = 'nti_metadata_processor_job_latency_seconds'
+    lines.append('# HELP %s Duration of the committed jobs' % name)
+    lines.append('# TYPE %s histogram' % name)
+    for snapshot in snapshots:
+        for queue, stats in sorted(snapshot.get('QueueJobs', {}).items()):
+            labels = {'processor': snapshot['Name'], 'queue': queue}
+            lines.extend(_histogram_lines(name, labels, stats['Latency']))
+
+    gauges = (
+        ('queue_depth', 'Jobs in the queue', 'Depth'),
+        ('queue_failed_depth', 'Jobs in the failed queue', 'FailedDepth'),
+        ('queue_oldest_job_age_seconds', 'Age of the oldest job', 'OldestJobAge'),
+        ('queue_drain_rate', 'Jobs removed from the queue per second', 'DrainRate'),
+    )
+    for suffix, doc, key in gauges:
+        name = 'nti_metadata_' + suffix
+        lines.append('# HELP %s %s' % (name, doc))
+        lines.append('# TYPE %s gauge' % name)
+        for snapshot in snapshots:
+            for queue, stats in sorted(snapshot['Queues'].items()):
+                if stats.get(key) is not None:
+                    labels = {'processor': snapshot['Name'], 'queue': queue}
+                    lines.append(_line(name, labels, stats[key]))
+    return '\n'.join(lines) + '\n'
+
+
+def write_prometheus(path, snapshots):
+    tmp = path + '.tmp'
+    try:
+        with open(tmp, 'w') as fp:
+            fp.write(render_prometheus(snapshots))
+        os.rename(tmp, path)
+    except (IOError, OSError):
+        logger.exception("Cannot write metrics to %s", path)
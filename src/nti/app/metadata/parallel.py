@@ -0,0 +1,271 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Helpers to spread work over worker processes, each one running with
+its own database connection.
+
+.. $Id$
+"""
+
+from __future__ import division
+from __future__ import print_function
+from __future__ import absolute_import
+
+import sys
+import functools
+import multiprocessing
+from itertools import islice
+
+from six.moves import queue as Queue
+
+import transaction
+
+from ZODB.POSException import ConflictError
+
+from zope import component
+
+from nti.dataserver.interfaces import IRedisClient
+
+from nti.dataserver.utils import run_with_dataserver
+
+from nti.dataserver.utils.base_script import create_context
+
+#: Default number of attempts for a conflicting batch
+DEFAULT_RETRIES = 5
+
+#: Seconds a shared set is kept in redis after it is created
+SHARED_SET_EXPIRATION = 24 * 3600
+
+#: Seconds to wait for a worker message before checking the workers
+POLL_INTERVAL = 1
+
+logger = __import__('logging').getLogger(__name__)
+
+
+def partition_ids(doc_ids, partitions):
+    """
+    Split the given doc ids in at most ``partitions`` contiguous,
+    inclusive ``(min, max)`` intid ranges of about the same size.
+
+    :param doc_ids: A sized collection that iterates in ascending
+        order, e.g. a ``BTrees`` set.
+    """
+    total = len(doc_ids)
+    if not total:
+        return []
+    partitions = max(1, min(partitions, total))
+    size = -(-total // partitions)
+    result = []
+    low = None
+    for idx, doc_id in enumerate(doc_ids):
+        if idx % size == 0:
+            low = doc_id
+        if idx % size == size - 1 or idx == total - 1:
+            result.append((low, doc_id))
+    return result
+
+
+def commit_in_batches(items, batch_size, func, report=None,
+                      retries=DEFAULT_RETRIES):
+    """
+    Call ``func(batch)`` for each batch of ``batch_size`` items and
+    commit after each one. A batch that conflicts is aborted and retried
+    up to ``retries`` times, so ``func`` must be safe to call again.
+
+    :param report: An optional callable that is given the accumulated
+        result of ``func`` after each commit.
+    :return: The sum of the values returned by ``func``.
+    """
+    total = 0
+    items = iter(items)
+    while True:
+        batch = list(islice(items, batch_size))
+        if not batch:
+            break
+        for attempt in range(retries):
+            try:
+                count = func(batch)
+                transaction.commit()
+                break
+            except ConflictError:
+                transaction.abort()
+                logger.warning("Conflict processing %s-%s (attempt %s)",
+                               batch[0], batch[-1], attempt + 1)
+        else:
+            raise ConflictError("Too many conflicts processing %s-%s" %
+                                (batch[0], batch[-1]))
+        total += count or 0
+        if report is not None:
+            report(total)
+    return total
+
+
+class SharedSet(object):
+    """
+    A set of intids kept in redis, so that it can be shared by worker
+    processes.
+    """
+
+    def __init__(self, key, redis=None):
+        self.key = key
+        self.redis = redis
+
+    def _redis(self):
+        if self.redis is None:
+            self.redis = component.getUtility(IRedisClient)
+        return self.redis
+
+    def add_new(self, doc_ids):
+        """
+        Add the given intids and return the ones that were not in the
+        set already.
+        """
+        doc_ids = list(doc_ids)
+        if not doc_ids:
+            return []
+        pipe = self._redis().pipeline()
+        pipe.exists(self.key)
+        for doc_id in doc_ids:
+            pipe.sadd(self.key, doc_id)
+        added = pipe.execute()
+        # the expiration is not refreshed, so a set that is never
+        # cleared does not live forever
+        if not added.pop(0):
+            self._redis().expire(self.key, SHARED_SET_EXPIRATION)
+        return [x for x, y in zip(doc_ids, added) if y]
+
+    def missing(self, doc_ids):
+        """
+        Return the given intids that are not in the set.
+        """
+        doc_ids = list(doc_ids)
+        if not doc_ids:
+            return []
+        pipe = self._redis().pipeline()
+        for doc_id in doc_ids:
+            pipe.sismember(self.key, doc_id)
+        return [x for x, y in zip(doc_ids, pipe.execute()) if not y]
+
+    def __len__(self):
+        return self._redis().scard(self.key)
+
+    def clear(self):
+        self._redis().delete(self.key)
+
+
+class DataserverRunner(object):
+    """
+    Runs a function in a new dataserver, and hence with its own database
+    connection. Instances are sent to the worker processes.
+    """
+
+    def __init__(self, env_dir, xmlconfig_packages=('nti.appserver',),
+                 with_library=False):
+        self.env_dir = env_dir
+        self.with_library = with_library
+        self.xmlconfig_packages = xmlconfig_packages
+
+    def __call__(self, function):
+        context = create_context(self.env_dir,
+                                 with_library=self.with_library)
+        return run_with_dataserver(environment_dir=self.env_dir,
+                                   xmlconfig_packages=self.xmlconfig_packages,
+                                   context=context,
+                                   minimal_ds=True,
+                                   function=function)
+
+
+def mp_context():
+    """
+    Return the :mod:`multiprocessing` context used to start the worker
+    processes.
+    """
+    try:
+        # don't fork processes that hold database connections
+        return multiprocessing.get_context('spawn')
+    except AttributeError:  # pragma: no cover
+        # python 2 can only fork. The workers open their own dataserver
+        # and exit with os._exit, so they never use nor close the
+        # connections they inherit.
+        return multiprocessing
+
+
+def _worker(runner, target, index, partition, messages):
+    def report(count):
+        messages.put(('progress', index, count))
+    try:
+        result = runner(functools.partial(target, partition, report))
+        messages.put(('result', index, result))
+    except Exception as e:  # pylint: disable=broad-except
+        logger.exception("Partition %s %s failed", index, partition)
+        messages.put(('error', index, repr(e)))
+        # the exit code tells the partition failed
+        sys.exit(1)
+
+
+def run_partitions(target, partitions, runner, workers=None):
+    """
+    Run ``target(partition, report)`` for each partition in a worker
+    process through ``runner``, with at most ``workers`` of them at
+    the same time. ``report`` may be called by the target with a
+    progress count.
+
+    Both the target and the runner must be picklable.
+
+    :return: A dictionary with the status, progress count and result
+        of each partition, by its index. The status is only set from
+        the exit code of the worker, once all its messages are read.
+    """
+    context = mp_context()
+    messages = context.Queue()
+    workers = workers or len(partitions)
+    pending = list(enumerate(partitions))
+    stats = {
+        index: {'Partition': partition, 'Status': 'pending', 'Count': 0}
+        for index, partition in pending
+    }
+
+    def receive(kind, index, value):
+        if kind == 'progress':
+            stats[index]['Count'] = value
+            logger.info("Partition %s %s: %s processed",
+                        index, stats[index]['Partition'], value)
+        else:
+            stats[index]['Result'] = value
+
+    running = {}
+    while pending or running:
+        while pending and len(running) < workers:
+            index, partition = pending.pop(0)
+            process = context.Process(target=_worker,
+                                      args=(runner, target, index,
+                                            partition, messages))
+            process.start()
+            running[index] = process
+            stats[index]['Status'] = 'running'
+        try:
+            receive(*messages.get(timeout=POLL_INTERVAL))
+        except Queue.Empty:
+            pass
+        for index, process in list(running.items()):
+            if process.is_alive():
+                continue
+            process.join()
+            del running[index]
+            # a worker sends all its messages before it exits
+            while True:
+                try:
+                    receive(*messages.get_nowait())
+                except Queue.Empty:
+                    break
+            stat = stats[index]
+            if process.exitcode == 0 and 'Result' in stat:
+                stat['Status'] = 'done'
+                logger.info("Partition %s %s done",
+                            index, stat['Partition'])
+            else:
+                stat['Status'] = 'failed'
+                stat.setdefault('Result', process.exitcode)
+                logger.error("Partition %s %s failed with exit code %s",
+                             index, stat['Partition'], process.exitcode)
+    return stats
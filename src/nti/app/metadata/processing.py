@@ -0,0 +1,256 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Bulk metadata indexing jobs.
+
+.. $Id$
+"""
+
+from __future__ import division
+from __future__ import print_function
+from __future__ import absolute_import
+
+import uuid
+
+import six
+
+import transaction
+
+from ZODB.POSException import POSError
+
+from zope import component
+
+from zope.intid.interfaces import IIntIds
+
+from nti.app.metadata.parallel import SharedSet
+
+from nti.asynchronous.job import create_job
+
+from nti.metadata import QUEUE_NAMES
+
+from nti.metadata import metadata_catalogs
+
+from nti.metadata.processing import get_job_queue
+
+#: Default number of intids in a bulk indexing job
+DEFAULT_CHUNK_SIZE = 500
+
+#: The lane of the metadata queues used by real-time indexing
+INTERACTIVE_LANE = u'interactive'
+
+#: The low-priority lane used by bulk reindexes and rebuilds
+BULK_LANE = u'bulk'
+
+LANES = (INTERACTIVE_LANE, BULK_LANE)
+
+#: The queues of the bulk lane, drained after the interactive ones
+BULK_QUEUE_NAMES = tuple(name + '/bulk' for name in QUEUE_NAMES)
+
+#: The queues of all the lanes
+ALL_QUEUE_NAMES = tuple(QUEUE_NAMES) + BULK_QUEUE_NAMES
+
+#: Redis set of the intids waiting in a bulk indexing job
+PENDING_KEY = 'nti/app/metadata/pending'
+
+#: Redis counter of the intids merged into a pending job
+COALESCED_KEY = 'nti/app/metadata/coalesced'
+
+logger = __import__('logging').getLogger(__name__)
+
+
+def lane_queue_names(lane=INTERACTIVE_LANE):
+    """
+    Return the names of the queues of the given lane.
+    """
+    if lane == BULK_LANE:
+        return BULK_QUEUE_NAMES
+    if lane == INTERACTIVE_LANE:
+        return tuple(QUEUE_NAMES)
+    raise ValueError("Invalid lane %s" % lane)
+
+
+class PendingIntids(SharedSet):
+    """
+    The intids waiting in a bulk indexing job. Queuing an intid that is
+    still pending is coalesced with the job that already has it, since
+    indexing an object always reads its latest state.
+
+    Jobs are only queued when their transaction commits, so the intids
+    are added to the set by the commit, and removed again if it fails.
+    An aborted or retried transaction leaves no intid pending without
+    a job.
+    """
+
+    _txn = None
+    _state = None
+
+    def __init__(self, key=PENDING_KEY, redis=None):
+        super(PendingIntids, self).__init__(key, redis)
+
+    def _transaction_state(self):
+        txn = transaction.get()
+        if self._txn is not txn:
+            self._txn = txn
+            self._state = {'DocIds': [], 'Added': [], 'Coalesced': 0}
+            txn.addBeforeCommitHook(self._before_commit,
+                                    args=(self._state,))
+            txn.addAfterCommitHook(self._after_commit,
+                                   args=(self._state,))
+        return self._state
+
+    def _before_commit(self, state):
+        # added before the jobs are queued, so a job never runs before
+        # its intids are pending
+        state['Added'] = super(PendingIntids, self).add_new(state['DocIds'])
+
+    def _after_commit(self, status, state):
+        if not status:
+            self.discard(state['Added'])
+        elif state['Coalesced']:
+            self._redis().incrby(COALESCED_KEY, state['Coalesced'])
+
+    def add_new(self, doc_ids):
+        """
+        Return the given intids that are neither pending nor queued by
+        the current transaction. They are pending once it commits.
+        """
+        doc_ids = list(doc_ids)
+        state = self._transaction_state()
+        queued = set(state['DocIds'])
+        result = [x for x in self.missing(doc_ids) if x not in queued]
+        state['DocIds'].extend(result)
+        state['Coalesced'] += len(doc_ids) - len(result)
+        return result
+
+    def discard(self, doc_ids):
+        doc_ids = list(doc_ids)
+        if doc_ids:
+            self._redis().srem(self.key, *doc_ids)
+
+    @property
+    def coalesced(self):
+        return int(self._redis().get(COALESCED_KEY) or 0)
+
+
+def coalescing_stats(redis=None):
+    """
+    Return the number of pending and of coalesced intids.
+    """
+    pending = PendingIntids(redis=redis)
+    return {
+        'Pending': len(pending),
+        'Coalesced': pending.coalesced,
+    }
+
+
+def index_doc_ids(doc_ids):
+    """
+    Index the objects with the given intids in all the metadata
+    catalogs. Ids of objects that no longer exist are unindexed.
+    """
+    count = 0
+    # changes made from now on need a new job
+    PendingIntids().discard(doc_ids)
+    catalogs = metadata_catalogs()
+    intids = component.getUtility(IIntIds)
+    for doc_id in doc_ids:
+        obj = intids.queryObject(doc_id)
+        try:
+            for catalog in catalogs:
+                if obj is None:
+                    catalog.unindex_doc(doc_id)
+                else:
+                    catalog.force_index_doc(doc_id, obj)
+        except (POSError, TypeError) as e:
+            logger.error('Error %s while indexing %s, %s',
+                         e, doc_id, type(obj))
+        else:
+            count += obj is not None
+    return count
+
+
+def job_doc_ids(job):
+    """
+    Return the intids the given job indexes, taken from its arguments.
+    """
+    for arg in getattr(job, 'args', None) or ():
+        if isinstance(arg, six.integer_types):
+            return [arg]
+        if isinstance(arg, (list, tuple)) and arg:
+            if all(isinstance(x, six.integer_types) for x in arg):
+                return list(arg)
+    return []
+
+
+def event_doc_id(job):
+    """
+    Return the intid of the given job if it is queued for an event on a
+    single object, rather than a bulk indexing job.
+    """
+    for arg in getattr(job, 'args', None) or ():
+        if isinstance(arg, six.integer_types):
+            return arg
+    return None
+
+
+def put_index_job(doc_ids, name=None):
+    """
+    Put a single job that indexes all the given intids in the named
+    metadata queue.
+    """
+    jobid = uuid.uuid4().hex
+    job = create_job(index_doc_ids,
+                     jargs=(list(doc_ids),),
+                     jobid=jobid)
+    queue = get_job_queue(name or QUEUE_NAMES[0])
+    queue.put(job)
+    return job
+
+
+class BulkQueuer(object):
+    """
+    Collect intids to be indexed and put them in the metadata queues
+    in chunks, one job per chunk, instead of one job per intid.
+
+    Chunks are spread over the given queue names. If given a
+    :class:`PendingIntids`, intids already waiting in a job are not
+    queued again.
+    """
+
+    def __init__(self, chunk_size=DEFAULT_CHUNK_SIZE, queue_names=QUEUE_NAMES,
+                 put=put_index_job, pending=None):
+        self.put = put
+        self.jobs = 0
+        self.total = 0
+        self.coalesced = 0
+        self.pending = pending
+        self.buffer = []
+        self.chunk_size = chunk_size
+        self.queue_names = tuple(queue_names)
+
+    def add(self, doc_id):
+        self.buffer.append(doc_id)
+        if len(self.buffer) >= self.chunk_size:
+            self.flush()
+
+    def flush(self):
+        doc_ids, self.buffer = self.buffer, []
+        if doc_ids and self.pending is not None:
+            queued = self.pending.add_new(doc_ids)
+            self.coalesced += len(doc_ids) - len(queued)
+            doc_ids = queued
+        if doc_ids:
+            name = self.queue_names[self.jobs % len(self.queue_names)]
+            self.put(doc_ids, name)
+            self.jobs += 1
+            self.total += len(doc_ids)
+
+    def __call__(self, doc_id):
+        self.add(doc_id)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, unused_exc_value, unused_traceback):
+        if exc_type is None:
+            self.flush()
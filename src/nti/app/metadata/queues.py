@@ -0,0 +1,228 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Direct access to the redis structures of the metadata job queues.
+
+A queue named ``name`` keeps its pickled jobs in the list ``name``, the
+job ids in the hash ``name/hash`` and its failed jobs in another queue
+named ``name/failed``.
+
+.. $Id$
+"""
+
+from __future__ import division
+from __future__ import print_function
+from __future__ import absolute_import
+
+import time
+import zlib
+import pickle
+from io import BytesIO
+
+from zope import component
+
+from nti.dataserver.interfaces import IRedisClient
+
+#: Default number of keys read per redis call
+DEFAULT_SCAN_SIZE = 1000
+
+logger = __import__('logging').getLogger(__name__)
+
+
+def get_redis():
+    return component.getUtility(IRedisClient)
+
+
+def hash_key(name):
+    return name + '/hash'
+
+
+def failed_name(name):
+    return name + '/failed'
+
+
+def unpickle(data):
+    data = zlib.decompress(data)
+    bio = BytesIO(data)
+    bio.seek(0)
+    result = pickle.load(bio)
+    return result
+
+
+def pickle_job(job):
+    bio = BytesIO()
+    pickle.dump(job, bio)
+    return zlib.compress(bio.getvalue())
+
+
+def _text(value):
+    return value.decode('utf-8') if isinstance(value, bytes) else value
+
+
+def job_created(job):
+    return getattr(job, 'createdTime', None) or getattr(job, 'created', None)
+
+
+def oldest_job_age(redis, name, now=None):
+    """
+    Return the age in seconds of the job at the head of the named queue,
+    or None if it is empty or the job has no creation time.
+    """
+    data = redis.lindex(name, 0)
+    if not data:
+        return None
+    try:
+        created = job_created(unpickle(data))
+    except Exception:  # pylint: disable=broad-except
+        logger.exception("Cannot read job at the head of %s", name)
+        return None
+    if not created:
+        return None
+    now = time.time() if now is None else now
+    return max(now - created, 0)
+
+
+def queue_stats(redis, name):
+    """
+    Return the depth, the age of the oldest job and the failed-queue
+    depth of the named queue.
+    """
+    failed = failed_name(name)
+    depth, failed_depth = redis.pipeline() \
+                               .llen(name) \
+                               .llen(failed) \
+                               .execute()
+    return {
+        'Depth': depth,
+        'FailedDepth': failed_depth,
+        'OldestJobAge': oldest_job_age(redis, name),
+    }
+
+
+def scan_job_keys(redis, name, cursor=0, count=DEFAULT_SCAN_SIZE):
+    """
+    Return the next cursor and a page of the job keys of the named
+    queue. A returned cursor of 0 means there are no more keys.
+    """
+    cursor, data = redis.hscan(hash_key(name), cursor, count=count)
+    return int(cursor), sorted(_text(x) for x in data)
+
+
+def iter_job_keys(redis, name, count=DEFAULT_SCAN_SIZE):
+    """
+    Iterate over the job keys of the named queue without reading them
+    all at once.
+    """
+    for key, unused_value in redis.hscan_iter(hash_key(name), count=count):
+        yield _text(key)
+
+
+def _unlink(redis, *keys):
+    """
+    Remove the given keys with ``UNLINK``, which frees their memory in
+    the background, or return None if the server does not support it.
+    """
+    if not hasattr(redis, 'unlink'):
+        return None
+    try:
+        return redis.unlink(*keys)
+    except Exception:  # pylint: disable=broad-except
+        logger.warning("Cannot unlink %s, deleting in chunks", keys)
+        return None
+
+
+def delete_hash(redis, key, count=DEFAULT_SCAN_SIZE):
+    """
+    Delete the fields of the given hash in ``HSCAN`` pages of ``count``,
+    so redis is never blocked by a single huge command.
+
+    :return: The number of fields removed.
+    """
+    removed = 0
+    cursor = 0
+    while True:
+        cursor, data = redis.hscan(key, cursor, count=count)
+        if data:
+            removed += redis.hdel(key, *data)
+        if not int(cursor):
+            break
+    redis.delete(key)
+    return removed
+
+
+def delete_list(redis, key, count=DEFAULT_SCAN_SIZE):
+    """
+    Delete the given list trimming ``count`` items at a time.
+
+    :return: The number of items removed.
+    """
+    removed = 0
+    while True:
+        size = redis.llen(key)
+        if not size:
+            break
+        redis.ltrim(key, count, -1)
+        removed += min(size, count)
+    return removed
+
+
+def _clear(redis, name, count, unlink):
+    key = hash_key(name)
+    if unlink:
+        jobs, keys = redis.pipeline() \
+                          .llen(name) \
+                          .hlen(key) \
+                          .execute()
+        if _unlink(redis, name, key) is not None:
+            return jobs, keys
+    return delete_list(redis, name, count), delete_hash(redis, key, count)
+
+
+def clear_queue(redis, name, jobs=True, failed=True,
+                count=DEFAULT_SCAN_SIZE, unlink=True):
+    """
+    Remove the jobs and job keys of the named queue and/or of its failed
+    queue. With ``unlink`` they are removed with ``UNLINK`` if the
+    server supports it, otherwise in chunks of ``count``.
+
+    :return: The number of jobs and job keys removed from each and the
+        elapsed time.
+    """
+    started = time.time()
+    result = dict.fromkeys(('Jobs', 'Keys', 'FailedJobs', 'FailedKeys'), 0)
+    if jobs:
+        result['Jobs'], result['Keys'] = _clear(redis, name, count, unlink)
+    if failed:
+        result['FailedJobs'], result['FailedKeys'] = \
+            _clear(redis, failed_name(name), count, unlink)
+    result['Elapsed'] = time.time() - started
+    logger.info("Queue %s cleared %s", name, result)
+    return result
+
+
+def purge_queues(names, jobs=True, failed=True, count=DEFAULT_SCAN_SIZE,
+                 unlink=False, redis=None, report=None):
+    """
+    Clear the named queues, by default in chunks of ``count`` so redis
+    keeps serving other clients while a large backlog is removed.
+
+    :param report: An optional callable that is given the number of
+        jobs removed after each queue.
+    :return: The :func:`clear_queue` report of each queue, the total
+        number of jobs removed and the elapsed time.
+    """
+    started = time.time()
+    redis = get_redis() if redis is None else redis
+    total = 0
+    queues = {}
+    for name in names:
+        stats = queues[name] = clear_queue(redis, name, jobs, failed,
+                                           count, unlink)
+        total += stats['Jobs'] + stats['FailedJobs']
+        if report is not None:
+            report(total)
+    return {
+        'Queues': queues,
+        'Total': total,
+        'Elapsed': time.time() - started,
+    }
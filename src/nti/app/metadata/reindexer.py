@@ -9,66 +9,120 @@ from __future__ import print_function
 from __future__ import absolute_import
 
 import time
+import uuid
+import functools
 from collections import defaultdict
 
-from zc.catalog.interfaces import IIndexValues
+import transaction
 
-from zc.catalog.index import NormalizationWrapper
+from BTrees.OOBTree import OOBTree
 
 from ZODB.POSException import POSError
 
-from zope import component
-
-from zope.index.topic import TopicIndex
+from persistent import Persistent
 
-from zope.index.topic.interfaces import ITopicFilteredSet
+from zope import component
 
 from zope.intid.interfaces import IIntIds
 
+from zope.location.location import locate
+
 from zope.security.management import system_user
 
+from nti.app.metadata.parallel import DEFAULT_RETRIES
+
+from nti.app.metadata.parallel import SharedSet
+from nti.app.metadata.parallel import partition_ids
+from nti.app.metadata.parallel import run_partitions
+from nti.app.metadata.parallel import commit_in_batches
+
+from nti.app.metadata.processing import DEFAULT_CHUNK_SIZE
+
+from nti.app.metadata.processing import BULK_LANE
+
+from nti.app.metadata.processing import BulkQueuer
+from nti.app.metadata.processing import PendingIntids
+
+from nti.app.metadata.processing import lane_queue_names
+
+from nti.app.metadata.utils import database_root
+from nti.app.metadata.utils import get_catalog_doc_ids
+from nti.app.metadata.utils import iter_catalog_doc_ids
 from nti.app.metadata.utils import principal_metadata_objects
 
 from nti.dataserver.interfaces import IUser
 
+from nti.dataserver.metadata.index import IX_LASTMODIFIED
+
 from nti.dataserver.metadata.index import add_catalog_filters
 from nti.dataserver.metadata.index import get_metadata_catalog
+from nti.dataserver.metadata.index import create_metadata_catalog
 
 from nti.dataserver.users.users import User
 
+from nti.dataserver.utils.base_script import set_site
+
 from nti.externalization.interfaces import LocatedExternalDict
 from nti.externalization.interfaces import StandardExternalFields
 
 from nti.metadata import queue_add
 
-from nti.zope_catalog.interfaces import IKeywordIndex
+from nti.zope_catalog.interfaces import IMetadataCatalog
 
 TOTAL = StandardExternalFields.TOTAL
 ITEM_COUNT = StandardExternalFields.ITEM_COUNT
 
+#: Default number of documents per rebuild batch
+DEFAULT_BATCH_SIZE = 1000
+
+#: Key in the database root where the cursor of a batched rebuild is kept
+REBUILD_CURSOR_KEY = 'nti.app.metadata.rebuild_cursor'
+
 logger = __import__('logging').getLogger(__name__)
 
 
-def reindex_principal(principal, accept=(), intids=None, mt_count=None, seen=None):
+def reindex_principal(principal, accept=(), intids=None, mt_count=None, seen=None,
+                      queue=None, since=None, until=None):
     result = 0
     seen = set() if seen is None else seen
+    queue = queue_add if queue is None else queue
     mt_count = defaultdict(int) if mt_count is None else mt_count
     intids = component.getUtility(IIntIds) if intids is None else intids
-    for iid, mimeType, _ in principal_metadata_objects(principal, accept, intids):
+    for iid, mimeType, _ in principal_metadata_objects(principal, accept, intids,
+                                                       since=since, until=until):
         if iid in seen:
             continue
         result += 1
         seen.add(iid)
-        queue_add(iid)
+        queue(iid)
         mt_count[mimeType] = mt_count[mimeType] + 1
     return result
 
 
-def reindex(usernames=(), system=False, accept=(), intids=None):
+def _queuer(chunk_size, lane=BULK_LANE):
+    return BulkQueuer(chunk_size,
+                      queue_names=lane_queue_names(lane),
+                      pending=PendingIntids())
+
+
+def reindex(usernames=(), system=False, accept=(), intids=None, report=None,
+            bulk=True, chunk_size=DEFAULT_CHUNK_SIZE, lane=BULK_LANE,
+            since=None, until=None):
+    """
+    Queue the objects of the given principals to be reindexed, only the
+    ones created or last modified between ``since`` and ``until`` if
+    either is given.
+
+    :param bulk: Queue one job per ``chunk_size`` objects instead of
+        one job per object.
+    :param lane: The lane of the queues of the bulk jobs. Jobs for
+        single objects always go to the interactive lane.
+    """
     total = 0
     seen = set()
     now = time.time()
     mt_count = defaultdict(int)
+    queuer = _queuer(chunk_size, lane) if bulk else None
     intids = component.getUtility(IIntIds) if intids is None else intids
     for username in usernames or ():
         user = User.get_user(username)
@@ -77,75 +131,501 @@ def reindex(usernames=(), system=False, accept=(), intids=None):
         total += reindex_principal(user,
                                    accept,
                                    seen=seen,
+                                   since=since,
+                                   until=until,
+                                   queue=queuer,
                                    intids=intids,
                                    mt_count=mt_count)
+        if report is not None:
+            report(total)
 
     if system:
         total += reindex_principal(system_user(),
                                    accept,
                                    seen=seen,
+                                   since=since,
+                                   until=until,
+                                   queue=queuer,
                                    intids=intids,
                                    mt_count=mt_count)
 
+    if queuer is not None:
+        queuer.flush()
+
     elapsed = time.time() - now
     result = LocatedExternalDict()
     result[TOTAL] = total
     result['Elapsed'] = elapsed
     result['MimeTypeCount'] = dict(mt_count)
+    if queuer is not None:
+        result['Jobs'] = queuer.jobs
+        result['Coalesced'] = queuer.coalesced
+    if since is not None or until is not None:
+        result['Since'] = since
+        result['Until'] = until
     logger.info("%s object(s) processed in %s(s)", total, elapsed)
     return result
 
 
-def get_catalog_doc_ids(catalog):
-    seen = set()
-    for name, index in catalog.items():
-        if isinstance(index, NormalizationWrapper):
-            index = index.index
-        try:
-            if IIndexValues.providedBy(index):
-                seen.update(index.ids())
-            elif IKeywordIndex.providedBy(index):
-                seen.update(index.ids())
-            elif isinstance(index, TopicIndex):
-                # pylint: disable=protected-access
-                for filter_index in index._filters.values():
-                    if ITopicFilteredSet.providedBy(filter_index):
-                        seen.update(filter_index.getIds())
-        except (POSError, TypeError) as e:
-            logger.error('Error %s while getting ids from index "%s" (%s)',
-                         e, name, index)
-    return seen
-
-
-def rebuild_metadata_catalog(seen=None):
+def _reindex_shared(principal, accept, intids, seen, queue, mt_count,
+                    since=None, until=None):
+    found = {}
+    for iid, mimeType, _ in principal_metadata_objects(principal, accept, intids,
+                                                       since=since, until=until):
+        found[iid] = mimeType
+    result = 0
+    for iid in seen.add_new(sorted(found)):
+        result += 1
+        queue(iid)
+        mimeType = found[iid]
+        mt_count[mimeType] = mt_count[mimeType] + 1
+    return result
+
+
+def reindex_partition(usernames, report=None, accept=(), seen_key=None,
+                      bulk=True, chunk_size=DEFAULT_CHUNK_SIZE, site=None,
+                      lane=BULK_LANE, since=None, until=None):
+    """
+    Queue the objects of the given users to be reindexed, skipping the
+    ones found in the shared set of seen intids, and commit after each
+    user.
+
+    This is meant to run in a worker process with its own connection.
+    """
+    if site:
+        set_site(site)
+    total = 0
+    seen = SharedSet(seen_key)
+    mt_count = defaultdict(int)
     intids = component.getUtility(IIntIds)
-    # get all ids and clear indexes
-    catalog = get_metadata_catalog()
-    doc_ids = get_catalog_doc_ids(catalog)
+    queuer = _queuer(chunk_size, lane) if bulk else None
+    for username in usernames:
+        user = User.get_user(username)
+        if not IUser.providedBy(user):
+            continue
+        total += _reindex_shared(user, accept, intids, seen,
+                                 queuer or queue_add, mt_count,
+                                 since, until)
+        transaction.commit()
+        intids._p_jar.cacheGC()
+        if report is not None:
+            report(total)
+    if queuer is not None:
+        queuer.flush()
+    return {
+        TOTAL: total,
+        'MimeTypeCount': dict(mt_count),
+        'Jobs': queuer.jobs if queuer is not None else total,
+        'Coalesced': queuer.coalesced if queuer is not None else 0,
+    }
+
+
+def parallel_reindex(runner, usernames=(), system=False, accept=(), workers=2,
+                     bulk=True, chunk_size=DEFAULT_CHUNK_SIZE, site=None,
+                     lane=BULK_LANE, since=None, until=None):
+    """
+    Queue the objects of the given principals to be reindexed, spreading
+    the users over worker processes. The intids already queued are
+    shared by the workers through redis.
+
+    :param runner: A picklable callable that runs a function with its
+        own database connection in the worker process, e.g.
+        :class:`nti.app.metadata.parallel.DataserverRunner`
+    """
+    total = 0
+    jobs = 0
+    coalesced = 0
+    failed = []
+    now = time.time()
+    mt_count = defaultdict(int)
+    seen = SharedSet('nti/app/metadata/reindex/' + uuid.uuid4().hex)
+    usernames = list(usernames or ())
+    partitions = [
+        tuple(usernames[idx::workers]) for idx in range(min(workers, len(usernames)))
+    ]
+    target = functools.partial(reindex_partition,
+                               bulk=bulk,
+                               accept=list(accept),
+                               site=site,
+                               lane=lane,
+                               since=since,
+                               until=until,
+                               seen_key=seen.key,
+                               chunk_size=chunk_size)
+    try:
+        stats = run_partitions(target, partitions, runner, workers)
+        for _, stat in sorted(stats.items()):
+            if stat['Status'] != 'done':
+                failed.append(stat['Partition'])
+                continue
+            value = stat['Result']
+            total += value[TOTAL]
+            jobs += value['Jobs']
+            coalesced += value.get('Coalesced', 0)
+            for mimeType, count in value['MimeTypeCount'].items():
+                mt_count[mimeType] = mt_count[mimeType] + count
+        if system:
+            queuer = _queuer(chunk_size, lane) if bulk else None
+            intids = component.getUtility(IIntIds)
+            total += _reindex_shared(system_user(), accept, intids, seen,
+                                     queuer or queue_add, mt_count,
+                                     since, until)
+            if queuer is not None:
+                queuer.flush()
+                jobs += queuer.jobs
+                coalesced += queuer.coalesced
+    finally:
+        seen.clear()
+
+    elapsed = time.time() - now
+    result = LocatedExternalDict()
+    result[TOTAL] = total
+    result['Elapsed'] = elapsed
+    result['MimeTypeCount'] = dict(mt_count)
+    if bulk:
+        result['Jobs'] = jobs
+        result['Coalesced'] = coalesced
+    if since is not None or until is not None:
+        result['Since'] = since
+        result['Until'] = until
+    if failed:
+        result['FailedPartitions'] = failed
+    logger.info("%s object(s) processed in %s(s)", total, elapsed)
+    return result
+
+
+class RebuildCursor(Persistent):
+    """
+    Persistent progress of a metadata catalog rebuild.
+
+    It keeps the (sorted) snapshot of the doc ids taken when the rebuild
+    started, the last doc id that was processed and, for shadow rebuilds,
+    the catalog being filled, so an interrupted rebuild can pick up where
+    it stopped.
+    """
+
+    last = None
+    count = 0
+    catalog = None
+    partitions = None
+
+    def __init__(self, doc_ids, catalog=None):
+        self.catalog = catalog
+        self.doc_ids = doc_ids
+        self.started = time.time()
+
+    def remaining(self):
+        if self.last is None:
+            return iter(self.doc_ids)
+        return iter(self.doc_ids.keys(self.last, excludemin=True))
+
+    def __len__(self):
+        return len(self.doc_ids)
+
+
+def get_rebuild_cursor(catalog):
+    root = database_root(catalog)
+    return root.get(REBUILD_CURSOR_KEY) if root is not None else None
+
+
+def set_rebuild_cursor(catalog, cursor):
+    root = database_root(catalog)
+    if root is not None:
+        root[REBUILD_CURSOR_KEY] = cursor
+    return cursor
+
+
+def remove_rebuild_cursor(catalog):
+    root = database_root(catalog)
+    if root is not None and REBUILD_CURSOR_KEY in root:
+        del root[REBUILD_CURSOR_KEY]
+
+
+def _index_doc(catalog, doc_id, intids):
+    obj = intids.queryObject(doc_id)
+    if obj is None:
+        logger.debug("%s is missing", doc_id)
+        return False
+    try:
+        catalog.force_index_doc(doc_id, obj)
+    except (POSError, TypeError) as e:
+        logger.error('Error %s while indexing %s, %s',
+                     e, doc_id, type(obj))
+        try:
+            intids.force_unregister(doc_id)
+        except (AttributeError, KeyError):
+            pass
+        return False
+    return True
+
+
+def _checkpoint(catalog, commit=False):
+    """
+    End a rebuild batch. Either commit the work done so far or, when we
+    don't own the transaction (e.g. in a view), write a savepoint so
+    the modified objects can be released. The connection cache is shrunk
+    afterwards.
+    """
+    if commit:
+        transaction.commit()
+    else:
+        transaction.savepoint(optimistic=True)
+    jar = getattr(catalog, '_p_jar', None)
+    if jar is not None:
+        jar.cacheGC()
+
+
+def _clear_catalog(catalog):
     for index in catalog.values():
         index.clear()
     # filters need to be added
     add_catalog_filters(catalog, catalog.family)
-    # reindex
+
+
+def create_shadow_catalog(catalog):
+    """
+    Return a new, empty catalog with the same indexes and filters as the
+    given metadata catalog.
+    """
+    shadow = create_metadata_catalog(family=catalog.family)
+    add_catalog_filters(shadow, shadow.family)
+    return shadow
+
+
+def _catalog_registry(catalog):
+    try:
+        return catalog.__parent__.getSiteManager()
+    except AttributeError:
+        return component.getSiteManager()
+
+
+def _modified_since(catalog, timestamp):
+    if IX_LASTMODIFIED not in catalog:
+        return ()
+    try:
+        return catalog[IX_LASTMODIFIED].apply({
+            'between': (timestamp, time.time() + 1)
+        })
+    except (POSError, TypeError, ValueError) as e:
+        logger.error('Error %s while querying modified objects', e)
+        return ()
+
+
+def _catch_up(catalog, cursor, intids):
+    """
+    Bring the shadow catalog up to date with the changes made to the live
+    catalog since the rebuild started.
+    """
     count = 0
-    seen = set() if seen is None else seen
-    logger.info("Processing %s object(s)", len(doc_ids))
-    for doc_id in doc_ids:
-        obj = intids.queryObject(doc_id)
-        if obj is None:
-            logger.debug("%s is missing", doc_id)
-            continue
-        try:
-            catalog.force_index_doc(doc_id, obj)
-        except (POSError, TypeError) as e:
-            logger.error('Error %s while indexing %s, %s',
-                         e, doc_id, type(obj))
-            try:
-                intids.force_unregister(doc_id)
-            except (AttributeError, KeyError):
-                pass
-        else:
+    family = catalog.family
+    shadow = cursor.catalog
+    live_ids = get_catalog_doc_ids(catalog)
+    for doc_id in family.IF.difference(cursor.doc_ids, live_ids):
+        shadow.unindex_doc(doc_id)
+    changed = family.IF.union(family.IF.difference(live_ids, cursor.doc_ids),
+                              family.IF.Set(_modified_since(catalog, cursor.started)))
+    for doc_id in changed or ():
+        if _index_doc(shadow, doc_id, intids):
             count += 1
-            seen.add(doc_id)
+    logger.info("%s object(s) changed during rebuild", count)
+    return count
+
+
+def swap_catalog(catalog, shadow, intids=None):
+    """
+    Replace the registration(s) of the given catalog with the shadow one.
+    """
+    intids = component.getUtility(IIntIds) if intids is None else intids
+    registry = _catalog_registry(catalog)
+    registrations = [
+        (reg.provided, reg.name) for reg in registry.registeredUtilities()
+        if reg.component is catalog
+    ]
+    if not registrations:
+        registrations = [(IMetadataCatalog, catalog.__name__)]
+    for provided, name in registrations:
+        registry.unregisterUtility(catalog, provided=provided, name=name)
+    locate(shadow, catalog.__parent__, catalog.__name__)
+    for provided, name in registrations:
+        registry.registerUtility(shadow, provided=provided, name=name)
+    # keep intid registrations in sync
+    if intids.queryId(catalog) is not None:
+        for index in catalog.values():
+            if intids.queryId(index) is not None:
+                intids.unregister(index)
+        intids.unregister(catalog)
+        intids.register(shadow)
+        for index in shadow.values():
+            intids.register(index)
+    logger.info("Catalog %s swapped", catalog.__name__)
+    return shadow
+
+
+def _start_rebuild(catalog, shadow=True):
+    # get all ids and clear indexes, unless we fill a shadow catalog
+    doc_ids = catalog.family.IF.TreeSet(iter_catalog_doc_ids(catalog))
+    if shadow:
+        return RebuildCursor(doc_ids, create_shadow_catalog(catalog))
+    _clear_catalog(catalog)
+    return RebuildCursor(doc_ids)
+
+
+def rebuild_metadata_catalog(seen=None, batch_size=None, resume=False,
+                             commit=False, shadow=True, report=None):
+    """
+    Rebuild the metadata catalog.
+
+    By default a fresh shadow catalog is filled while the current one
+    keeps answering queries, and then it replaces the current one.
+
+    :param batch_size: If given, the rebuild is done in batches of this
+        many documents, keeping a persistent cursor in the database.
+    :param resume: Continue an interrupted batched rebuild if its
+        cursor is found.
+    :param commit: Commit the transaction after each batch; otherwise
+        only savepoints are made. Only scripts that own the transaction
+        should set this.
+    :param shadow: If False, the indexes of the current catalog are
+        cleared and refilled in place.
+    :param report: An optional callable that is given the number of
+        indexed objects after each batch.
+    """
+    intids = component.getUtility(IIntIds)
+    catalog = get_metadata_catalog()
+    cursor = get_rebuild_cursor(catalog) if resume else None
+    if cursor is None:
+        cursor = _start_rebuild(catalog, shadow)
+        if batch_size:
+            set_rebuild_cursor(catalog, cursor)
+            _checkpoint(catalog, commit)
+    else:
+        logger.info("Resuming rebuild after doc id %s (%s object(s) indexed)",
+                    cursor.last, cursor.count)
+    target = cursor.catalog if cursor.catalog is not None else catalog
+    # reindex
+    batch = 0
+    logger.info("Processing %s object(s)", len(cursor))
+    for doc_id in cursor.remaining():
+        if _index_doc(target, doc_id, intids):
+            cursor.count += 1
+            if seen is not None:
+                seen.add(doc_id)
+        cursor.last = doc_id
+        batch += 1
+        if batch_size and batch >= batch_size:
+            _checkpoint(catalog, commit)
+            logger.info("%s object(s) indexed so far", cursor.count)
+            if report is not None:
+                report(cursor.count)
+            batch = 0
+    if commit:
+        _checkpoint(catalog, commit)
+    return _finish_rebuild(catalog, cursor, intids)
+
+
+def _finish_rebuild(catalog, cursor, intids):
+    count = cursor.count
+    for progress in (cursor.partitions or {}).values():
+        count += progress.count
+    if cursor.catalog is not None:
+        # catch up and replace the live catalog
+        _catch_up(catalog, cursor, intids)
+        swap_catalog(catalog, cursor.catalog, intids)
+    remove_rebuild_cursor(catalog)
     logger.info("%s object(s) indexed", count)
     return count
+
+
+class RebuildPartition(Persistent):
+    """
+    Progress of a worker over an intid range of a parallel rebuild.
+    """
+
+    last = None
+    count = 0
+
+
+def rebuild_partition(partition, report=None, batch_size=DEFAULT_BATCH_SIZE,
+                      retries=DEFAULT_RETRIES):
+    """
+    Index the doc ids of the rebuild cursor in the given inclusive
+    ``(min, max)`` range, committing every batch.
+
+    This is meant to run in a worker process with its own connection.
+    Workers index disjoint intid ranges, so most concurrent changes to
+    the index BTrees are merged by their conflict resolution; batches
+    that still conflict are retried.
+    """
+    intids = component.getUtility(IIntIds)
+    catalog = get_metadata_catalog()
+    cursor = get_rebuild_cursor(catalog)
+    if cursor is None or not cursor.partitions:
+        raise ValueError("No parallel rebuild in progress")
+    progress = cursor.partitions[partition]
+    target = cursor.catalog if cursor.catalog is not None else catalog
+    low, high = partition
+    if progress.last is not None:
+        doc_ids = cursor.doc_ids.keys(progress.last, high, excludemin=True)
+    else:
+        doc_ids = cursor.doc_ids.keys(low, high)
+
+    def index_batch(batch):
+        count = 0
+        for doc_id in batch:
+            if _index_doc(target, doc_id, intids):
+                count += 1
+        progress.count += count
+        progress.last = batch[-1]
+        return count
+
+    def batch_done(unused_total):
+        catalog._p_jar.cacheGC()
+        if report is not None:
+            report(progress.count)
+
+    commit_in_batches(doc_ids, batch_size, index_batch,
+                      report=batch_done,
+                      retries=retries)
+    return progress.count
+
+
+def parallel_rebuild_metadata_catalog(runner, workers=2, resume=False,
+                                      batch_size=DEFAULT_BATCH_SIZE,
+                                      shadow=True):
+    """
+    Rebuild the metadata catalog with worker processes that each index
+    an intid range of it.
+
+    This commits the current transaction, so only scripts that own it
+    should call it.
+
+    :param runner: A picklable callable that runs a function with its
+        own database connection in the worker process, e.g.
+        :class:`nti.app.metadata.parallel.DataserverRunner`
+    :return: The number of indexed objects and the stats by partition.
+    """
+    intids = component.getUtility(IIntIds)
+    catalog = get_metadata_catalog()
+    cursor = get_rebuild_cursor(catalog) if resume else None
+    if cursor is None:
+        cursor = _start_rebuild(catalog, shadow)
+        set_rebuild_cursor(catalog, cursor)
+    if not cursor.partitions:
+        cursor.partitions = OOBTree()
+        for partition in partition_ids(cursor.doc_ids, workers):
+            cursor.partitions[partition] = RebuildPartition()
+    partitions = list(cursor.partitions.keys())
+    transaction.commit()
+    logger.info("Processing %s object(s) in %s partition(s)",
+                len(cursor), len(partitions))
+    target = functools.partial(rebuild_partition,
+                               batch_size=batch_size)
+    stats = run_partitions(target, partitions, runner, workers)
+    # see the changes made by the workers
+    transaction.begin()
+    failed = [x for x in stats.values() if x['Status'] != 'done']
+    if failed:
+        logger.error("%s partition(s) failed. Rebuild can be resumed",
+                     len(failed))
+        return None, stats
+    return _finish_rebuild(catalog, cursor, intids), stats
@@ -0,0 +1,387 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Replay of the jobs kept in the metadata queues.
+
+.. $Id$
+"""
+
+from __future__ import division
+from __future__ import print_function
+from __future__ import absolute_import
+
+import time
+import functools
+
+import six
+
+from zope import component
+
+from zope.intid.interfaces import IIntIds
+
+from nti.app.metadata.consumer import RateLimiter
+
+from nti.app.metadata.consumer import execute_job
+
+from nti.app.metadata.parallel import DEFAULT_RETRIES
+
+from nti.app.metadata.parallel import partition_ids
+from nti.app.metadata.parallel import run_partitions
+from nti.app.metadata.parallel import commit_in_batches
+
+from nti.app.metadata.processing import ALL_QUEUE_NAMES
+
+from nti.app.metadata.processing import job_doc_ids
+
+from nti.app.metadata.queues import hash_key
+from nti.app.metadata.queues import unpickle
+from nti.app.metadata.queues import get_redis
+from nti.app.metadata.queues import pickle_job
+from nti.app.metadata.queues import failed_name
+
+from nti.app.metadata.utils import get_mime_type
+
+#: Default number of jobs read per ``LRANGE`` window of a replay
+DEFAULT_WINDOW_SIZE = 500
+
+#: Default number of failed jobs sampled per queue
+DEFAULT_SAMPLE_SIZE = 100
+
+#: Number of windows a sample of failed jobs is spread over
+SAMPLE_WINDOWS = 10
+
+#: Number of distinct messages kept per error bucket
+BUCKET_MESSAGES = 3
+
+#: Default number of failed jobs replayed per transaction
+DEFAULT_REPLAY_BATCH_SIZE = 50
+
+#: The counters of a failed-job replay
+REPLAY_COUNTERS = ('Jobs', 'Replayed', 'Failed')
+
+logger = __import__('logging').getLogger(__name__)
+
+
+def checkpoint_key(name):
+    return name + '/checkpoint'
+
+
+def iter_job_windows(redis, name, start=0, size=DEFAULT_WINDOW_SIZE):
+    """
+    Yield ``(offset, data)`` windows of up to ``size`` pickled jobs of
+    the named queue, starting at the given offset.
+    """
+    while True:
+        data = redis.lrange(name, start, start + size - 1)
+        if not data:
+            break
+        yield start, data
+        start += len(data)
+
+
+def _read_job(data):
+    try:
+        return unpickle(data)
+    except Exception:  # pylint: disable=broad-except
+        logger.exception("Cannot read job")
+        return None
+
+
+def run_job(data):
+    """
+    Run the given pickled job with
+    :func:`nti.app.metadata.consumer.execute_job`.
+    """
+    job = _read_job(data)
+    return job is not None and execute_job(job)
+
+
+def replay_queue(redis, name, size=DEFAULT_WINDOW_SIZE, report=None,
+                 retries=DEFAULT_RETRIES):
+    """
+    Run the jobs of the named queue reading them in ``LRANGE`` windows
+    of ``size``, so only a window is in memory, and commit after each
+    one. The offset of the next window is saved in a checkpoint, so a
+    restarted replay does not run again the jobs already committed.
+
+    The jobs are not removed from the queue; the caller is expected to
+    reset it, and delete the checkpoint, once the replay is done.
+
+    :param report: An optional callable that is given the stats after
+        each window.
+    :return: The number of jobs executed, failed and skipped because of
+        a previous replay, plus the throughput.
+    """
+    started = time.time()
+    checkpoint = checkpoint_key(name)
+    offset = int(redis.get(checkpoint) or 0)
+    stats = {
+        'Total': redis.llen(name),
+        'Jobs': 0,
+        'Failed': 0,
+        'Resumed': offset,
+    }
+    if offset:
+        logger.info("Resuming replay of %s at job %s", name, offset)
+
+    def run(batch):
+        return sum(1 for x in batch if run_job(x))
+
+    for start, data in iter_job_windows(redis, name, offset, size):
+        executed = commit_in_batches(data, len(data), run, retries=retries)
+        redis.set(checkpoint, start + len(data))
+        stats['Jobs'] += executed
+        stats['Failed'] += len(data) - executed
+        elapsed = time.time() - started
+        stats['Elapsed'] = elapsed
+        stats['JobsPerSecond'] = (start + len(data) - offset) / elapsed \
+                                 if elapsed else 0
+        logger.info("%s: %s of %s job(s) replayed (%.1f job(s)/s)",
+                    name, start + len(data), stats['Total'],
+                    stats['JobsPerSecond'])
+        if report is not None:
+            report(stats)
+    stats.setdefault('Elapsed', time.time() - started)
+    stats.setdefault('JobsPerSecond', 0)
+    return stats
+
+
+# failed jobs
+
+
+def replay_name(name):
+    return failed_name(name) + '/replay'
+
+
+def job_id(job):
+    return getattr(job, 'id', None) or getattr(job, 'jobid', None)
+
+
+def job_error(job):
+    """
+    Return the exception type and the message of the error of the given
+    failed job.
+    """
+    error = getattr(job, 'error', None)
+    if error is None:
+        return u'Unknown', None
+    if isinstance(error, BaseException):
+        return error.__class__.__name__, six.text_type(error)
+    message = getattr(error, 'message', None) or six.text_type(error)
+    kind = getattr(error, 'type', None) or getattr(error, 'code', None)
+    if not kind:
+        # messages look like 'ValueError: ...'
+        head = message.split(':', 1)[0].strip()
+        kind = head if head and ' ' not in head else u'Unknown'
+    return kind, message
+
+
+def sample_failed_jobs(redis, name, size=DEFAULT_SAMPLE_SIZE):
+    """
+    Return up to ``size`` pickled jobs of the failed queue of the named
+    queue, read in windows spread over all of it.
+    """
+    size = max(1, size)
+    failed = failed_name(name)
+    depth = redis.llen(failed)
+    if depth <= size:
+        return redis.lrange(failed, 0, size - 1)
+    result = []
+    windows = min(size, SAMPLE_WINDOWS)
+    window = size // windows
+    for idx in range(windows):
+        start = idx * depth // windows
+        result.extend(redis.lrange(failed, start, start + window - 1))
+    return result
+
+
+def bucket_failed_jobs(names=ALL_QUEUE_NAMES, size=DEFAULT_SAMPLE_SIZE,
+                       redis=None, intids=None):
+    """
+    Sample the failed jobs of the named queues and group them by the
+    type of their exception and by the mime type of the objects they
+    index.
+    """
+    redis = get_redis() if redis is None else redis
+    intids = component.queryUtility(IIntIds) if intids is None else intids
+    queues = {}
+    errors = {}
+    mime_types = {}
+    sampled = 0
+    for name in names:
+        data = sample_failed_jobs(redis, name, size)
+        queues[name] = {
+            'FailedDepth': redis.llen(failed_name(name)),
+            'Sampled': len(data),
+        }
+        for job in (_read_job(x) for x in data):
+            sampled += 1
+            if job is None:
+                kind, message, doc_ids = u'Unreadable', None, ()
+            else:
+                kind, message = job_error(job)
+                doc_ids = job_doc_ids(job)
+            bucket = errors.setdefault(kind, {
+                'Jobs': 0, 'MimeTypes': {}, 'Messages': []
+            })
+            bucket['Jobs'] += 1
+            messages = bucket['Messages']
+            if message and len(messages) < BUCKET_MESSAGES:
+                if message not in messages:
+                    messages.append(message)
+            for doc_id in doc_ids:
+                obj = intids.queryObject(doc_id) if intids is not None else None
+                mime_type = get_mime_type(obj) if obj is not None else u'missing'
+                bucket['MimeTypes'][mime_type] = \
+                    bucket['MimeTypes'].get(mime_type, 0) + 1
+                mime_types[mime_type] = mime_types.get(mime_type, 0) + 1
+    return {
+        'Queues': queues,
+        'Sampled': sampled,
+        'Errors': errors,
+        'MimeTypes': mime_types,
+    }
+
+
+def _take_failed(redis, name):
+    """
+    Set the failed jobs of the named queue aside to be replayed and
+    return their number. New failures keep going to the failed queue.
+    """
+    failed, replay = failed_name(name), replay_name(name)
+    if redis.exists(replay):
+        logger.warning("Resuming an interrupted replay of %s", failed)
+    elif redis.exists(failed):
+        redis.renamenx(failed, replay)
+    return redis.llen(replay)
+
+
+def replay_partition(partition, report=None, rate=None,
+                     batch_size=DEFAULT_REPLAY_BATCH_SIZE, redis=None,
+                     retries=DEFAULT_RETRIES):
+    """
+    Replay the failed jobs set aside for the queue in the given
+    inclusive ``(name, start, end)`` offset range, committing every
+    ``batch_size`` jobs and running at most ``rate`` jobs per second.
+    Jobs that fail again go back to the failed queue, with the error of
+    the replay.
+
+    This is meant to run in a worker process with its own connection.
+    """
+    name, start, end = partition
+    redis = get_redis() if redis is None else redis
+    limiter = RateLimiter(rate) if rate else None
+    failed = failed_name(name)
+    stats = dict.fromkeys(REPLAY_COUNTERS, 0)
+    outcome = []
+
+    def run(batch):
+        del outcome[:]
+        for data in batch:
+            if limiter is not None:
+                time.sleep(limiter.delay())
+                limiter.consume()
+            job = _read_job(data)
+            outcome.append((data, job,
+                            job is not None and execute_job(job)))
+        return sum(1 for x in outcome if x[2])
+
+    for offset, data in iter_job_windows(redis, replay_name(name),
+                                         start, batch_size):
+        if offset > end:
+            break
+        data = data[:end - offset + 1]
+        commit_in_batches(data, len(data), run, retries=retries)
+        pipe = redis.pipeline()
+        for raw, job, executed in outcome:
+            if not executed:
+                pipe.rpush(failed, raw if job is None else pickle_job(job))
+            elif job_id(job):
+                pipe.hdel(hash_key(failed), job_id(job))
+        pipe.execute()
+        stats['Jobs'] += len(outcome)
+        stats['Replayed'] += sum(1 for x in outcome if x[2])
+        stats['Failed'] = stats['Jobs'] - stats['Replayed']
+        if report is not None:
+            report(stats['Jobs'])
+    return stats
+
+
+def _summary(stats, started):
+    elapsed = time.time() - started
+    stats['Elapsed'] = elapsed
+    stats['JobsPerSecond'] = stats['Jobs'] / elapsed if elapsed else 0
+    return stats
+
+
+def replay_failed_jobs(names=ALL_QUEUE_NAMES, rate=None,
+                       batch_size=DEFAULT_REPLAY_BATCH_SIZE, redis=None,
+                       report=None):
+    """
+    Replay the failed jobs of the named queues with
+    :func:`replay_partition`.
+    """
+    started = time.time()
+    redis = get_redis() if redis is None else redis
+    result = dict.fromkeys(REPLAY_COUNTERS, 0)
+    queues = result['Queues'] = {}
+    for name in names:
+        total = _take_failed(redis, name)
+        if not total:
+            continue
+        stats = queues[name] = replay_partition((name, 0, total - 1),
+                                                rate=rate,
+                                                batch_size=batch_size,
+                                                redis=redis)
+        redis.delete(replay_name(name))
+        for counter in REPLAY_COUNTERS:
+            result[counter] += stats[counter]
+        if report is not None:
+            report(result['Jobs'])
+    return _summary(result, started)
+
+
+def parallel_replay_failed_jobs(runner, workers=2, names=ALL_QUEUE_NAMES,
+                                rate=None, batch_size=DEFAULT_REPLAY_BATCH_SIZE,
+                                redis=None):
+    """
+    Replay the failed jobs of the named queues with worker processes
+    that each replay an offset range of them, sharing the ``rate``.
+
+    The jobs of a queue with a failed partition are kept aside and
+    replayed again by the next replay.
+
+    :param runner: A picklable callable that runs a function with its
+        own database connection in the worker process, e.g.
+        :class:`nti.app.metadata.parallel.DataserverRunner`
+    """
+    started = time.time()
+    redis = get_redis() if redis is None else redis
+    partitions = []
+    for name in names:
+        total = _take_failed(redis, name)
+        partitions.extend((name, low, high)
+                          for low, high in partition_ids(range(total), workers))
+    workers = max(1, min(workers, len(partitions)))
+    target = functools.partial(replay_partition,
+                               rate=rate / workers if rate else None,
+                               batch_size=batch_size)
+    stats = run_partitions(target, partitions, runner, workers)
+    failed = []
+    result = dict.fromkeys(REPLAY_COUNTERS, 0)
+    queues = result['Queues'] = {}
+    for _, stat in sorted(stats.items()):
+        name = stat['Partition'][0]
+        queue = queues.setdefault(name, dict.fromkeys(REPLAY_COUNTERS, 0))
+        if stat['Status'] != 'done':
+            failed.append(stat['Partition'])
+            continue
+        for counter in REPLAY_COUNTERS:
+            queue[counter] += stat['Result'][counter]
+            result[counter] += stat['Result'][counter]
+    for name in queues:
+        if not any(x[0] == name for x in failed):
+            redis.delete(replay_name(name))
+    if failed:
+        result['FailedPartitions'] = failed
+    return _summary(result, started)
@@ -9,12 +9,22 @@ from __future__ import print_function
 from __future__ import absolute_import
 
 import os
+import sys
 import pprint
 import argparse
 
 from zope.catalog.interfaces import ICatalogEdit
 
+from nti.app.metadata.parallel import DataserverRunner
+
 from nti.app.metadata.utils import check_indices
+from nti.app.metadata.utils import DEFAULT_SAMPLE_SIZE
+from nti.app.metadata.utils import DEFAULT_MAX_SWEEP_AGE
+
+from nti.app.metadata.utils import write_index_problems
+from nti.app.metadata.utils import parallel_check_indices
+from nti.app.metadata.utils import parallel_check_structures
+from nti.app.metadata.utils import incremental_check_indices
 
 from nti.dataserver.utils import run_with_dataserver
 
@@ -22,19 +32,53 @@ from nti.dataserver.utils.base_script import create_context
 
 from nti.zope_catalog.interfaces import IDeferredCatalog
 
+CONF_PACKAGES = ('nti.appserver', 'nti.app.metadata')
+
 logger = __import__('logging').getLogger(__name__)
 
 
-def _process_args(args):
+def _process_args(args, env_dir):
     if args.all:
         catalog_interface = ICatalogEdit
     else:
         catalog_interface = IDeferredCatalog
 
-    result = check_indices(catalog_interface=catalog_interface,
-                           test_broken=args.broken,
-                           inspect_btrees=args.btrees,
-                           inspect_treesets=args.treesets)
+    if args.dry_run or args.output:
+        output = args.output or '-'
+        kwargs = {
+            'dry_run': args.dry_run,
+            'test_broken': args.broken,
+            'catalog_interface': catalog_interface,
+        }
+        if output == '-':
+            return write_index_problems(sys.stdout, **kwargs)
+        with open(output, 'w') as fp:
+            return write_index_problems(fp, **kwargs)
+    if args.incremental:
+        result = incremental_check_indices(catalog_interface=catalog_interface,
+                                           test_broken=args.broken,
+                                           sample_size=args.sample_size,
+                                           max_sweep_age=args.max_sweep_age,
+                                           full=args.full)
+    elif args.workers and args.workers > 1:
+        runner = DataserverRunner(env_dir,
+                                  xmlconfig_packages=CONF_PACKAGES,
+                                  with_library=True)
+        result = parallel_check_indices(runner,
+                                        workers=args.workers,
+                                        test_broken=args.broken,
+                                        catalog_interface=catalog_interface)
+        if args.btrees or args.treesets:
+            structures = parallel_check_structures(runner,
+                                                   workers=args.workers,
+                                                   inspect_treesets=args.treesets,
+                                                   catalog_interface=catalog_interface)
+            result['Structures'] = structures
+    else:
+        result = check_indices(catalog_interface=catalog_interface,
+                               test_broken=args.broken,
+                               inspect_btrees=args.btrees or args.treesets,
+                               inspect_treesets=args.treesets)
     if args.verbose:
         pprint.pprint(result)
     return result
@@ -57,21 +101,55 @@ def main():
     arg_parser.add_argument('-b', '--broken', help="Test for broken objects",
                             action='store_true',
                             dest='broken')
+    arg_parser.add_argument('-w', '--workers',
+                            help="Number of worker processes, each checking an intid range",
+                            type=int,
+                            dest='workers')
+
+    arg_parser.add_argument('-i', '--incremental',
+                            help="Only check new doc ids and a sample of the others",
+                            action='store_true',
+                            dest='incremental')
+    arg_parser.add_argument('-f', '--full',
+                            help="Check all doc ids in incremental mode",
+                            action='store_true',
+                            dest='full')
+    arg_parser.add_argument('-s', '--sample-size',
+                            help="Number of verified doc ids rechecked per catalog",
+                            type=int,
+                            default=DEFAULT_SAMPLE_SIZE,
+                            dest='sample_size')
+    arg_parser.add_argument('--max-sweep-age',
+                            help="Seconds after which all doc ids are checked again in incremental mode",
+                            type=float,
+                            default=DEFAULT_MAX_SWEEP_AGE,
+                            dest='max_sweep_age')
+
+    arg_parser.add_argument('-d', '--dry-run',
+                            help="Only report the problems, without unindexing",
+                            action='store_true',
+                            dest='dry_run')
+    arg_parser.add_argument('-o', '--output',
+                            help="File to stream the problems to as JSON lines ('-' for stdout)",
+                            dest='output')
 
     args = arg_parser.parse_args()
+    if args.incremental and ((args.workers or 0) > 1 or args.btrees or args.treesets):
+        arg_parser.error("Incremental checks cannot use workers or check BTrees")
+    if (args.dry_run or args.output) and (args.incremental or (args.workers or 0) > 1):
+        arg_parser.error("Streamed reports cannot be incremental or use workers")
     env_dir = os.getenv('DATASERVER_DIR')
     if not env_dir or not os.path.exists(env_dir) and not os.path.isdir(env_dir):
         raise IOError("Invalid dataserver environment root directory")
 
     context = create_context(env_dir, True)
-    conf_packages = ('nti.appserver', 'nti.app.metadata')
 
     run_with_dataserver(environment_dir=env_dir,
-                        xmlconfig_packages=conf_packages,
+                        xmlconfig_packages=CONF_PACKAGES,
                         verbose=args.verbose,
                         context=context,
                         minimal_ds=True,
-                        function=lambda: _process_args(args))
+                        function=lambda: _process_args(args, env_dir))
 
 
 if __name__ == '__main__':
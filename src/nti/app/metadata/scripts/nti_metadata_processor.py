@@ -8,6 +8,11 @@ from __future__ import division
 from __future__ import print_function
 from __future__ import absolute_import
 
+import os
+import multiprocessing
+
+import transaction
+
 from zope import interface
 
 from zope.location.interfaces import ILocation
@@ -16,6 +21,21 @@ from z3c.autoinclude.zcml import includePluginsDirective
 
 from nti.app.asynchronous.processor import Processor
 
+from nti.app.metadata.consumer import BatchProcessor
+from nti.app.metadata.consumer import WorkerSupervisor
+from nti.app.metadata.consumer import DEFAULT_MAX_LATENCY
+
+from nti.app.metadata.consumer import partition_queues
+
+from nti.app.metadata.metrics import ProcessorMetrics
+
+from nti.app.metadata.parallel import DataserverRunner
+
+from nti.app.metadata.processing import ALL_QUEUE_NAMES
+from nti.app.metadata.processing import BULK_QUEUE_NAMES
+
+from nti.dataserver.utils import run_with_dataserver
+
 from nti.dataserver.utils.base_script import create_context
 
 from nti.metadata import QUEUE_NAMES
@@ -32,8 +52,87 @@ class PluginPoint(object):
 PP_METADATA = PluginPoint('nti.metadata')
 
 
+def _create_context(env_dir, slugs=None):
+    context = create_context(env_dir,
+                             slugs=slugs,
+                             plugins=slugs,
+                             with_library=True)
+    includePluginsDirective(context, PP_METADATA)
+    return context
+
+
+def _get_env_dir():
+    env_dir = os.getenv('DATASERVER_DIR')
+    if not env_dir or not os.path.exists(env_dir) and not os.path.isdir(env_dir):
+        raise IOError("Invalid dataserver environment root directory")
+    return env_dir
+
+
+class ProcessorRunner(DataserverRunner):
+    """
+    Runs a function in a new dataserver configured like the processor,
+    publishing the metrics of its process. Each worker process writes
+    its own metrics file, named after the process.
+    """
+
+    metrics = None
+
+    def __init__(self, env_dir, slugs=None, queue_names=ALL_QUEUE_NAMES,
+                 metrics_interval=10, metrics_path=None):
+        super(ProcessorRunner, self).__init__(env_dir, with_library=True)
+        self.slugs = slugs
+        self.queue_names = queue_names
+        self.metrics_path = metrics_path
+        self.metrics_interval = metrics_interval
+
+    def _metrics_path(self):
+        if not self.metrics_path:
+            return None
+        root, ext = os.path.splitext(self.metrics_path)
+        return '%s-%s%s' % (root, multiprocessing.current_process().name, ext)
+
+    def __call__(self, function):
+        self.metrics = ProcessorMetrics(queue_names=self.queue_names,
+                                        interval=self.metrics_interval,
+                                        path=self._metrics_path())
+        transaction.manager.registerSynch(self.metrics)
+        if isinstance(function, BatchProcessor):
+            function.metrics = self.metrics
+        return run_with_dataserver(environment_dir=self.env_dir,
+                                   xmlconfig_packages=self.xmlconfig_packages,
+                                   context=_create_context(self.env_dir, self.slugs),
+                                   minimal_ds=True,
+                                   function=function)
+
+
 class Constructor(Processor):
 
+    metrics = None
+
+    def create_arg_parser(self):
+        arg_parser = super(Constructor, self).create_arg_parser()
+        arg_parser.add_argument('--metrics-file',
+                                help="Prometheus metrics file, one per worker with --workers",
+                                dest='metrics_file')
+        arg_parser.add_argument('--metrics-interval', help="Metrics interval (secs)",
+                                dest='metrics_interval', type=int, default=10)
+        arg_parser.add_argument('--batch-size', help="Jobs per transaction",
+                                dest='batch_size', type=int, default=1)
+        arg_parser.add_argument('--max-latency', help="Max secs to wait for a batch",
+                                dest='max_latency', type=float,
+                                default=DEFAULT_MAX_LATENCY)
+        arg_parser.add_argument('--workers', help="Number of worker processes",
+                                dest='workers', type=int, default=1)
+        arg_parser.add_argument('--bulk-rate', help="Max bulk lane jobs per sec",
+                                dest='bulk_rate', type=float, default=None)
+        return arg_parser
+
+    def setup_metrics(self, args):
+        self.metrics = ProcessorMetrics(queue_names=ALL_QUEUE_NAMES,
+                                        interval=getattr(args, 'metrics_interval', 10),
+                                        path=getattr(args, 'metrics_file', None))
+        transaction.manager.registerSynch(self.metrics)
+
     def extend_context(self, context):
         includePluginsDirective(context, PP_METADATA)
 
@@ -52,7 +151,57 @@ class Constructor(Processor):
         setattr(args, 'trx_retries', 9)
         setattr(args, 'max_sleep_time', 30)
         setattr(args, 'queue_names', QUEUE_NAMES)
-        super(Constructor, self).process_args(args)
+        setattr(args, 'bulk_queue_names', BULK_QUEUE_NAMES)
+        if getattr(args, 'workers', 1) > 1:
+            return self.process_workers(args)
+        self.setup_metrics(args)
+        # only the batched processor drains the lanes in order and
+        # rate limits the bulk one
+        if getattr(args, 'batch_size', 1) > 1 or getattr(args, 'bulk_rate', None):
+            self.process_batches(args)
+        else:
+            # the bulk lane queues go last, without rate limits
+            setattr(args, 'queue_names', ALL_QUEUE_NAMES)
+            super(Constructor, self).process_args(args)
+
+    def batch_options(self, args):
+        return {
+            'batch_size': args.batch_size,
+            'max_latency': args.max_latency,
+            'max_sleep_time': args.max_sleep_time,
+            'retries': args.trx_retries,
+            'bulk_rate': getattr(args, 'bulk_rate', None),
+        }
+
+    def process_workers(self, args):
+        runner = ProcessorRunner(_get_env_dir(),
+                                 slugs=args.slugs,
+                                 metrics_interval=getattr(args, 'metrics_interval', 10),
+                                 metrics_path=getattr(args, 'metrics_file', None))
+        options = self.batch_options(args)
+        partitions = partition_queues(args.queue_names, args.workers)
+        if options['bulk_rate']:
+            # the rate limit is for the whole deployment
+            options['bulk_rate'] /= len(partitions)
+        supervisor = WorkerSupervisor(runner, partitions,
+                                      partition_queues(args.bulk_queue_names,
+                                                       len(partitions)),
+                                      **options)
+        return supervisor()
+
+    def process_batches(self, args):
+        env_dir = _get_env_dir()
+        processor = BatchProcessor(queue_names=args.queue_names,
+                                   bulk_queue_names=args.bulk_queue_names,
+                                   **self.batch_options(args))
+        processor.metrics = self.metrics
+        context = self.create_context(env_dir, args)
+        run_with_dataserver(environment_dir=env_dir,
+                            xmlconfig_packages=('nti.appserver',),
+                            context=context,
+                            minimal_ds=True,
+                            verbose=getattr(args, 'verbose', False),
+                            function=processor)
 
 
 def main():
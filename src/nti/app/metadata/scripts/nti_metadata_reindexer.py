@@ -14,7 +14,16 @@ import argparse
 
 from zope import component
 
+from nti.app.metadata.parallel import DataserverRunner
+
+from nti.app.metadata.processing import LANES
+from nti.app.metadata.processing import BULK_LANE
+from nti.app.metadata.processing import DEFAULT_CHUNK_SIZE
+
 from nti.app.metadata.reindexer import reindex
+from nti.app.metadata.reindexer import parallel_reindex
+
+from nti.app.metadata.utils import resolve_timestamp
 
 from nti.dataserver.utils import run_with_dataserver
 from nti.dataserver.utils.base_script import set_site
@@ -33,12 +42,34 @@ def _load_library():
         pass
 
 
-def _process_args(args):
+def _process_args(args, env_dir):
     _load_library()
     set_site(args.site)
-    result = reindex(system=args.system,
-                     accept=args.types or (),
-                     usernames=args.usernames or ())
+    chunk_size = args.chunk_size or DEFAULT_CHUNK_SIZE
+    since = resolve_timestamp(args.since)
+    until = resolve_timestamp(args.until)
+    if args.workers and args.workers > 1:
+        runner = DataserverRunner(env_dir, with_library=True)
+        result = parallel_reindex(runner,
+                                  site=args.site,
+                                  system=args.system,
+                                  workers=args.workers,
+                                  bulk=not args.single,
+                                  chunk_size=chunk_size,
+                                  lane=args.lane,
+                                  since=since,
+                                  until=until,
+                                  accept=args.types or (),
+                                  usernames=args.usernames or ())
+    else:
+        result = reindex(system=args.system,
+                         bulk=not args.single,
+                         chunk_size=chunk_size,
+                         lane=args.lane,
+                         since=since,
+                         until=until,
+                         accept=args.types or (),
+                         usernames=args.usernames or ())
     if args.verbose:
         pprint.pprint(result)
     return result
@@ -57,6 +88,31 @@ def main():
     arg_parser.add_argument('-m', '--system', help="Include system user",
                             action='store_true',
                             dest='system')
+    arg_parser.add_argument('-c', '--chunk-size',
+                            help="Number of objects per indexing job",
+                            type=int,
+                            dest='chunk_size')
+    arg_parser.add_argument('--single', help="Queue one job per object",
+                            action='store_true',
+                            dest='single')
+    arg_parser.add_argument('-l', '--lane', help="The queue lane of the jobs",
+                            choices=LANES,
+                            default=BULK_LANE,
+                            dest='lane')
+    arg_parser.add_argument('--since',
+                            help="Only objects created or modified since this timestamp "
+                                 "(negative for seconds ago)",
+                            type=float,
+                            dest='since')
+    arg_parser.add_argument('--until',
+                            help="Only objects created or modified until this timestamp "
+                                 "(negative for seconds ago)",
+                            type=float,
+                            dest='until')
+    arg_parser.add_argument('-w', '--workers',
+                            help="Number of worker processes to spread the users over",
+                            type=int,
+                            dest='workers')
     site_group = arg_parser.add_mutually_exclusive_group()
     site_group.add_argument('-u', '--usernames',
                             dest='usernames',
@@ -76,7 +132,7 @@ def main():
                         verbose=args.verbose,
                         context=context,
                         minimal_ds=True,
-                        function=lambda: _process_args(args))
+                        function=lambda: _process_args(args, env_dir))
 
 
 if __name__ == '__main__':
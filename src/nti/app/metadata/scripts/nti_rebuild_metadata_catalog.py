@@ -15,7 +15,11 @@ import argparse
 
 from zope import component
 
+from nti.app.metadata.parallel import DataserverRunner
+
+from nti.app.metadata.reindexer import DEFAULT_BATCH_SIZE
 from nti.app.metadata.reindexer import rebuild_metadata_catalog
+from nti.app.metadata.reindexer import parallel_rebuild_metadata_catalog
 
 from nti.dataserver.utils import run_with_dataserver
 
@@ -40,21 +44,56 @@ def _sync_library():
         pass
 
 
-def _process_args(args):
+def _process_args(args, env_dir):
     _sync_library()
-    count = rebuild_metadata_catalog()
+    result = {}
+    if args.workers and args.workers > 1:
+        runner = DataserverRunner(env_dir, with_library=True)
+        batch_size = args.batch_size or DEFAULT_BATCH_SIZE
+        count, stats = parallel_rebuild_metadata_catalog(runner,
+                                                         workers=args.workers,
+                                                         resume=args.resume,
+                                                         batch_size=batch_size,
+                                                         shadow=not args.in_place)
+        result[ITEMS] = stats
+        failed = [x['Partition'] for _, x in sorted(stats.items())
+                  if x['Status'] != 'done']
+        if failed:
+            print("Partition(s) %s failed. Rebuild can be resumed with --resume"
+                  % ', '.join('%s-%s' % x for x in failed),
+                  file=sys.stderr)
+            return 1
+    else:
+        count = rebuild_metadata_catalog(batch_size=args.batch_size,
+                                         resume=args.resume,
+                                         shadow=not args.in_place,
+                                         commit=True)
     if args.verbose:
-        result = {
-            TOTAL: count,
-            ITEM_COUNT: count
-        }
+        result[TOTAL] = result[ITEM_COUNT] = count
         pprint.pprint(result)
+    return 0
 
 
 def main():
     arg_parser = argparse.ArgumentParser(description="Rebuild metadata catalog")
     arg_parser.add_argument('-v', '--verbose', help="Be Verbose", action='store_true',
                             dest='verbose')
+    arg_parser.add_argument('-b', '--batch-size',
+                            help="Commit after this many documents",
+                            type=int,
+                            dest='batch_size')
+    arg_parser.add_argument('-r', '--resume',
+                            help="Resume an interrupted batched rebuild",
+                            action='store_true',
+                            dest='resume')
+    arg_parser.add_argument('-i', '--in-place',
+                            help="Clear and reindex the current catalog",
+                            action='store_true',
+                            dest='in_place')
+    arg_parser.add_argument('-w', '--workers',
+                            help="Number of worker processes, each indexing an intid range",
+                            type=int,
+                            dest='workers')
 
     args = arg_parser.parse_args()
     env_dir = os.getenv('DATASERVER_DIR')
@@ -64,13 +103,13 @@ def main():
     conf_packages = ('nti.appserver',)
     context = create_context(env_dir, with_library=True)
 
-    run_with_dataserver(environment_dir=env_dir,
-                        verbose=args.verbose,
-                        xmlconfig_packages=conf_packages,
-                        context=context,
-                        minimal_ds=True,
-                        function=lambda: _process_args(args))
-    sys.exit(0)
+    status = run_with_dataserver(environment_dir=env_dir,
+                                 verbose=args.verbose,
+                                 xmlconfig_packages=conf_packages,
+                                 context=context,
+                                 minimal_ds=True,
+                                 function=lambda: _process_args(args, env_dir))
+    sys.exit(status)
 
 
 if __name__ == '__main__':
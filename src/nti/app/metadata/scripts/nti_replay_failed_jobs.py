@@ -0,0 +1,107 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+.. $Id$
+"""
+
+from __future__ import division
+from __future__ import print_function
+from __future__ import absolute_import
+
+import os
+import pprint
+import argparse
+
+from nti.app.metadata.parallel import DataserverRunner
+
+from nti.app.metadata.processing import ALL_QUEUE_NAMES
+
+from nti.app.metadata.replay import DEFAULT_SAMPLE_SIZE
+from nti.app.metadata.replay import DEFAULT_REPLAY_BATCH_SIZE
+
+from nti.app.metadata.replay import bucket_failed_jobs
+from nti.app.metadata.replay import replay_failed_jobs
+from nti.app.metadata.replay import parallel_replay_failed_jobs
+
+from nti.dataserver.utils import run_with_dataserver
+
+from nti.dataserver.utils.base_script import create_context
+
+CONF_PACKAGES = ('nti.appserver', 'nti.app.metadata')
+
+logger = __import__('logging').getLogger(__name__)
+
+
+def _process_args(args, env_dir):
+    names = args.queues or ALL_QUEUE_NAMES
+    if args.sample:
+        result = bucket_failed_jobs(names, args.sample_size)
+    elif args.workers and args.workers > 1:
+        runner = DataserverRunner(env_dir,
+                                  xmlconfig_packages=CONF_PACKAGES,
+                                  with_library=True)
+        result = parallel_replay_failed_jobs(runner,
+                                             names=names,
+                                             rate=args.rate,
+                                             workers=args.workers,
+                                             batch_size=args.batch_size)
+    else:
+        result = replay_failed_jobs(names,
+                                    rate=args.rate,
+                                    batch_size=args.batch_size)
+    if args.verbose or args.sample:
+        pprint.pprint(result)
+    return result
+
+
+def main():
+    arg_parser = argparse.ArgumentParser(description="Metadata failed job replayer")
+    arg_parser.add_argument('-v', '--verbose', help="Be verbose",
+                            action='store_true',
+                            dest='verbose')
+    arg_parser.add_argument('-q', '--queues',
+                            dest='queues',
+                            nargs="+",
+                            choices=ALL_QUEUE_NAMES,
+                            help="The queues whose failed jobs are used")
+    arg_parser.add_argument('-s', '--sample',
+                            help="Only group a sample of the failed jobs "
+                                 "by exception and mime type",
+                            action='store_true',
+                            dest='sample')
+    arg_parser.add_argument('--sample-size',
+                            help="Number of failed jobs sampled per queue",
+                            type=int,
+                            default=DEFAULT_SAMPLE_SIZE,
+                            dest='sample_size')
+    arg_parser.add_argument('-r', '--rate',
+                            help="Maximum number of jobs replayed per second",
+                            type=float,
+                            dest='rate')
+    arg_parser.add_argument('-b', '--batch-size',
+                            help="Number of jobs replayed per transaction",
+                            type=int,
+                            default=DEFAULT_REPLAY_BATCH_SIZE,
+                            dest='batch_size')
+    arg_parser.add_argument('-w', '--workers',
+                            help="Number of worker processes, each replaying a range of the jobs",
+                            type=int,
+                            dest='workers')
+
+    args = arg_parser.parse_args()
+    env_dir = os.getenv('DATASERVER_DIR')
+    if not env_dir or not os.path.exists(env_dir) and not os.path.isdir(env_dir):
+        raise IOError("Invalid dataserver environment root directory")
+
+    context = create_context(env_dir, True)
+
+    run_with_dataserver(environment_dir=env_dir,
+                        xmlconfig_packages=CONF_PACKAGES,
+                        verbose=args.verbose,
+                        context=context,
+                        minimal_ds=True,
+                        function=lambda: _process_args(args, env_dir))
+
+
+if __name__ == '__main__':
+    main()
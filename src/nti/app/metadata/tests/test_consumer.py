@@ -0,0 +1,281 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+from __future__ import division
+from __future__ import print_function
+from __future__ import absolute_import
+
+# disable: accessing protected members, too many methods
+# pylint: disable=W0212,R0904
+
+from hamcrest import is_
+from hamcrest import assert_that
+from hamcrest import has_entries
+
+import os
+import signal
+import unittest
+
+import fakeredis
+
+from six.moves import queue as Queue
+
+import transaction
+
+from ZODB.POSException import ConflictError
+
+from nti.app.metadata.consumer import RateLimiter
+from nti.app.metadata.consumer import BatchProcessor
+from nti.app.metadata.consumer import WorkerSupervisor
+
+from nti.app.metadata.consumer import partition_queues
+
+from nti.app.metadata.metrics import ProcessorMetrics
+
+from nti.app.metadata.parallel import SharedSet
+
+
+class _DataManager(object):
+    """
+    Conflicts when committing more than ``limit`` jobs, and cannot
+    commit the ``broken`` job.
+    """
+
+    def __init__(self, limit, broken=None):
+        self.jobs = []
+        self.limit = limit
+        self.broken = broken
+        self.committed = []
+
+    def abort(self, unused_txn):
+        self.jobs = []
+
+    tpc_abort = abort
+
+    def tpc_begin(self, txn):
+        pass
+
+    commit = tpc_begin
+
+    def tpc_vote(self, unused_txn):
+        if len(self.jobs) > self.limit:
+            raise ConflictError()
+        if self.broken in self.jobs:
+            raise KeyError(self.broken)
+
+    def tpc_finish(self, unused_txn):
+        self.committed.append(list(self.jobs))
+        self.jobs = []
+
+    def sortKey(self):
+        return 'jobs'
+
+    def savepoint(self):
+        return _Savepoint(self)
+
+
+class _Savepoint(object):
+
+    def __init__(self, manager):
+        self.manager = manager
+        self.jobs = list(manager.jobs)
+
+    def rollback(self):
+        self.manager.jobs = list(self.jobs)
+
+
+class _Job(object):
+
+    def __init__(self, name, manager, fail=False):
+        self.name = name
+        self.fail = fail
+        self.manager = manager
+
+    def __call__(self):
+        if self.fail:
+            raise ValueError(self.name)
+        if not self.manager.jobs:
+            transaction.get().join(self.manager)
+        self.manager.jobs.append(self.name)
+
+    def has_failed(self):
+        return False
+
+
+class _Queue(object):
+
+    def __init__(self, jobs):
+        self.jobs = list(jobs)
+        self.failed = []
+
+    def claim(self):
+        return self.jobs.pop(0) if self.jobs else None
+
+    def put_failed(self, job):
+        self.failed.append(job.name)
+
+
+class _Process(object):
+    """
+    Runs the worker in this process when started.
+    """
+
+    pid = exitcode = None
+
+    def __init__(self, target, args, name=None):
+        self.name = name
+        self.target = target
+        self.args = args
+
+    def start(self):
+        self.pid = os.getpid()
+        try:
+            self.target(*self.args)
+            self.exitcode = 0
+        except SystemExit as e:
+            self.exitcode = e.code
+
+    def is_alive(self):
+        return False
+
+    def join(self, unused_timeout=None):
+        pass
+
+
+class _Context(object):
+    Process = _Process
+
+
+class _Runner(object):
+    """
+    Fails the first time it is called.
+    """
+
+    calls = 0
+
+    def __call__(self, unused_processor):
+        self.calls += 1
+        if self.calls == 1:
+            raise ValueError()
+
+
+class TestConsumer(unittest.TestCase):
+
+    def test_claim(self):
+        manager = _DataManager(10)
+        processor = BatchProcessor(batch_size=3, max_latency=0)
+        processor.queues = [_Queue([_Job(x, manager) for x in range(4)]),
+                            _Queue([_Job('a', manager)])]
+        processor.bulk_queues = []
+        batch = processor.claim()
+        assert_that([job.name for _, job in batch], is_([0, 'a', 1]))
+        batch = processor.claim()
+        assert_that([job.name for _, job in batch], is_([2, 3]))
+        assert_that(processor.claim(), is_([]))
+
+    def test_process(self):
+        manager = _DataManager(2)
+        queue = _Queue(())
+        batch = [(queue, _Job(x, manager)) for x in range(5)]
+        batch.append((queue, _Job('bad', manager, fail=True)))
+        processor = BatchProcessor(batch_size=10)
+        processor.metrics = metrics = ProcessorMetrics(name='test')
+        assert_that(processor.process(batch), is_(5))
+        assert_that(manager.committed, is_([[0], [1, 2], [3, 4]]))
+        assert_that(queue.failed, is_(['bad']))
+        assert_that(processor.splits, is_(2))
+        assert_that(processor.retried, is_(2))
+        # each committed job is timed, by queue
+        stats = metrics.queue_jobs['unknown']
+        assert_that(stats, has_entries('Jobs', 5, 'FailedJobs', 1))
+        assert_that(sum(stats['Latency']['Counts']), is_(5))
+
+    def test_process_commit_error(self):
+        manager = _DataManager(10, broken=2)
+        queue = _Queue(())
+        batch = [(queue, _Job(x, manager)) for x in range(4)]
+        processor = BatchProcessor(batch_size=10)
+        assert_that(processor.process(batch), is_(3))
+        assert_that(manager.committed, is_([[0, 1], [3]]))
+        assert_that(queue.failed, is_([2]))
+        assert_that(processor.stats(),
+                    is_({'Jobs': 3, 'Failed': 1, 'Splits': 2, 'Batches': 0,
+                         'Coalesced': 0, 'Retries': 2}))
+
+    def test_coalesce(self):
+        manager = _DataManager(10)
+        queue = _Queue(())
+        jobs = [_Job(x, manager) for x in ('add', 'bulk', 'modify',
+                                           'other', 'pending', 'admin')]
+        for job, args in zip(jobs, ((1,), ([1, 2],), (1,), (2,), (3,),
+                                    ('jobid', 'name'))):
+            job.args = args
+        redis = fakeredis.FakeStrictRedis()
+        redis.sadd('pending', 3)
+        processor = BatchProcessor()
+        processor.pending = SharedSet('pending', redis)
+        batch = processor.coalesce([(queue, job) for job in jobs])
+        assert_that([job.name for _, job in batch],
+                    is_(['bulk', 'modify', 'other', 'admin']))
+        assert_that(processor.coalesced, is_(2))
+
+    def test_partition_queues(self):
+        assert_that(partition_queues(('a', 'b', 'c', 'd', 'e'), 2),
+                    is_([('a', 'c', 'e'), ('b', 'd')]))
+        assert_that(partition_queues(('a',), 4), is_([('a',)]))
+
+    def test_stop(self):
+        processor = BatchProcessor(max_latency=0)
+
+        def sleep(unused_seconds):
+            processor.stop = True
+        processor.sleep = sleep
+        processor.queues = [_Queue(())]
+        processor.bulk_queues = []
+        assert_that(processor(), is_(0))
+        assert_that(processor.stats(),
+                    is_({'Jobs': 0, 'Failed': 0, 'Splits': 0, 'Batches': 0,
+                         'Coalesced': 0, 'Retries': 0}))
+
+    def test_lanes(self):
+        manager = _DataManager(10)
+        processor = BatchProcessor(batch_size=2, max_latency=0, bulk_rate=1)
+        processor.queues = [_Queue([_Job('a', manager)])]
+        processor.bulk_queues = [_Queue([_Job(x, manager) for x in range(3)])]
+        processor.limiter.burst = processor.limiter.tokens = 2
+        batch = processor.claim()
+        assert_that([job.name for _, job in batch], is_(['a', 0]))
+        batch = processor.claim()
+        assert_that([job.name for _, job in batch], is_([1]))
+        assert_that(processor.claim(), is_([]))
+        assert_that(processor.throttled, is_(True))
+
+    def test_rate_limiter(self):
+        now = [0]
+        limiter = RateLimiter(2, clock=lambda: now[0])
+        for _ in range(2):
+            assert_that(limiter.ready(), is_(True))
+            limiter.consume()
+        assert_that(limiter.ready(), is_(False))
+        assert_that(limiter.delay(), is_(0.5))
+        now[0] = 0.5
+        assert_that(limiter.ready(), is_(True))
+
+    def test_restart_failed_worker(self):
+        for signum in (signal.SIGTERM, signal.SIGINT):
+            self.addCleanup(signal.signal, signum, signal.getsignal(signum))
+        runner = _Runner()
+        supervisor = WorkerSupervisor(runner, [('a',)])
+        supervisor.context = _Context()
+        supervisor.messages = Queue.Queue()
+        supervisor.start(0)
+        assert_that(supervisor.processes[0].exitcode, is_(1))
+        # the failed worker is replaced
+        supervisor._check()
+        assert_that(runner.calls, is_(2))
+        assert_that(supervisor.restarts[0], is_(1))
+        assert_that(supervisor.processes[0].exitcode, is_(0))
+        # a finished worker is not
+        supervisor._check()
+        assert_that(runner.calls, is_(2))
+        assert_that(supervisor.processes, is_({}))
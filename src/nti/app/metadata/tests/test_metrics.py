@@ -0,0 +1,115 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+from __future__ import division
+from __future__ import print_function
+from __future__ import absolute_import
+
+# disable: accessing protected members, too many methods
+# pylint: disable=W0212,R0904
+
+from hamcrest import is_
+from hamcrest import is_in
+from hamcrest import has_length
+from hamcrest import assert_that
+from hamcrest import has_entries
+
+import unittest
+
+import fakeredis
+
+import transaction
+
+from ZODB.POSException import ConflictError
+
+from nti.app.metadata.metrics import LATENCY_BUCKETS
+
+from nti.app.metadata.metrics import ProcessorMetrics
+from nti.app.metadata.metrics import render_prometheus
+from nti.app.metadata.metrics import get_processor_metrics
+
+
+class _Resource(object):
+
+    def tpc_begin(self, txn):
+        pass
+
+    commit = tpc_vote = tpc_finish = abort = tpc_abort = tpc_begin
+
+    def sortKey(self):
+        return 'resource'
+
+
+class _Conflict(_Resource):
+
+    def tpc_vote(self, unused_txn):
+        raise ConflictError()
+
+
+class TestMetrics(unittest.TestCase):
+
+    def setUp(self):
+        self.manager = transaction.TransactionManager()
+        self.metrics = ProcessorMetrics(name='test', interval=3600)
+        self.manager.registerSynch(self.metrics)
+
+    def test_transactions(self):
+        # a batch
+        txn = self.manager.begin()
+        txn.join(_Resource())
+        self.manager.commit()
+        # a conflicting batch
+        txn = self.manager.begin()
+        txn.join(_Conflict())
+        with self.assertRaises(ConflictError):
+            self.manager.commit()
+        self.manager.abort()
+        # a retried batch
+        self.manager.begin()
+        self.manager.abort()
+        self.metrics.record({'Jobs': 10, 'Failed': 1, 'Batches': 2,
+                             'Retries': 1})
+        snapshot = self.metrics.snapshot()
+        # only the batch processor knows an abort is retried
+        assert_that(snapshot,
+                    has_entries('Name', 'test',
+                                'Jobs', 10,
+                                'FailedJobs', 1,
+                                'Batches', 2,
+                                'Retries', 1,
+                                'Aborts', 1,
+                                'Conflicts', 1))
+        assert_that(snapshot['Latency']['Counts'],
+                    has_length(len(LATENCY_BUCKETS) + 1))
+        assert_that(sum(snapshot['Latency']['Counts']), is_(1))
+
+    def test_prometheus(self):
+        self.metrics.observe(0.2)
+        self.metrics.observe(100)
+        self.metrics.record({'Jobs': 5, 'Batches': 2})
+        self.metrics.observe_job('q', 0.02)
+        self.metrics.observe_failed('q')
+        snapshot = self.metrics.snapshot(queues={'q': {'Depth': 3}})
+        text = render_prometheus([snapshot])
+        assert_that('nti_metadata_processor_jobs_total{processor="test"} 5',
+                    is_in(text.splitlines()))
+        assert_that('nti_metadata_processor_batch_latency_seconds_bucket'
+                    '{le="+Inf",processor="test"} 2',
+                    is_in(text.splitlines()))
+        assert_that('nti_metadata_queue_depth{processor="test",queue="q"} 3',
+                    is_in(text.splitlines()))
+        assert_that('nti_metadata_processor_queue_jobs_total'
+                    '{processor="test",queue="q"} 1',
+                    is_in(text.splitlines()))
+        assert_that('nti_metadata_processor_queue_failed_jobs_total'
+                    '{processor="test",queue="q"} 1',
+                    is_in(text.splitlines()))
+        assert_that('nti_metadata_processor_job_latency_seconds_bucket'
+                    '{le="0.05",processor="test",queue="q"} 1',
+                    is_in(text.splitlines()))
+
+    def test_get_processor_metrics(self):
+        redis = fakeredis.FakeStrictRedis()
+        redis.set('nti/app/metadata/metrics/a', '{"Name": "a"}')
+        redis.set('nti/app/metadata/metrics/b', '{"Name": "b"}')
+        assert_that(get_processor_metrics(redis), has_length(2))
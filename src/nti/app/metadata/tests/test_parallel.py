@@ -0,0 +1,146 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+from __future__ import division
+from __future__ import print_function
+from __future__ import absolute_import
+
+# disable: accessing protected members, too many methods
+# pylint: disable=W0212,R0904
+
+from hamcrest import is_
+from hamcrest import has_length
+from hamcrest import assert_that
+from hamcrest import has_entries
+from hamcrest import starts_with
+
+import os
+import shutil
+import tempfile
+import unittest
+import functools
+
+import transaction
+
+from BTrees.LLBTree import LLBTree
+
+import fakeredis
+
+from ZODB import DB
+
+from ZODB.FileStorage import FileStorage
+
+from nti.app.metadata.parallel import SharedSet
+from nti.app.metadata.parallel import SHARED_SET_EXPIRATION
+from nti.app.metadata.parallel import partition_ids
+from nti.app.metadata.parallel import run_partitions
+
+#: root of the database opened by the runner in the worker process
+_root = None
+
+
+class FileStorageRunner(object):
+
+    def __init__(self, path):
+        self.path = path
+
+    def __call__(self, function):
+        global _root  # pylint: disable=global-statement
+        db = DB(FileStorage(self.path))
+        try:
+            conn = db.open()
+            _root = conn.root()
+            result = function()
+            transaction.commit()
+            return result
+        finally:
+            _root = None
+            db.close()
+
+
+def _double(partition, report, batch_size=2):
+    count = 0
+    low, high = partition
+    for doc_id in range(low, high + 1):
+        _root['tree'][doc_id] = doc_id * 2
+        count += 1
+        if count % batch_size == 0:
+            transaction.commit()
+            report(count)
+    return count
+
+
+def _fail_odd(partition, report):
+    report(0)
+    if partition[0] % 2:
+        raise ValueError(partition)
+    return 0
+
+
+class TestParallel(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.path = os.path.join(self.tmpdir, 'Data.fs')
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir, True)
+
+    def test_partition_ids(self):
+        assert_that(partition_ids((), 3), is_([]))
+        assert_that(partition_ids(range(1, 11), 3),
+                    is_([(1, 4), (5, 8), (9, 10)]))
+        assert_that(partition_ids(range(1, 3), 4),
+                    is_([(1, 1), (2, 2)]))
+
+    def test_shared_set(self):
+        redis = fakeredis.FakeStrictRedis()
+        seen = SharedSet('seen', redis)
+        assert_that(seen.add_new([1, 2, 3]), is_([1, 2, 3]))
+        other = SharedSet('seen', redis)
+        assert_that(other.add_new([3, 4]), is_([4]))
+        assert_that(seen, has_length(4))
+        # the expiration is set when the set is created
+        assert_that(redis.ttl('seen'), is_(SHARED_SET_EXPIRATION))
+        redis.expire('seen', 10)
+        other.add_new([5])
+        assert_that(redis.ttl('seen'), is_(10))
+        seen.clear()
+        assert_that(seen, has_length(0))
+
+    def test_run_partitions(self):
+        db = DB(FileStorage(self.path))
+        with db.transaction() as conn:
+            conn.root()['tree'] = LLBTree()
+        db.close()
+
+        partitions = partition_ids(range(1, 11), 3)
+        # FileStorage does not allow concurrent processes
+        stats = run_partitions(functools.partial(_double, batch_size=2),
+                               partitions,
+                               FileStorageRunner(self.path),
+                               workers=1)
+        assert_that(stats, has_length(3))
+        assert_that(stats[0],
+                    has_entries('Status', 'done',
+                                'Result', 4,
+                                'Partition', (1, 4)))
+
+        db = DB(FileStorage(self.path))
+        with db.transaction() as conn:
+            tree = conn.root()['tree']
+            assert_that(dict(tree), is_({x: x * 2 for x in range(1, 11)}))
+        db.close()
+
+    def test_run_failed_partitions(self):
+        db = DB(FileStorage(self.path))
+        db.close()
+        stats = run_partitions(_fail_odd, [(1, 1), (2, 2)],
+                               FileStorageRunner(self.path),
+                               workers=1)
+        assert_that(stats[0],
+                    has_entries('Status', 'failed',
+                                'Result', starts_with('ValueError')))
+        assert_that(stats[1],
+                    has_entries('Status', 'done',
+                                'Result', 0))
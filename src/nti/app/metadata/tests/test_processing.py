@@ -0,0 +1,123 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+from __future__ import division
+from __future__ import print_function
+from __future__ import absolute_import
+
+# disable: accessing protected members, too many methods
+# pylint: disable=W0212,R0904
+
+from hamcrest import is_
+from hamcrest import assert_that
+
+import unittest
+
+import fakeredis
+
+import transaction
+
+from ZODB.POSException import ConflictError
+
+from nti.app.metadata.processing import BulkQueuer
+from nti.app.metadata.processing import PendingIntids
+from nti.app.metadata.processing import coalescing_stats
+
+
+class _Conflict(object):
+
+    def tpc_begin(self, txn):
+        pass
+
+    commit = tpc_finish = abort = tpc_abort = tpc_begin
+
+    def tpc_vote(self, unused_txn):
+        raise ConflictError()
+
+    def sortKey(self):
+        return 'conflict'
+
+
+class TestProcessing(unittest.TestCase):
+
+    def test_bulk_queuer(self):
+        jobs = []
+
+        def put(doc_ids, name):
+            jobs.append((name, list(doc_ids)))
+
+        with BulkQueuer(2, ('a', 'b'), put=put) as queuer:
+            for doc_id in range(5):
+                queuer(doc_id)
+        assert_that(jobs,
+                    is_([('a', [0, 1]), ('b', [2, 3]), ('a', [4])]))
+        assert_that(queuer.jobs, is_(3))
+        assert_that(queuer.total, is_(5))
+
+    def test_coalescing(self):
+        jobs = []
+
+        def put(doc_ids, unused_name):
+            jobs.append(list(doc_ids))
+
+        redis = fakeredis.FakeStrictRedis()
+        pending = PendingIntids(redis=redis)
+        transaction.begin()
+        with BulkQueuer(3, ('a',), put=put, pending=pending) as queuer:
+            for doc_id in (1, 2, 3, 1, 2, 4):
+                queuer(doc_id)
+        assert_that(jobs, is_([[1, 2, 3], [4]]))
+        assert_that(queuer.coalesced, is_(2))
+        # pending once the jobs are queued by the commit
+        assert_that(len(pending), is_(0))
+        transaction.commit()
+        assert_that(coalescing_stats(redis),
+                    is_({'Pending': 4, 'Coalesced': 2}))
+
+        # once executed, ids are queued again
+        pending.discard([1, 2])
+        with BulkQueuer(3, ('a',), put=put, pending=pending) as queuer:
+            for doc_id in (1, 2, 3):
+                queuer(doc_id)
+        transaction.commit()
+        assert_that(jobs[-1], is_([1, 2]))
+        assert_that(queuer.coalesced, is_(1))
+
+    def test_coalescing_abort(self):
+        jobs = []
+
+        def put(doc_ids, unused_name):
+            jobs.append(list(doc_ids))
+
+        redis = fakeredis.FakeStrictRedis()
+        pending = PendingIntids(redis=redis)
+        transaction.begin()
+        with BulkQueuer(3, ('a',), put=put, pending=pending) as queuer:
+            for doc_id in (1, 2, 3):
+                queuer(doc_id)
+        transaction.abort()
+        assert_that(len(pending), is_(0))
+
+        # the retry queues them again
+        with BulkQueuer(3, ('a',), put=put, pending=pending) as queuer:
+            for doc_id in (1, 2, 3):
+                queuer(doc_id)
+        transaction.commit()
+        assert_that(jobs, is_([[1, 2, 3], [1, 2, 3]]))
+        assert_that(queuer.coalesced, is_(0))
+        assert_that(len(pending), is_(3))
+
+    def test_coalescing_commit_failed(self):
+        redis = fakeredis.FakeStrictRedis()
+        pending = PendingIntids(redis=redis)
+        transaction.begin()
+        with BulkQueuer(3, ('a',), put=lambda *unused: None,
+                        pending=pending) as queuer:
+            for doc_id in (1, 2):
+                queuer(doc_id)
+        transaction.get().join(_Conflict())
+        with self.assertRaises(ConflictError):
+            transaction.commit()
+        transaction.abort()
+        assert_that(coalescing_stats(redis),
+                    is_({'Pending': 0, 'Coalesced': 0}))
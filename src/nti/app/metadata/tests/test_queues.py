@@ -0,0 +1,87 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+from __future__ import division
+from __future__ import print_function
+from __future__ import absolute_import
+
+# disable: accessing protected members, too many methods
+# pylint: disable=W0212,R0904
+
+from hamcrest import is_
+from hamcrest import none
+from hamcrest import assert_that
+from hamcrest import has_entries
+
+import zlib
+import pickle
+import unittest
+
+import fakeredis
+
+from nti.app.metadata.queues import clear_queue
+from nti.app.metadata.queues import delete_hash
+from nti.app.metadata.queues import delete_list
+from nti.app.metadata.queues import purge_queues
+from nti.app.metadata.queues import queue_stats
+from nti.app.metadata.queues import iter_job_keys
+from nti.app.metadata.queues import scan_job_keys
+
+
+def _pickle(job):
+    return zlib.compress(pickle.dumps(job))
+
+
+class TestQueues(unittest.TestCase):
+
+    def setUp(self):
+        self.redis = fakeredis.FakeStrictRedis()
+        for idx in range(5):
+            self.redis.rpush('queue', _pickle({'id': idx}))
+            self.redis.hset('queue/hash', 'job%s' % idx, 1)
+        self.redis.rpush('queue/failed', _pickle({'id': 'failed'}))
+
+    def test_queue_stats(self):
+        assert_that(queue_stats(self.redis, 'queue'),
+                    has_entries('Depth', 5,
+                                'FailedDepth', 1,
+                                'OldestJobAge', is_(none())))
+
+    def test_job_keys(self):
+        keys = []
+        cursor = None
+        while cursor != 0:
+            cursor, page = scan_job_keys(self.redis, 'queue', cursor or 0, 2)
+            keys.extend(page)
+        expected = ['job%s' % x for x in range(5)]
+        assert_that(sorted(keys), is_(expected))
+        assert_that(sorted(iter_job_keys(self.redis, 'queue')),
+                    is_(expected))
+
+    def test_delete_chunks(self):
+        assert_that(delete_hash(self.redis, 'queue/hash', 2), is_(5))
+        assert_that(delete_list(self.redis, 'queue', 2), is_(5))
+        assert_that(self.redis.exists('queue', 'queue/hash'), is_(0))
+
+    def test_clear_queue(self):
+        self.redis.hset('queue/failed/hash', 'failed', 1)
+        assert_that(clear_queue(self.redis, 'queue', jobs=False),
+                    has_entries('Jobs', 0,
+                                'Keys', 0,
+                                'FailedJobs', 1,
+                                'FailedKeys', 1))
+        assert_that(self.redis.llen('queue'), is_(5))
+        assert_that(clear_queue(self.redis, 'queue', unlink=False, count=2),
+                    has_entries('Jobs', 5,
+                                'Keys', 5,
+                                'FailedJobs', 0))
+        assert_that(self.redis.exists('queue', 'queue/hash'), is_(0))
+
+    def test_purge_queues(self):
+        progress = []
+        result = purge_queues(('queue',), redis=self.redis, count=2,
+                              report=progress.append)
+        assert_that(result, has_entries('Total', 6))
+        assert_that(result['Queues']['queue'],
+                    has_entries('Jobs', 5, 'FailedJobs', 1))
+        assert_that(progress, is_([6]))
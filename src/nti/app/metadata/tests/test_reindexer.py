@@ -0,0 +1,43 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+from __future__ import division
+from __future__ import print_function
+from __future__ import absolute_import
+
+# disable: accessing protected members, too many methods
+# pylint: disable=W0212,R0904
+
+from hamcrest import is_
+from hamcrest import assert_that
+from hamcrest import instance_of
+
+import unittest
+
+import BTrees
+
+from zc.catalog.index import ValueIndex
+
+from zope.catalog.catalog import Catalog
+
+from nti.app.metadata.reindexer import get_catalog_doc_ids
+from nti.app.metadata.reindexer import iter_catalog_doc_ids
+
+
+class TestReindexer(unittest.TestCase):
+
+    def _catalog(self):
+        catalog = Catalog(family=BTrees.family64)
+        for name, docs in (('a', (7, 1, 5)), ('b', (5, 3, 9))):
+            index = catalog[name] = ValueIndex(family=BTrees.family64)
+            for doc_id in docs:
+                index.index_doc(doc_id, name)
+        return catalog
+
+    def test_catalog_doc_ids(self):
+        catalog = self._catalog()
+        doc_ids = get_catalog_doc_ids(catalog)
+        assert_that(doc_ids, instance_of(BTrees.family64.IF.Set))
+        assert_that(list(doc_ids), is_([1, 3, 5, 7, 9]))
+        assert_that(list(iter_catalog_doc_ids(catalog)),
+                    is_([1, 3, 5, 7, 9]))
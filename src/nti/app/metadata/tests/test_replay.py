@@ -0,0 +1,150 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+from __future__ import division
+from __future__ import print_function
+from __future__ import absolute_import
+
+# disable: accessing protected members, too many methods
+# pylint: disable=W0212,R0904
+
+from hamcrest import is_
+from hamcrest import assert_that
+from hamcrest import has_entries
+
+import zlib
+import pickle
+import unittest
+
+import fakeredis
+
+from nti.app.metadata.queues import unpickle
+
+from nti.app.metadata.replay import job_error
+from nti.app.metadata.replay import replay_name
+from nti.app.metadata.replay import job_doc_ids
+from nti.app.metadata.replay import replay_queue
+from nti.app.metadata.replay import checkpoint_key
+from nti.app.metadata.replay import iter_job_windows
+from nti.app.metadata.replay import bucket_failed_jobs
+from nti.app.metadata.replay import replay_failed_jobs
+from nti.app.metadata.replay import sample_failed_jobs
+
+executed = []
+
+
+class _Job(object):
+
+    error = None
+
+    def __init__(self, uid, fail=False, args=()):
+        self.id = 'job%s' % uid
+        self.uid = uid
+        self.fail = fail
+        self.args = args
+
+    def __call__(self):
+        if self.fail:
+            raise ValueError(self.uid)
+        executed.append(self.uid)
+
+
+class _IntIds(object):
+
+    def queryObject(self, unused_uid):
+        return None
+
+
+def _pickle(job):
+    return zlib.compress(pickle.dumps(job))
+
+
+class TestReplay(unittest.TestCase):
+
+    def setUp(self):
+        del executed[:]
+        self.redis = fakeredis.FakeStrictRedis()
+        for idx in range(5):
+            self.redis.rpush('queue', _pickle(_Job(idx, fail=idx == 3)))
+
+    def test_iter_job_windows(self):
+        windows = [(x, len(y)) for x, y in
+                   iter_job_windows(self.redis, 'queue', size=2)]
+        assert_that(windows, is_([(0, 2), (2, 2), (4, 1)]))
+
+    def test_replay_queue(self):
+        reports = []
+        stats = replay_queue(self.redis, 'queue', size=2,
+                             report=lambda x: reports.append(dict(x)))
+        assert_that(executed, is_([0, 1, 2, 4]))
+        assert_that(stats, has_entries('Total', 5,
+                                       'Jobs', 4,
+                                       'Failed', 1,
+                                       'Resumed', 0))
+        assert_that(len(reports), is_(3))
+        assert_that(int(self.redis.get(checkpoint_key('queue'))), is_(5))
+        # jobs are left in the queue
+        assert_that(self.redis.llen('queue'), is_(5))
+
+    def test_resume(self):
+        self.redis.set(checkpoint_key('queue'), 2)
+        stats = replay_queue(self.redis, 'queue', size=2)
+        assert_that(executed, is_([2, 4]))
+        assert_that(stats, has_entries('Jobs', 2,
+                                       'Failed', 1,
+                                       'Resumed', 2))
+        # nothing left to replay
+        del executed[:]
+        stats = replay_queue(self.redis, 'queue', size=2)
+        assert_that(executed, is_([]))
+        assert_that(stats, has_entries('Jobs', 0, 'Resumed', 5))
+
+
+class TestFailedJobs(unittest.TestCase):
+
+    def setUp(self):
+        del executed[:]
+        self.redis = fakeredis.FakeStrictRedis()
+        for idx in range(6):
+            job = _Job(idx, fail=idx % 3 == 0, args=([idx, idx + 10],))
+            job.error = ValueError('boom') if idx % 2 else KeyError(idx)
+            self.redis.rpush('queue/failed', _pickle(job))
+            self.redis.hset('queue/failed/hash', job.id, 1)
+
+    def test_job_info(self):
+        job = _Job(1, args=(7, 'x'))
+        assert_that(job_doc_ids(job), is_([7]))
+        assert_that(job_error(job), is_(('Unknown', None)))
+        job.error = u'POSKeyError: 0x01'
+        assert_that(job_error(job), is_(('POSKeyError', u'POSKeyError: 0x01')))
+
+    def test_sample(self):
+        assert_that(len(sample_failed_jobs(self.redis, 'queue', 3)), is_(3))
+        assert_that(len(sample_failed_jobs(self.redis, 'queue', 10)), is_(6))
+
+    def test_bucket_failed_jobs(self):
+        result = bucket_failed_jobs(('queue',), redis=self.redis,
+                                    intids=_IntIds())
+        assert_that(result, has_entries('Sampled', 6,
+                                        'MimeTypes', {'missing': 12}))
+        assert_that(result['Errors']['ValueError'],
+                    has_entries('Jobs', 3,
+                                'Messages', ['boom']))
+        assert_that(result['Errors']['KeyError'], has_entries('Jobs', 3))
+
+    def test_replay_failed_jobs(self):
+        result = replay_failed_jobs(('queue',), batch_size=4,
+                                    redis=self.redis)
+        assert_that(executed, is_([1, 2, 4, 5]))
+        assert_that(result, has_entries('Jobs', 6,
+                                        'Replayed', 4,
+                                        'Failed', 2))
+        # jobs that failed again are back in the failed queue
+        assert_that(self.redis.llen('queue/failed'), is_(2))
+        assert_that(sorted(self.redis.hkeys('queue/failed/hash')),
+                    is_([b'job0', b'job3']))
+        # with the error of the replay
+        errors = [job_error(unpickle(x))
+                  for x in self.redis.lrange('queue/failed', 0, -1)]
+        assert_that(errors, is_([('ValueError', u'0'), ('ValueError', u'3')]))
+        assert_that(self.redis.exists(replay_name('queue')), is_(0))
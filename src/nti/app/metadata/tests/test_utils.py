@@ -0,0 +1,132 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+from __future__ import division
+from __future__ import print_function
+from __future__ import absolute_import
+
+# disable: accessing protected members, too many methods
+# pylint: disable=W0212,R0904
+
+from hamcrest import is_
+from hamcrest import has_length
+from hamcrest import assert_that
+from hamcrest import has_entries
+
+import unittest
+
+import BTrees
+
+from zope.intid import IntIds
+
+from nti.app.metadata.utils import STRUCTURE_TREES
+from nti.app.metadata.utils import STRUCTURE_VALUES
+
+from nti.app.metadata.utils import in_window
+from nti.app.metadata.utils import get_check_state
+from nti.app.metadata.utils import find_missing_ids
+from nti.app.metadata.utils import resolve_timestamp
+from nti.app.metadata.utils import check_structures
+from nti.app.metadata.utils import new_structure_stats
+
+from nti.app.metadata.utils import _index_ids
+
+
+class _Corrupt(object):
+
+    def _check(self):
+        raise AssertionError("Bucket length < 1")
+
+
+class _Index(object):
+
+    def __init__(self):
+        family = BTrees.family64
+        self.documents_to_values = family.IO.BTree({1: 'a', 2: 'b'})
+        self.values_to_documents = family.OO.BTree()
+        self.values_to_documents['a'] = family.IF.TreeSet((1,))
+        self.values_to_documents['b'] = _Corrupt()
+        self.values_to_documents['c'] = family.IF.TreeSet((3,))
+
+
+class _Jar(object):
+
+    def __init__(self):
+        self.data = {}
+
+    def root(self):
+        return self.data
+
+
+class _Located(object):
+
+    def __init__(self, name, parent=None, jar=None):
+        self.__name__ = name
+        self.__parent__ = parent
+        self._p_jar = jar
+
+
+class TestUtils(unittest.TestCase):
+
+    def test_find_missing_ids(self):
+        intids = IntIds(family=BTrees.family64)
+        for uid in (1, 3, 5):
+            intids.refs[uid] = object()
+        doc_ids = BTrees.family64.IF.TreeSet((1, 2, 3, 4))
+        assert_that(list(find_missing_ids(doc_ids, intids)), is_([2, 4]))
+        assert_that(list(find_missing_ids((), intids)), is_([]))
+
+    def test_index_ids(self):
+        index = _Index()
+        assert_that(list(_index_ids(index, 2, 5)), is_([2]))
+        assert_that(list(_index_ids(index, None, 1)), is_([1]))
+
+    def test_check_structures(self):
+        index = _Index()
+        stats = new_structure_stats()
+        check_structures(u'catalog', u'mimeType', index, STRUCTURE_TREES, stats)
+        assert_that(stats, has_entries('Checked', 2, 'Corrupt', is_([])))
+
+        check_structures(u'catalog', u'mimeType', index,
+                         (STRUCTURE_VALUES, 'a', 'b'), stats)
+        assert_that(stats['Checked'], is_(4))
+        assert_that(stats['Corrupt'], has_length(1))
+        assert_that(stats['Corrupt'][0],
+                    has_entries('Catalog', u'catalog',
+                                'Index', u'mimeType',
+                                'Structure', 'values_to_documents',
+                                'Key', repr('b'),
+                                'OID', None))
+
+        check_structures(u'catalog', u'mimeType', index,
+                         (STRUCTURE_VALUES, 'c', None), stats)
+        assert_that(stats['Checked'], is_(5))
+        assert_that(stats['Corrupt'], has_length(1))
+
+    def test_time_window(self):
+        assert_that(resolve_timestamp(None), is_(None))
+        assert_that(resolve_timestamp('100'), is_(100.0))
+        assert_that(resolve_timestamp(-60, now=1000), is_(940.0))
+        self.assertRaises(ValueError, resolve_timestamp, 'yesterday')
+
+        obj = _Corrupt()
+        obj.createdTime = 100
+        obj.lastModified = 200
+        assert_that(in_window(obj), is_(True))
+        assert_that(in_window(obj, since=150), is_(True))
+        assert_that(in_window(obj, since=50, until=120), is_(True))
+        assert_that(in_window(obj, since=120, until=150), is_(False))
+        assert_that(in_window(obj, since=300), is_(False))
+
+    def test_check_state(self):
+        jar = _Jar()
+        sites = _Located(u'++etc++hostsites', _Located(u'dataserver2'))
+        first = _Located(u'catalog', _Located(u'first', sites), jar)
+        second = _Located(u'catalog', _Located(u'second', sites), jar)
+        assert_that(get_check_state(first), is_(None))
+        state = get_check_state(first, create=True)
+        state.high = 10
+        assert_that(get_check_state(first), is_(state))
+        # catalogs of different sites with the same name
+        assert_that(get_check_state(second), is_(None))
+        assert_that(get_check_state(second, create=True).high, is_(None))
@@ -12,13 +12,18 @@ from hamcrest import none
 from hamcrest import is_in
 from hamcrest import is_not
 from hamcrest import has_value
+from hamcrest import has_key
+from hamcrest import has_item
 from hamcrest import has_entry
+from hamcrest import has_length
 from hamcrest import assert_that
 from hamcrest import has_entries
 from hamcrest import greater_than_or_equal_to
 
 import simplejson as json
 
+import transaction
+
 from ZODB.interfaces import IBroken
 
 from zope import component
@@ -26,8 +31,18 @@ from zope import interface
 
 from zope.intid.interfaces import IIntIds
 
+from nti.app.metadata.jobs import run_admin_job
+from nti.app.metadata.jobs import queue_admin_job
+
+from nti.app.metadata.processing import PendingIntids
+
+from nti.app.metadata.reindexer import get_rebuild_cursor
+from nti.app.metadata.reindexer import rebuild_metadata_catalog
+
 from nti.app.metadata.tests import MetadataApplicationTestLayer
 
+from nti.app.metadata.utils import mime_type_registry
+
 from nti.app.testing.application_webtest import ApplicationLayerTest
 
 from nti.app.testing.decorators import WithSharedApplicationMockDSHandleChanges
@@ -86,6 +101,123 @@ class TestAdminViews(ApplicationLayerTest):
                                 'TotalBroken', 1,
                                 'TotalMissing', 0))
 
+        res = testapp.post('/dataserver2/metadata/@@check_indices',
+                           json.dumps({'treesets': True}),
+                           extra_environ=self._make_extra_environ(),
+                           status=200)
+        assert_that(res.json_body,
+                    has_entry('Structures',
+                              has_entries('Checked', greater_than_or_equal_to(1),
+                                          'Corrupt', is_([]))))
+
+        testapp.post('/dataserver2/metadata/@@check_indices',
+                     json.dumps({'workers': 'many'}),
+                     extra_environ=self._make_extra_environ(),
+                     status=422)
+
+    @WithSharedApplicationMockDSHandleChanges(users=True, testapp=True)
+    def test_check_indices_dry_run(self):
+        username = u'ichigo@bleach.com'
+        with mock_dataserver.mock_db_trans(self.ds):
+            ichigo = self._create_user(username=username)
+            note = self._create_note(u'Broken', ichigo.username)
+            ichigo.addContainedObject(note)
+            interface.alsoProvides(note, IBroken)
+            intids = component.getUtility(IIntIds)
+            doc_id = intids.queryId(note)
+
+        # pylint: disable=no-member
+        testapp = TestApp(self.app)
+        res = testapp.post('/dataserver2/metadata/@@check_indices',
+                           json.dumps({'broken': True, 'dryRun': True}),
+                           extra_environ=self._make_extra_environ(),
+                           status=200)
+        lines = [json.loads(x) for x in res.text.splitlines()]
+        assert_that(lines[0],
+                    has_entries('DocId', doc_id,
+                                'Problem', 'Broken'))
+        assert_that(lines[-1]['Summary'], has_entries('TotalBroken', 1))
+
+        # nothing was unindexed
+        with mock_dataserver.mock_db_trans(self.ds):
+            catalog = get_metadata_catalog()
+            assert_that(doc_id, is_in(catalog['mimeType'].ids()))
+
+        # options a streamed check cannot honor
+        for options in ({'async': True},
+                        {'check': True},
+                        {'incremental': True},
+                        {'async': True, 'workers': 2}):
+            options['dryRun'] = True
+            testapp.post('/dataserver2/metadata/@@check_indices',
+                         json.dumps(options),
+                         extra_environ=self._make_extra_environ(),
+                         status=422)
+
+    @WithSharedApplicationMockDSHandleChanges(users=True, testapp=True)
+    def test_incremental_check_indices(self):
+        username = u'ichigo@bleach.com'
+        with mock_dataserver.mock_db_trans(self.ds):
+            ichigo = self._create_user(username=username)
+            note = self._create_note(u'As Nodt Fear', ichigo.username)
+            ichigo.addContainedObject(note)
+
+        # pylint: disable=no-member
+        testapp = TestApp(self.app)
+        res = testapp.post('/dataserver2/metadata/@@check_indices',
+                           json.dumps({'incremental': True}),
+                           extra_environ=self._make_extra_environ(),
+                           status=200)
+        coverage = list(res.json_body['Coverage'].values())[0]
+        assert_that(coverage['New'], is_(coverage['Total']))
+        assert_that(coverage, has_entries('FullSweep', True,
+                                          'LastFullSweep', is_not(none())))
+        assert_that(res.json_body, has_entries('CoverageRatio', 1,
+                                               'TotalMissing', 0))
+
+        res = testapp.post('/dataserver2/metadata/@@check_indices',
+                           json.dumps({'incremental': True,
+                                       'sampleSize': 1}),
+                           extra_environ=self._make_extra_environ(),
+                           status=200)
+        coverage = list(res.json_body['Coverage'].values())[0]
+        assert_that(coverage, has_entries('New', 0,
+                                          'Sampled', 1,
+                                          'FullSweep', False))
+
+        # the last full sweep is too old
+        res = testapp.post('/dataserver2/metadata/@@check_indices',
+                           json.dumps({'incremental': True,
+                                       'maxSweepAge': 0}),
+                           extra_environ=self._make_extra_environ(),
+                           status=200)
+        coverage = list(res.json_body['Coverage'].values())[0]
+        assert_that(coverage, has_entries('New', coverage['Total'],
+                                          'FullSweep', True))
+
+        res = testapp.post('/dataserver2/metadata/@@check_indices',
+                           json.dumps({'incremental': True,
+                                       'full': True}),
+                           extra_environ=self._make_extra_environ(),
+                           status=200)
+        coverage = list(res.json_body['Coverage'].values())[0]
+        assert_that(coverage, has_entries('New', coverage['Total'],
+                                          'SampleCursor', none(),
+                                          'LastFullSweep', is_not(none())))
+
+        for options in ({'sampleSize': 'all'}, {'maxSweepAge': -1}):
+            options['incremental'] = True
+            testapp.post('/dataserver2/metadata/@@check_indices',
+                         json.dumps(options),
+                         extra_environ=self._make_extra_environ(),
+                         status=422)
+
+        testapp.post('/dataserver2/metadata/@@check_indices',
+                     json.dumps({'incremental': True,
+                                 'treesets': True}),
+                     extra_environ=self._make_extra_environ(),
+                     status=422)
+
     @WithSharedApplicationMockDSHandleChanges(users=True, testapp=True)
     def test_mime_types(self):
         username = u'ichigo@bleach.com'
@@ -93,14 +225,51 @@ class TestAdminViews(ApplicationLayerTest):
             ichigo = self._create_user(username=username)
             note = self._create_note(u'As Nodt Fear', ichigo.username)
             ichigo.addContainedObject(note)
+            doc_id = component.getUtility(IIntIds).queryId(note)
 
+        mime_type_registry.invalidate()
         # pylint: disable=no-member
         testapp = TestApp(self.app)
         res = testapp.get('/dataserver2/metadata/@@mime_types',
                           extra_environ=self._make_extra_environ(),
                           status=200)
         assert_that(res.json_body,
-                    has_entries('Total', is_(greater_than_or_equal_to(3))))
+                    has_entries('Total', is_(greater_than_or_equal_to(3)),
+                                'Items', has_item('application/vnd.nextthought.note')))
+        assert_that(res.json_body, is_not(has_key('Counts')))
+
+        etag = res.headers['ETag']
+        testapp.get('/dataserver2/metadata/@@mime_types',
+                    headers={'If-None-Match': etag},
+                    extra_environ=self._make_extra_environ(),
+                    status=304)
+
+        res = testapp.get('/dataserver2/metadata/@@mime_types',
+                          {'counts': True},
+                          headers={'If-None-Match': etag},
+                          extra_environ=self._make_extra_environ(),
+                          status=200)
+        assert_that(res.json_body,
+                    has_entry('Counts', has_entry('application/vnd.nextthought.note', 1)))
+
+        # a document that changes mime type changes the ETag
+        counts_etag = res.headers['ETag']
+        with mock_dataserver.mock_db_trans(self.ds):
+            index = get_metadata_catalog()['mimeType']
+            mime_types = list(index.values_to_documents.keys())
+            other = [x for x in mime_types
+                     if x != 'application/vnd.nextthought.note'][0]
+            index.index_doc(doc_id, other)
+        self.addCleanup(setattr, mime_type_registry, 'min_age',
+                        mime_type_registry.min_age)
+        mime_type_registry.min_age = 0
+        res = testapp.get('/dataserver2/metadata/@@mime_types',
+                          {'counts': True},
+                          headers={'If-None-Match': counts_etag},
+                          extra_environ=self._make_extra_environ(),
+                          status=200)
+        assert_that(res.json_body,
+                    has_entry('Counts', has_entry(other, greater_than_or_equal_to(2))))
 
     @WithSharedApplicationMockDSHandleChanges(users=True, testapp=True)
     def test_unindex_index_doc(self):
@@ -141,6 +310,7 @@ class TestAdminViews(ApplicationLayerTest):
             ichigo.addContainedObject(note)
 
         # pylint: disable=no-member
+        PendingIntids().clear()
         testapp = TestApp(self.app)
         res = testapp.post('/dataserver2/metadata/reindexer',
                            json.dumps({'username': username,
@@ -151,8 +321,67 @@ class TestAdminViews(ApplicationLayerTest):
         assert_that(res.json_body,
                     has_entries('MimeTypeCount', has_entry('application/vnd.nextthought.note', 1),
                                 'Elapsed', is_not(none()),
+                                'Jobs', 1,
+                                'Coalesced', 0,
                                 'Total', greater_than_or_equal_to(1)))
 
+        res = testapp.post('/dataserver2/metadata/reindexer',
+                           json.dumps({'username': username,
+                                       'bulk': False}),
+                           extra_environ=self._make_extra_environ(),
+                           status=200)
+        assert_that(res.json_body,
+                    has_entries('MimeTypeCount', has_entry('application/vnd.nextthought.note', 1),
+                                'Total', greater_than_or_equal_to(1)))
+        assert_that(res.json_body, is_not(has_key('Jobs')))
+
+        res = testapp.post('/dataserver2/metadata/reindexer',
+                           json.dumps({'username': username,
+                                       'accept': 'application/vnd.nextthought.note'}),
+                           extra_environ=self._make_extra_environ(),
+                           status=200)
+        assert_that(res.json_body,
+                    has_entries('MimeTypeCount', is_({'application/vnd.nextthought.note': 1}),
+                                'Coalesced', 1,
+                                'Jobs', 0,
+                                'Total', 1))
+
+        res = testapp.post('/dataserver2/metadata/reindexer',
+                           json.dumps({'username': username,
+                                       'lane': 'interactive'}),
+                           extra_environ=self._make_extra_environ(),
+                           status=200)
+        assert_that(res.json_body, has_entries('Coalesced', 1))
+
+        testapp.post('/dataserver2/metadata/reindexer',
+                     json.dumps({'username': username,
+                                 'lane': 'urgent'}),
+                     extra_environ=self._make_extra_environ(),
+                     status=422)
+
+        res = testapp.post('/dataserver2/metadata/reindexer',
+                           json.dumps({'username': username,
+                                       'since': -3600}),
+                           extra_environ=self._make_extra_environ(),
+                           status=200)
+        assert_that(res.json_body,
+                    has_entries('MimeTypeCount', has_entry('application/vnd.nextthought.note', 1),
+                                'Since', is_not(none()),
+                                'Until', none()))
+
+        res = testapp.post('/dataserver2/metadata/reindexer',
+                           json.dumps({'username': username,
+                                       'until': 1}),
+                           extra_environ=self._make_extra_environ(),
+                           status=200)
+        assert_that(res.json_body, has_entries('Total', 0))
+
+        testapp.post('/dataserver2/metadata/reindexer',
+                     json.dumps({'username': username,
+                                 'since': 10, 'until': 5}),
+                     extra_environ=self._make_extra_environ(),
+                     status=422)
+
     @WithSharedApplicationMockDSHandleChanges(users=True, testapp=True)
     def test_rebuild_catalog(self):
         username = u'ichigo@bleach.com'
@@ -168,3 +397,257 @@ class TestAdminViews(ApplicationLayerTest):
                            status=200)
         assert_that(res.json_body,
                     has_entries('Total', greater_than_or_equal_to(2)))
+
+    @WithSharedApplicationMockDSHandleChanges(users=True, testapp=True)
+    def test_rebuild_catalog_batched(self):
+        username = u'ichigo@bleach.com'
+        with mock_dataserver.mock_db_trans(self.ds):
+            ichigo = self._create_user(username=username)
+            note = self._create_note(u'Kurosaki Ichigo', ichigo.username)
+            ichigo.addContainedObject(note)
+
+        # pylint: disable=no-member
+        testapp = TestApp(self.app)
+        testapp.post('/dataserver2/metadata/@@RebuildMetadataCatalog',
+                     json.dumps({'batchSize': -1}),
+                     extra_environ=self._make_extra_environ(),
+                     status=422)
+
+        # batched rebuilds are queued, to be run by a worker process
+        for options in ({'batchSize': 1}, {'resume': True}):
+            res = testapp.post('/dataserver2/metadata/@@RebuildMetadataCatalog',
+                               json.dumps(options),
+                               extra_environ=self._make_extra_environ(),
+                               status=200)
+            assert_that(res.json_body,
+                        has_entries('JobId', is_not(none()),
+                                    'Status', 'Pending'))
+
+        with mock_dataserver.mock_db_trans(self.ds):
+            count = rebuild_metadata_catalog(batch_size=1, resume=True)
+            assert_that(count, greater_than_or_equal_to(2))
+
+        with mock_dataserver.mock_db_trans(self.ds):
+            catalog = get_metadata_catalog()
+            assert_that(get_rebuild_cursor(catalog), is_(none()))
+            intids = component.getUtility(IIntIds)
+            doc_id = intids.queryId(note)
+            assert_that(doc_id, is_in(catalog['mimeType'].ids()))
+
+    @WithSharedApplicationMockDSHandleChanges(users=True, testapp=True)
+    def test_rebuild_catalog_swap(self):
+        username = u'ichigo@bleach.com'
+        with mock_dataserver.mock_db_trans(self.ds):
+            ichigo = self._create_user(username=username)
+            note = self._create_note(u'Kurosaki Ichigo', ichigo.username)
+            ichigo.addContainedObject(note)
+            intids = component.getUtility(IIntIds)
+            doc_id = intids.queryId(note)
+            catalog_oid = get_metadata_catalog()._p_oid
+
+        # pylint: disable=no-member
+        testapp = TestApp(self.app)
+        testapp.post('/dataserver2/metadata/@@RebuildMetadataCatalog',
+                     extra_environ=self._make_extra_environ(),
+                     status=200)
+
+        with mock_dataserver.mock_db_trans(self.ds):
+            catalog = get_metadata_catalog()
+            assert_that(catalog._p_oid, is_not(catalog_oid))
+            assert_that(doc_id, is_in(catalog['mimeType'].ids()))
+
+    @WithSharedApplicationMockDSHandleChanges(users=True, testapp=True)
+    def test_async_jobs(self):
+        username = u'ichigo@bleach.com'
+        with mock_dataserver.mock_db_trans(self.ds):
+            self._create_user(username=username)
+
+        # pylint: disable=no-member
+        testapp = TestApp(self.app)
+        res = testapp.post('/dataserver2/metadata/reindexer',
+                           json.dumps({'username': username,
+                                       'async': True}),
+                           extra_environ=self._make_extra_environ(),
+                           status=200)
+        assert_that(res.json_body,
+                    has_entries('JobId', is_not(none()),
+                                'Status', 'Pending'))
+        jobid = res.json_body['JobId']
+
+        res = testapp.get('/dataserver2/metadata/@@job_status/%s' % jobid,
+                          extra_environ=self._make_extra_environ(),
+                          status=200)
+        assert_that(res.json_body,
+                    has_entries('JobId', jobid,
+                                'Name', 'reindex',
+                                'Status', 'Pending'))
+
+        with mock_dataserver.mock_db_trans(self.ds):
+            run_admin_job(jobid, 'reindex', usernames=[username])
+
+        res = testapp.get('/dataserver2/metadata/@@job_status',
+                          {'jobId': jobid},
+                          extra_environ=self._make_extra_environ(),
+                          status=200)
+        assert_that(res.json_body,
+                    has_entries('Status', 'Success',
+                                'Elapsed', is_not(none()),
+                                'Result', has_entry('Total', greater_than_or_equal_to(0))))
+
+        testapp.get('/dataserver2/metadata/@@job_status/unknown',
+                    extra_environ=self._make_extra_environ(),
+                    status=404)
+
+        # an aborted request leaves no job nor status
+        with mock_dataserver.mock_db_trans(self.ds):
+            status = queue_admin_job('reindex', usernames=[username])
+            transaction.abort()
+        assert_that(status.get(), is_(none()))
+
+        # worker processes are only started by async jobs
+        for name in ('reindexer', 'check_indices'):
+            testapp.post('/dataserver2/metadata/' + name,
+                         json.dumps({'workers': 2}),
+                         extra_environ=self._make_extra_environ(),
+                         status=422)
+
+        res = testapp.post('/dataserver2/metadata/check_indices',
+                           json.dumps({'workers': 2, 'async': True}),
+                           extra_environ=self._make_extra_environ(),
+                           status=200)
+        res = testapp.get('/dataserver2/metadata/@@job_status',
+                          {'jobId': res.json_body['JobId']},
+                          extra_environ=self._make_extra_environ(),
+                          status=200)
+        assert_that(res.json_body,
+                    has_entries('Name', 'parallel_check_indices',
+                                'Status', 'Pending'))
+
+    @WithSharedApplicationMockDSHandleChanges(users=True, testapp=True)
+    def test_queue_jobs(self):
+        # pylint: disable=no-member
+        testapp = TestApp(self.app)
+        res = testapp.get('/dataserver2/metadata/@@jobs',
+                          extra_environ=self._make_extra_environ(),
+                          status=200)
+        assert_that(res.json_body,
+                    has_entries('Items', is_not(none()),
+                                'Queues', is_not(none()),
+                                'Total', greater_than_or_equal_to(0)))
+
+        res = testapp.get('/dataserver2/metadata/@@jobs',
+                          {'summary': True},
+                          extra_environ=self._make_extra_environ(),
+                          status=200)
+        assert_that(res.json_body,
+                    has_entries('Pending', greater_than_or_equal_to(0),
+                                'Coalesced', greater_than_or_equal_to(0)))
+        name = list(res.json_body['Items'])[0]
+        assert_that(res.json_body['Items'][name],
+                    has_entries('Depth', greater_than_or_equal_to(0),
+                                'FailedDepth', greater_than_or_equal_to(0)))
+
+        res = testapp.get('/dataserver2/metadata/@@jobs',
+                          {'queue': name, 'batchSize': 10},
+                          extra_environ=self._make_extra_environ(),
+                          status=200)
+        assert_that(res.json_body,
+                    has_entries('Queue', name,
+                                'NextCursor', 0))
+
+        testapp.get('/dataserver2/metadata/@@jobs',
+                    {'queue': 'unknown'},
+                    extra_environ=self._make_extra_environ(),
+                    status=404)
+
+        for size in (0, -1, 'x'):
+            testapp.get('/dataserver2/metadata/@@jobs',
+                        {'batchSize': size},
+                        extra_environ=self._make_extra_environ(),
+                        status=422)
+
+    @WithSharedApplicationMockDSHandleChanges(users=True, testapp=True)
+    def test_metrics(self):
+        # pylint: disable=no-member
+        testapp = TestApp(self.app)
+        res = testapp.get('/dataserver2/metadata/@@metrics',
+                          extra_environ=self._make_extra_environ(),
+                          status=200)
+        assert_that(res.json_body,
+                    has_entries('Processors', is_not(none()),
+                                'Queues', is_not(none())))
+
+        res = testapp.get('/dataserver2/metadata/@@metrics',
+                          {'format': 'prometheus'},
+                          extra_environ=self._make_extra_environ(),
+                          status=200)
+        assert_that(res.content_type, is_('text/plain'))
+
+    @WithSharedApplicationMockDSHandleChanges(users=True, testapp=True)
+    def test_empty_queues(self):
+        # pylint: disable=no-member
+        testapp = TestApp(self.app)
+        res = testapp.post('/dataserver2/metadata/@@empty_queues',
+                           json.dumps({'failedOnly': True, 'wait': True}),
+                           extra_environ=self._make_extra_environ(),
+                           status=200)
+        name = list(res.json_body['Queues'])[0]
+        assert_that(res.json_body['Queues'][name],
+                    has_entries('Jobs', 0,
+                                'FailedJobs', greater_than_or_equal_to(0),
+                                'Elapsed', greater_than_or_equal_to(0)))
+
+        pending = PendingIntids()
+        pending._redis().sadd(pending.key, 1, 2)
+        res = testapp.post('/dataserver2/metadata/@@empty_queues',
+                           json.dumps({'queues': [name]}),
+                           extra_environ=self._make_extra_environ(),
+                           status=200)
+        assert_that(res.json_body,
+                    has_entries('JobId', is_not(none()),
+                                'Queues', [name]))
+        # the jobs of the other queues may have them
+        assert_that(pending, has_length(2))
+
+        testapp.post('/dataserver2/metadata/@@empty_queues',
+                     json.dumps({'wait': True}),
+                     extra_environ=self._make_extra_environ(),
+                     status=200)
+        assert_that(pending, has_length(0))
+
+        testapp.post('/dataserver2/metadata/@@empty_queues',
+                     json.dumps({'queues': 'unknown'}),
+                     extra_environ=self._make_extra_environ(),
+                     status=422)
+
+    @WithSharedApplicationMockDSHandleChanges(users=True, testapp=True)
+    def test_failed_jobs(self):
+        # pylint: disable=no-member
+        testapp = TestApp(self.app)
+        res = testapp.get('/dataserver2/metadata/@@failed_jobs',
+                          {'sampleSize': 10},
+                          extra_environ=self._make_extra_environ(),
+                          status=200)
+        assert_that(res.json_body,
+                    has_entries('Queues', is_not(none()),
+                                'Errors', is_not(none()),
+                                'MimeTypes', is_not(none()),
+                                'Sampled', greater_than_or_equal_to(0)))
+
+        testapp.get('/dataserver2/metadata/@@failed_jobs',
+                    {'sampleSize': 'many'},
+                    extra_environ=self._make_extra_environ(),
+                    status=422)
+
+        res = testapp.post('/dataserver2/metadata/@@replay_failed_jobs',
+                           json.dumps({'rate': 10, 'lane': 'interactive'}),
+                           extra_environ=self._make_extra_environ(),
+                           status=200)
+        assert_that(res.json_body,
+                    has_entries('JobId', is_not(none()),
+                                'Status', 'Pending'))
+
+        testapp.post('/dataserver2/metadata/@@replay_failed_jobs',
+                     json.dumps({'rate': -1}),
+                     extra_environ=self._make_extra_environ(),
+                     status=422)
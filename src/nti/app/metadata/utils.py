@@ -8,12 +8,25 @@ from __future__ import division
 from __future__ import print_function
 from __future__ import absolute_import
 
+import json
+import time
+import heapq
+import hashlib
+import functools
+from itertools import islice
+
+import BTrees
+
 try:
     from BTrees.check import check as btree_check
 except ImportError:
     def btree_check(unused_item):
         pass
 
+from persistent import Persistent
+
+from persistent.list import PersistentList
+
 from zope import component
 
 from zope.index.topic import TopicIndex
@@ -24,17 +37,33 @@ from zope.intid.interfaces import IIntIds
 
 from zc.catalog.index import NormalizationWrapper
 
+from zc.catalog.interfaces import IValueIndex
 from zc.catalog.interfaces import IIndexValues
 
 from zope.mimetype.interfaces import IContentTypeAware
 
 from ZODB.POSException import POSError
 
+from nti.app.metadata.parallel import partition_ids
+from nti.app.metadata.parallel import run_partitions
+from nti.app.metadata.parallel import commit_in_batches
+
+from nti.dataserver.interfaces import IUser
+
+from nti.dataserver.metadata.index import IX_CREATOR
+from nti.dataserver.metadata.index import IX_MIMETYPE
+from nti.dataserver.metadata.index import IX_CREATEDTIME
+from nti.dataserver.metadata.index import IX_LASTMODIFIED
+
+from nti.dataserver.metadata.index import get_metadata_catalog
+
 from nti.dataserver.metadata.utils import queryId
 from nti.dataserver.metadata.utils import get_principal_metadata_objects
 
 from nti.externalization.interfaces import LocatedExternalDict
 
+from nti.metadata import metadata_catalogs
+
 from nti.externalization.oids import to_external_oid
 
 from nti.zope_catalog.catalog import isBroken
@@ -43,6 +72,33 @@ from nti.zope_catalog.interfaces import IFieldIndex
 from nti.zope_catalog.interfaces import IKeywordIndex
 from nti.zope_catalog.interfaces import IMetadataCatalog
 
+#: Number of doc ids checked per transaction by the parallel checker
+CHECK_BATCH_SIZE = 1000
+
+#: Default number of already verified doc ids rechecked per catalog by
+#: an incremental check
+DEFAULT_SAMPLE_SIZE = 10000
+
+#: Default seconds after which an incremental check sweeps all the doc
+#: ids of a catalog again
+DEFAULT_MAX_SWEEP_AGE = 7 * 24 * 3600
+
+#: Number of verified ranges kept in the history of a catalog
+CHECK_HISTORY_SIZE = 100
+
+#: Database root key of the incremental check state of the catalogs
+CHECK_STATE_KEY = 'nti.app.metadata.check_state'
+
+MISSING = u'Missing'
+BROKEN = u'Broken'
+
+#: Structural check work unit of the top-level BTrees of an index
+STRUCTURE_TREES = ('trees',)
+
+#: Kind of the structural check work units of a key range of the tree
+#: sets in the ``values_to_documents`` BTree of an index
+STRUCTURE_VALUES = 'values'
+
 logger = __import__('logging').getLogger(__name__)
 
 
@@ -58,9 +114,129 @@ def get_mime_type(obj, default='unknown'):
     return str(result) if result else default
 
 
-def principal_metadata_objects(principal, accept=(), intids=None):
+def resolve_timestamp(value, now=None):
+    """
+    Return the given time as a timestamp; a negative value is taken as
+    relative to now.
+
+    :raises ValueError: If the value is not a number.
+    """
+    if value is None or value == '':
+        return None
+    value = float(value)
+    if value < 0:
+        value += time.time() if now is None else now
+    return value
+
+
+def _time_range(since=None, until=None):
+    return (since or 0, time.time() + 1 if until is None else until)
+
+
+def in_window(obj, since=None, until=None):
+    """
+    Return whether the given object was created or last modified
+    between ``since`` and ``until``.
+    """
+    low, high = _time_range(since, until)
+    for name in ('lastModified', 'createdTime'):
+        value = getattr(obj, name, None) or 0
+        if low <= value <= high:
+            return True
+    return False
+
+
+def window_doc_ids(since=None, until=None, catalog=None):
+    """
+    Return the doc ids of the objects created or last modified between
+    ``since`` and ``until``, as answered by the time indexes of the
+    metadata catalog, or None if the catalog cannot answer.
+    """
+    catalog = get_metadata_catalog() if catalog is None else catalog
+    if catalog is None or IX_LASTMODIFIED not in catalog:
+        return None
+    query = {'between': _time_range(since, until)}
+    family = getattr(catalog, 'family', BTrees.family64)
+    try:
+        result = catalog[IX_LASTMODIFIED].apply(query)
+        if IX_CREATEDTIME in catalog:
+            result = family.IF.union(result,
+                                     catalog[IX_CREATEDTIME].apply(query))
+    except (POSError, TypeError, ValueError) as e:
+        logger.error('Error %s while querying objects in time window', e)
+        return None
+    return result
+
+
+def principal_catalog_doc_ids(principal, mime_type=None, catalog=None):
+    """
+    Return the doc ids of the objects, with the given mime type if any,
+    created by the given user, as answered by the metadata catalog, or
+    None if the catalog cannot answer.
+    """
+    catalog = get_metadata_catalog() if catalog is None else catalog
+    username = getattr(principal, 'username', None)
+    if catalog is None or not username or IX_CREATOR not in catalog:
+        return None
+    query = {
+        IX_CREATOR: {'any_of': (username.lower(),)},
+    }
+    if mime_type is not None:
+        if IX_MIMETYPE not in catalog:
+            return None
+        query[IX_MIMETYPE] = {'any_of': (mime_type,)}
+    try:
+        return catalog.apply(query)
+    except (POSError, TypeError) as e:
+        logger.error('Error %s while querying objects of %s', e, username)
+        return None
+
+
+def _catalog_principal_doc_ids(principal, accept, since=None, until=None):
+    catalog = get_metadata_catalog()
+    window = None
+    if since is not None or until is not None:
+        window = window_doc_ids(since, until, catalog)
+        if window is None:
+            return None
+    family = getattr(catalog, 'family', BTrees.family64)
+    sources = []
+    for mime_type in sorted(accept) or (None,):
+        doc_ids = principal_catalog_doc_ids(principal, mime_type, catalog)
+        if doc_ids is None:
+            return None
+        if window is not None:
+            doc_ids = family.IF.intersection(doc_ids, window)
+        sources.append((mime_type, doc_ids))
+    return sources
+
+
+def principal_metadata_objects(principal, accept=(), intids=None, use_catalog=True,
+                               since=None, until=None):
+    """
+    Yield the intid, mime type and object of the metadata objects of the
+    given principal.
+
+    When there are mime types to ``accept`` or a ``since``/``until``
+    time window and the principal is a user, the matching intids are
+    taken from the creator, mime type and time indexes of the metadata
+    catalog, so that non-matching objects are never loaded.
+    """
     intids = component.getUtility(IIntIds) if intids is None else intids
+    sources = None
+    window = since is not None or until is not None
+    if (accept or window) and use_catalog and IUser.providedBy(principal):
+        sources = _catalog_principal_doc_ids(principal, accept, since, until)
+    if sources is not None:
+        for mime_type, doc_ids in sources:
+            for iid in doc_ids or ():
+                obj = intids.queryObject(iid)
+                if obj is not None:
+                    yield iid, mime_type or get_mime_type(obj), obj
+        return
     for obj in get_principal_metadata_objects(principal):
+        if window and not in_window(obj, since, until):
+            continue
         mime_type = get_mime_type(obj)
         if accept and mime_type not in accept:
             continue
@@ -69,6 +245,160 @@ def principal_metadata_objects(principal, accept=(), intids=None):
             yield iid, mime_type, obj
 
 
+def _index_generation(index):
+    """
+    Return a value that changes with every write of the given index.
+
+    Neither the index, nor its trees and counters, are modified when a
+    document only changes mime type: a bucket of its trees is. So this
+    is the last transaction of the database, read before the index.
+    """
+    jar = getattr(index, '_p_jar', None)
+    if jar is None:
+        # not persistent, never the same
+        return object()
+    return jar.db().lastTransaction()
+
+
+class MimeTypeRegistry(object):
+    """
+    A per-process cache of the distinct mime types in each metadata
+    catalog and, only once asked for, of the number of documents of
+    each one.
+
+    The entry of a catalog is kept for at least ``min_age`` seconds.
+    After that it is recomputed if the database changed since it was,
+    the counts only once asked for. The ETag is a digest of the
+    returned values.
+    """
+
+    min_age = 60
+
+    def __init__(self):
+        self.invalidate()
+
+    def invalidate(self):
+        self.entries = {}
+
+    @staticmethod
+    def _indexes():
+        for catalog in metadata_catalogs():
+            index = catalog.get(IX_MIMETYPE)
+            if IValueIndex.providedBy(index):
+                yield catalog, index
+
+    def _entry(self, catalog, index, counts, now):
+        # catalogs of different sites may share a name
+        key = (_catalog_key(catalog),
+               getattr(catalog, '_p_oid', None) or id(catalog))
+        entry = self.entries.get(key)
+        if entry is None or now - entry['Updated'] >= self.min_age:
+            generation = _index_generation(index)
+            if entry is None or entry['Generation'] != generation:
+                entry = {
+                    'Counts': None,
+                    'Generation': generation,
+                    'MimeTypes': tuple(index.values_to_documents.keys()),
+                }
+                self.entries[key] = entry
+            entry['Updated'] = now
+        if counts and entry['Counts'] is None:
+            # this loads every tree set of the index
+            btree = index.values_to_documents
+            entry['Counts'] = {x: len(btree[x]) for x in entry['MimeTypes']}
+        return entry
+
+    def get_mime_types(self, counts=False):
+        """
+        Return an ETag and either the sorted mime types of the metadata
+        catalogs of the current site or, with ``counts``, their number
+        of documents.
+        """
+        now = time.time()
+        result = {}
+        for catalog, index in self._indexes():
+            entry = self._entry(catalog, index, counts, now)
+            if counts:
+                for mime_type, count in entry['Counts'].items():
+                    result[mime_type] = result.get(mime_type, 0) + count
+            else:
+                result.update(dict.fromkeys(entry['MimeTypes']))
+        result = result if counts else sorted(result)
+        key = (counts, sorted(result.items()) if counts else result)
+        etag = hashlib.md5(repr(key).encode('utf-8')).hexdigest()
+        return etag, result
+
+mime_type_registry = MimeTypeRegistry()
+
+
+def _index_ids(index, low=None, high=None):
+    """
+    Return the (sorted) doc ids of the given value, field or keyword
+    index in the inclusive ``(low, high)`` range.
+    """
+    if low is None and high is None:
+        return index.ids()
+    # the doc id to value trees of zc.catalog and zope.index
+    for name in ('documents_to_values', '_rev_index'):
+        tree = getattr(index, name, None)
+        if tree is not None:
+            return tree.keys(low, high)
+    return [x for x in index.ids()
+            if (low is None or x >= low) and (high is None or x <= high)]
+
+
+def _catalog_id_sets(catalog, low=None, high=None):
+    """
+    Yield the name and the (sorted) doc ids of each index in the given
+    catalog, optionally in the inclusive ``(low, high)`` range.
+    """
+    for name, index in catalog.items():
+        if isinstance(index, NormalizationWrapper):
+            index = index.index
+        try:
+            if IIndexValues.providedBy(index) or IFieldIndex.providedBy(index):
+                yield name, _index_ids(index, low, high)
+            elif IKeywordIndex.providedBy(index):
+                yield name, _index_ids(index, low, high)
+            elif isinstance(index, TopicIndex):
+                # pylint: disable=protected-access
+                for filter_index in index._filters.values():
+                    if ITopicFilteredSet.providedBy(filter_index):
+                        yield name, filter_index.getIds().keys(low, high)
+        except (POSError, TypeError) as e:
+            logger.error('Error %s while getting ids from index "%s" (%s)',
+                         e, name, index)
+
+
+def get_catalog_doc_ids(catalog, low=None, high=None):
+    """
+    Return a ``BTrees`` set with the doc ids of all the indexes in the
+    given catalog, optionally in the inclusive ``(low, high)`` range.
+    """
+    family = getattr(catalog, 'family', BTrees.family64)
+    sets = []
+    for name, ids in _catalog_id_sets(catalog, low, high):
+        try:
+            sets.append(family.IF.multiunion([ids]))
+        except (POSError, TypeError) as e:
+            logger.error('Error %s while getting ids from index "%s"',
+                         e, name)
+    return family.IF.multiunion(sets)
+
+
+def iter_catalog_doc_ids(catalog):
+    """
+    Iterate over the doc ids of all the indexes in the given catalog in
+    ascending order, without collecting them first.
+    """
+    last = None
+    sources = [iter(ids) for _, ids in _catalog_id_sets(catalog)]
+    for doc_id in heapq.merge(*sources):
+        if doc_id != last:
+            yield doc_id
+        last = doc_id
+
+
 def _set_library_catalog(catalogs):
     try:
         from nti.contentlibrary.indexed_data import get_library_catalog
@@ -79,77 +409,202 @@ def _set_library_catalog(catalogs):
         pass
 
 
+def get_catalogs(catalog_interface=IMetadataCatalog):
+    catalogs = list(component.getAllUtilitiesRegisteredFor(catalog_interface))
+    _set_library_catalog(catalogs)
+    return catalogs
+
+
+def get_catalogs_doc_ids(catalogs, family=BTrees.family64, low=None, high=None):
+    return family.IF.multiunion([get_catalog_doc_ids(x, low, high)
+                                 for x in catalogs])
+
+
+def _unindex(catalogs, docid):
+    for catalog in catalogs:
+        catalog.unindex_doc(docid)
+
+
+def check_doc_id(uid, intids, test_broken=False):
+    """
+    Return ``None`` if the given doc id is valid, else a tuple with the
+    problem (``MISSING`` or ``BROKEN``) and the type of the object.
+    """
+    obj = None
+    try:
+        obj = intids.queryObject(uid)
+        if obj is None:
+            return MISSING, None
+        if test_broken and isBroken(obj):
+            return BROKEN, str(type(obj))
+    except (POSError, TypeError):
+        return BROKEN, str(type(obj))
+    except (AttributeError):
+        pass
+    return None
+
+
+def _process_ids(catalogs, docids, missing, broken, seen, intids,
+                 test_broken=False):
+    result = set()
+    for uid in docids:
+        if uid in seen:
+            continue
+        seen.add(uid)
+        problem = check_doc_id(uid, intids, test_broken)
+        if problem is None:
+            continue
+        result.add(uid)
+        kind, type_name = problem
+        try:
+            _unindex(catalogs, uid)
+        except (POSError, TypeError):
+            kind = BROKEN
+        if kind == MISSING:
+            missing.add(uid)
+        else:
+            broken[uid] = type_name or str(type(None))
+    return result
+
+
+def find_missing_ids(doc_ids, intids):
+    """
+    Return the given doc ids that are not registered in the intid
+    utility, computed as the set difference with the keys of its
+    ``refs`` BTree. No object is loaded.
+    """
+    family = intids.family
+    doc_ids = family.IO.TreeSet(doc_ids)
+    return family.IO.difference(doc_ids, intids.refs)
+
+
+def _process_missing_ids(catalogs, docids, missing, seen, intids):
+    docids = [x for x in docids if x not in seen]
+    seen.update(docids)
+    result = find_missing_ids(docids, intids)
+    for uid in result:
+        _unindex(catalogs, uid)
+        missing.add(uid)
+    return result
+
+
+def _check_ids(catalogs, docids, missing, broken, seen, intids,
+               test_broken=False):
+    # objects are only loaded to test if they are broken
+    if test_broken or getattr(intids, 'refs', None) is None:
+        return _process_ids(catalogs, docids, missing, broken, seen,
+                            intids, test_broken)
+    return _process_missing_ids(catalogs, docids, missing, seen, intids)
+
+
+def new_structure_stats():
+    return {'Checked': 0, 'Corrupt': []}
+
+
+def check_structure(obj):
+    """
+    Run the internal consistency checks of the given BTree or tree set.
+
+    :return: None or a description of the error found.
+    """
+    try:
+        if hasattr(obj, '_check'):
+            obj._check()  # pylint: disable=protected-access
+        btree_check(obj)
+    except Exception as e:  # pylint: disable=broad-except
+        return repr(e)
+    return None
+
+
+def check_structures(catalog_name, index_name, index, unit, stats):
+    """
+    Check the structures of an index for the given work unit, either
+    :data:`STRUCTURE_TREES` or a ``(STRUCTURE_VALUES, min, max)`` key
+    range of its ``values_to_documents`` BTree, adding the counts and
+    the corrupt structures found to ``stats``.
+    """
+    index = getattr(index, 'index', index)
+
+    def _check(structure, obj, key=None):
+        stats['Checked'] += 1
+        error = check_structure(obj)
+        if error is None:
+            return
+        record = {
+            'Catalog': catalog_name,
+            'Index': index_name,
+            'Structure': structure,
+            'OID': to_external_oid(obj),
+            'Error': error,
+        }
+        if key is not None:
+            record['Key'] = repr(key)
+        stats['Corrupt'].append(record)
+
+    if unit[0] == STRUCTURE_VALUES:
+        btree = getattr(index, 'values_to_documents', None)
+        if btree is not None:
+            _, low, high = unit
+            for key, value in btree.items(low, high):
+                if hasattr(value, '_check'):
+                    _check('values_to_documents', value, key)
+        return
+    for structure in ('documents_to_values', 'values_to_documents'):
+        btree = getattr(index, structure, None)
+        if btree is not None:
+            _check(structure, btree)
+
+
+def _log_structures(stats):
+    logger.info("%s structure(s) checked, %s corrupt",
+                stats['Checked'], len(stats['Corrupt']))
+    for record in stats['Corrupt']:
+        logger.error("Corrupt %s of index %s in %s (%s): %s",
+                     record['Structure'], record['Index'],
+                     record['Catalog'], record['OID'], record['Error'])
+
+
+def iter_structure_units(catalogs, inspect_treesets=False, ranges=1):
+    """
+    Yield the ``(catalog name, index name, unit)`` work units of the
+    structural checks of the given catalogs, with the tree sets of each
+    index split in up to ``ranges`` key ranges.
+    """
+    for catalog in catalogs:
+        catalog_name = _catalog_key(catalog)
+        for name, index in catalog.items():
+            if isinstance(index, NormalizationWrapper):
+                index = index.index
+            if not any(iface.providedBy(index)
+                       for iface in (IIndexValues, IFieldIndex, IKeywordIndex)):
+                continue
+            yield catalog_name, name, STRUCTURE_TREES
+            index = getattr(index, 'index', index)
+            btree = getattr(index, 'values_to_documents', None)
+            if inspect_treesets and btree is not None:
+                for low, high in partition_ids(btree.keys(), ranges):
+                    yield catalog_name, name, (STRUCTURE_VALUES, low, high)
+
+
 def check_indices(catalog_interface=IMetadataCatalog, intids=None,
-                  test_broken=False, inspect_btrees=False, inspect_treesets=False):
+                  test_broken=False, inspect_btrees=False, inspect_treesets=False,
+                  report=None):
     seen = set()
     broken = dict()
+    structures = new_structure_stats()
     result = LocatedExternalDict()
     missing = result['Missing'] = set()
     intids = component.getUtility(IIntIds) if intids is None else intids
 
     # get all catalogs
-    catalogs = list(component.getAllUtilitiesRegisteredFor(catalog_interface))
-    _set_library_catalog(catalogs)
-
-    def _unindex(catalogs, docid):
-        for catalog in catalogs:
-            catalog.unindex_doc(docid)
+    catalogs = get_catalogs(catalog_interface)
 
-    def _process_ids(catalogs, docids, missing, broken, seen):
-        result = set()
-        for uid in docids:
-            if uid in seen:
-                continue
-            seen.add(uid)
-            try:
-                obj = intids.queryObject(uid)
-                if obj is None:
-                    result.add(uid)
-                    _unindex(catalogs, uid)
-                    missing.add(uid)
-                elif test_broken and isBroken(obj):
-                    result.add(uid)
-                    _unindex(catalogs, uid)
-                    broken[uid] = str(type(obj))
-            except (POSError, TypeError):
-                result.add(uid)
-                _unindex(catalogs, uid)
-                broken[uid] = str(type(obj))
-            except (AttributeError):
-                pass
-        return result
-
-    def _check_btree(name, item):
-        logger.info("---------> %s, %s", name,
-                    to_external_oid(item) or '')
-        if hasattr(item, "_check"):
-            item._check()  # pylint: disable=protected-access
-        btree_check(item)
-
-    def _check_values_to_documents(name, btree):
-        _check_btree(name, btree)
+    def _check_btrees(catalog, name, index):
+        key = _catalog_key(catalog)
+        check_structures(key, name, index, STRUCTURE_TREES, structures)
         if inspect_treesets:
-            for key in btree.keys():
-                logger.info("\t---> %r, %s", key,
-                            to_external_oid(key) or '')
-                value = btree[key]
-                if hasattr(value, "_check"):
-                    value._check()  # pylint: disable=protected-access
-                btree_check(value)
-
-    def _check_btrees(name, index):
-        logger.info("---> Checking %s, %s", name, index.__class__)
-        index = getattr(index, 'index', index)
-        try:
-            btree = getattr(index, 'documents_to_values', None)
-            if btree is not None:
-                _check_btree('documents_to_values', btree)
-            btree = getattr(index, 'values_to_documents', None)
-            if btree is not None:
-                _check_values_to_documents('values_to_documents', btree)
-        except Exception as e:
-            logger.exception(e)
-            raise e
+            check_structures(key, name, index, (STRUCTURE_VALUES, None, None),
+                             structures)
 
     def _process_catalog(catalog):
         logger.info("Processing %s-[%s]",
@@ -161,19 +616,21 @@ def check_indices(catalog_interface=IMetadataCatalog, intids=None,
             try:
                 if IIndexValues.providedBy(index) or IFieldIndex.providedBy(index):
                     if inspect_btrees:
-                        _check_btrees(name, index)
+                        _check_btrees(catalog, name, index)
                     docids = list(index.ids())
-                    processed = _process_ids(catalogs, docids,
-                                             missing, broken, seen)
+                    processed = _check_ids(catalogs, docids,
+                                           missing, broken, seen,
+                                           intids, test_broken)
                     if processed:
                         logger.info("%s record(s) unindexed. Source %s,%s",
                                     len(processed), name, catalog)
                 elif IKeywordIndex.providedBy(index):
                     if inspect_btrees:
-                        _check_btrees(name, index)
+                        _check_btrees(catalog, name, index)
                     docids = list(index.ids())
-                    processed = _process_ids(catalogs, docids,
-                                             missing, broken, seen)
+                    processed = _check_ids(catalogs, docids,
+                                           missing, broken, seen,
+                                           intids, test_broken)
                     if processed:
                         logger.info("%s record(s) unindexed. Source %s,%s",
                                     len(processed), name, catalog)
@@ -182,8 +639,9 @@ def check_indices(catalog_interface=IMetadataCatalog, intids=None,
                     for filter_index in index._filters.values():
                         if ITopicFilteredSet.providedBy(filter_index):
                             docids = list(filter_index.getIds())
-                            processed = _process_ids(catalogs, docids,
-                                                     missing, broken, seen)
+                            processed = _check_ids(catalogs, docids,
+                                                   missing, broken, seen,
+                                                   intids, test_broken)
                             if processed:
                                 logger.info("%s record(s) unindexed. Source %s,%s",
                                             len(processed), name, catalog)
@@ -193,11 +651,370 @@ def check_indices(catalog_interface=IMetadataCatalog, intids=None,
 
     for catalog in catalogs:
         _process_catalog(catalog)
+        if report is not None:
+            report(len(seen))
+
+    result['Missing'] = sorted(missing)
+    result['TotalIndexed'] = len(seen)
+    result['TotalMissing'] = len(missing)
+    if test_broken:
+        result['Broken'] = broken
+        result['TotalBroken'] = len(broken)
+    if inspect_btrees:
+        result['Structures'] = structures
+        _log_structures(structures)
+    return result
+
+
+class CheckState(Persistent):
+    """
+    Persistent state of the incremental checks of a catalog.
+
+    Doc ids up to the ``high`` water mark have been verified at least
+    once. Each incremental check also rechecks a sample of them starting
+    at ``cursor``, which wraps around once all of them were sampled.
+    Since intids are not always allocated in order, ids added below the
+    mark are only found by the sample or by a full sweep, whose time is
+    ``last_full_sweep``. The verified ranges are kept in ``history`` as
+    ``(min, max, timestamp, kind)`` tuples.
+    """
+
+    high = None
+    cursor = None
+    last_full_sweep = None
+
+    def __init__(self):
+        self.history = PersistentList()
+
+    def record(self, low, high, kind, now=None):
+        if low is None:
+            return
+        self.history.append((low, high, now or time.time(), kind))
+        if len(self.history) > CHECK_HISTORY_SIZE:
+            del self.history[:-CHECK_HISTORY_SIZE]
+
+
+def database_root(obj):
+    jar = getattr(obj, '_p_jar', None)
+    return jar.root() if jar is not None else None
+
+
+def _catalog_key(catalog):
+    return getattr(catalog, '__name__', None) or catalog.__class__.__name__
+
+
+def _catalog_path(catalog):
+    """
+    Return the path of the given catalog from the root, which includes
+    its site, since catalogs of different sites may share a name.
+    """
+    names = []
+    obj = getattr(catalog, '__parent__', None)
+    while obj is not None:
+        name = getattr(obj, '__name__', None)
+        if name:
+            names.append(name)
+        obj = getattr(obj, '__parent__', None)
+    names.reverse()
+    names.append(_catalog_key(catalog))
+    return u'/'.join(names)
+
+
+def get_check_state(catalog, create=False):
+    root = database_root(catalog)
+    if root is None:
+        return CheckState() if create else None
+    states = root.get(CHECK_STATE_KEY)
+    if states is None:
+        if not create:
+            return None
+        states = root[CHECK_STATE_KEY] = BTrees.OOBTree.OOBTree()
+    key = _catalog_path(catalog)
+    result = states.get(key)
+    if result is None and create:
+        result = states[key] = CheckState()
+    return result
 
+
+def _range(ids):
+    return (ids[0], ids[-1]) if ids else (None, None)
+
+
+def _sweep_due(state, now, max_sweep_age):
+    if state.last_full_sweep is None:
+        return True
+    if max_sweep_age is None:
+        return False
+    return now - state.last_full_sweep >= max_sweep_age
+
+
+def incremental_check_indices(catalog_interface=IMetadataCatalog, intids=None,
+                              test_broken=False, sample_size=DEFAULT_SAMPLE_SIZE,
+                              full=False, report=None,
+                              max_sweep_age=DEFAULT_MAX_SWEEP_AGE):
+    """
+    Check the doc ids of the catalogs added since the last check plus a
+    rotating sample of ``sample_size`` of the ones already verified,
+    unindexing missing and broken objects. All the doc ids of a catalog
+    are checked with ``full``, on its first check and once its last
+    full sweep is older than ``max_sweep_age`` seconds (if not None).
+
+    The high-water mark, sample cursor and verified ranges of each
+    catalog are persisted. The result reports the coverage.
+    """
+    seen = set()
+    broken = dict()
+    missing = set()
+    coverage = dict()
+    now = time.time()
+    result = LocatedExternalDict()
+    intids = component.getUtility(IIntIds) if intids is None else intids
+    catalogs = get_catalogs(catalog_interface)
+    for catalog in catalogs:
+        state = get_check_state(catalog, create=True)
+        doc_ids = get_catalog_doc_ids(catalog)
+        if not doc_ids:
+            continue
+        sweep = full or _sweep_due(state, now, max_sweep_age)
+        if sweep:
+            new, sample = list(doc_ids), []
+        else:
+            new = list(doc_ids.keys(state.high, excludemin=True))
+            if state.cursor is None:
+                old = doc_ids.keys(None, state.high)
+            else:
+                old = doc_ids.keys(state.cursor, state.high, excludemin=True)
+            sample = list(islice(old, sample_size))
+        for ids in (new, sample):
+            _check_ids(catalogs, ids, missing, broken, seen,
+                       intids, test_broken)
+        # advance the high-water mark and the sample cursor
+        verified = doc_ids.maxKey()
+        if sweep:
+            state.cursor = None
+            state.last_full_sweep = now
+        elif len(sample) < sample_size:
+            state.cursor = None
+        elif sample:
+            state.cursor = sample[-1]
+        kind = 'full' if sweep else 'new'
+        state.record(*_range(new), kind=kind, now=now)
+        state.record(*_range(sample), kind='sample', now=now)
+        state.high = verified
+        pending = 0
+        if state.cursor is not None:
+            pending = len(doc_ids.keys(state.cursor, state.high,
+                                       excludemin=True))
+        coverage[_catalog_path(catalog)] = {
+            'Total': len(doc_ids),
+            'New': len(new),
+            'Sampled': len(sample),
+            'FullSweep': sweep,
+            'HighWaterMark': state.high,
+            'SampleCursor': state.cursor,
+            'LastFullSweep': state.last_full_sweep,
+            'PendingSweep': pending,
+        }
+        if report is not None:
+            report(len(seen))
+
+    total = sum(x['Total'] for x in coverage.values())
+    checked = sum(x['New'] + x['Sampled'] for x in coverage.values())
     result['Missing'] = sorted(missing)
     result['TotalIndexed'] = len(seen)
     result['TotalMissing'] = len(missing)
+    result['Coverage'] = coverage
+    result['CoverageRatio'] = checked / total if total else 1
+    if test_broken:
+        result['Broken'] = broken
+        result['TotalBroken'] = len(broken)
+    return result
+
+
+def check_partition(partition, report=None, catalog_interface=IMetadataCatalog,
+                    test_broken=False, batch_size=CHECK_BATCH_SIZE):
+    """
+    Check the doc ids of the given catalogs in the given inclusive
+    ``(min, max)`` range, unindexing missing and broken objects.
+
+    This is meant to run in a worker process with its own connection.
+    """
+    intids = component.getUtility(IIntIds)
+    catalogs = get_catalogs(catalog_interface)
+    low, high = partition
+    # only the ids of the range are read from each index
+    doc_ids = get_catalogs_doc_ids(catalogs, intids.family, low, high)
+    missing = set()
+    broken = dict()
+
+    def check_batch(batch):
+        _check_ids(catalogs, batch, missing, broken, set(),
+                   intids, test_broken)
+        return len(batch)
+    total = commit_in_batches(doc_ids, batch_size, check_batch,
+                              report=report)
+    return {
+        'Missing': sorted(missing),
+        'Broken': broken,
+        'TotalIndexed': total,
+    }
+
+
+def parallel_check_indices(runner, workers=2, catalog_interface=IMetadataCatalog,
+                           test_broken=False, intids=None):
+    """
+    Check the indices with worker processes that each check an intid
+    range of the doc ids in all catalogs. The results are merged into
+    the same shape :func:`check_indices` returns.
+
+    :param runner: A picklable callable that runs a function with its
+        own database connection in the worker process, e.g.
+        :class:`nti.app.metadata.parallel.DataserverRunner`
+    """
+    intids = component.getUtility(IIntIds) if intids is None else intids
+    catalogs = get_catalogs(catalog_interface)
+    doc_ids = get_catalogs_doc_ids(catalogs, intids.family)
+    target = functools.partial(check_partition,
+                               test_broken=test_broken,
+                               catalog_interface=catalog_interface)
+    stats = run_partitions(target, partition_ids(doc_ids, workers),
+                           runner, workers)
+    total = 0
+    failed = []
+    broken = dict()
+    missing = set()
+    for _, stat in sorted(stats.items()):
+        if stat['Status'] != 'done':
+            failed.append(stat['Partition'])
+            continue
+        value = stat['Result']
+        broken.update(value['Broken'])
+        missing.update(value['Missing'])
+        total += value['TotalIndexed']
+    result = LocatedExternalDict()
+    result['Missing'] = sorted(missing)
+    result['TotalIndexed'] = total
+    result['TotalMissing'] = len(missing)
     if test_broken:
         result['Broken'] = broken
         result['TotalBroken'] = len(broken)
+    if failed:
+        result['FailedPartitions'] = failed
     return result
+
+
+def check_structures_partition(partition, report=None,
+                               catalog_interface=IMetadataCatalog):
+    """
+    Check the structures of the given work units of
+    :func:`iter_structure_units`.
+
+    This is meant to run in a worker process with its own connection.
+    """
+    stats = new_structure_stats()
+    catalogs = {_catalog_key(x): x for x in get_catalogs(catalog_interface)}
+    for catalog_name, index_name, unit in partition:
+        catalog = catalogs.get(catalog_name)
+        index = catalog.get(index_name) if catalog is not None else None
+        if index is None:
+            continue
+        if isinstance(index, NormalizationWrapper):
+            index = index.index
+        check_structures(catalog_name, index_name, index, unit, stats)
+        jar = getattr(catalog, '_p_jar', None)
+        if jar is not None:
+            jar.cacheGC()
+        if report is not None:
+            report(stats['Checked'])
+    return stats
+
+
+def parallel_check_structures(runner, workers=2, catalog_interface=IMetadataCatalog,
+                              inspect_treesets=False):
+    """
+    Check the BTrees of the indices with worker processes. The
+    structures of each index, and the key ranges of its tree sets, are
+    dealt among the workers.
+
+    :param runner: A picklable callable that runs a function with its
+        own database connection in the worker process, e.g.
+        :class:`nti.app.metadata.parallel.DataserverRunner`
+    :return: The number of structures checked and the corrupt ones.
+    """
+    catalogs = get_catalogs(catalog_interface)
+    units = list(iter_structure_units(catalogs, inspect_treesets, workers))
+    workers = max(1, min(workers, len(units)))
+    partitions = [tuple(units[idx::workers])
+                  for idx in range(workers)] if units else []
+    target = functools.partial(check_structures_partition,
+                               catalog_interface=catalog_interface)
+    stats = run_partitions(target, partitions, runner, workers)
+    failed = []
+    result = new_structure_stats()
+    for index, stat in sorted(stats.items()):
+        if stat['Status'] != 'done':
+            failed.append(index)
+            continue
+        value = stat['Result']
+        result['Checked'] += value['Checked']
+        result['Corrupt'].extend(value['Corrupt'])
+    if failed:
+        result['FailedPartitions'] = failed
+    _log_structures(result)
+    return result
+
+
+def iter_index_problems(catalog_interface=IMetadataCatalog, intids=None,
+                        test_broken=False, dry_run=True, stats=None,
+                        batch_size=CHECK_BATCH_SIZE):
+    """
+    Yield a record for each missing or broken doc id of the catalogs,
+    reading the doc ids in batches so memory does not grow with the
+    number of problems. With ``dry_run`` nothing is unindexed, so it can
+    run against a read-only database.
+
+    :param stats: An optional dictionary updated with the totals.
+    """
+    stats = dict() if stats is None else stats
+    stats.update(TotalIndexed=0, TotalMissing=0, TotalBroken=0)
+    intids = component.getUtility(IIntIds) if intids is None else intids
+    catalogs = get_catalogs(catalog_interface)
+    doc_ids = iter(get_catalogs_doc_ids(catalogs, intids.family))
+    fast = not test_broken and getattr(intids, 'refs', None) is not None
+    while True:
+        batch = list(islice(doc_ids, batch_size))
+        if not batch:
+            break
+        stats['TotalIndexed'] += len(batch)
+        if fast:
+            problems = ((x, (MISSING, None))
+                        for x in find_missing_ids(batch, intids))
+        else:
+            problems = ((x, check_doc_id(x, intids, test_broken))
+                        for x in batch)
+        for uid, problem in problems:
+            if problem is None:
+                continue
+            kind, type_name = problem
+            if not dry_run:
+                _unindex(catalogs, uid)
+            stats['Total' + kind] += 1
+            yield {'DocId': uid, 'Problem': kind, 'Type': type_name}
+        jar = getattr(intids, '_p_jar', None)
+        if jar is not None:
+            jar.cacheGC()
+
+
+def write_index_problems(fp, **kwargs):
+    """
+    Write the records of :func:`iter_index_problems` to the given text
+    file as newline-delimited JSON, followed by a summary record.
+
+    :return: The summary.
+    """
+    stats = dict()
+    for record in iter_index_problems(stats=stats, **kwargs):
+        fp.write(json.dumps(record) + '\n')
+    summary = {'Summary': stats}
+    fp.write(json.dumps(summary) + '\n')
+    return stats
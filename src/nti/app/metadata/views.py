@@ -8,8 +8,14 @@ from __future__ import division
 from __future__ import print_function
 from __future__ import absolute_import
 
+import json
+import codecs
+import tempfile
+
 from pyramid import httpexceptions as hexc
 
+from pyramid.response import FileIter
+
 from pyramid.view import view_config
 from pyramid.view import view_defaults
 
@@ -17,8 +23,6 @@ from requests.structures import CaseInsensitiveDict
 
 import six
 
-from zc.catalog.interfaces import IValueIndex
-
 from zope import component
 from zope import interface
 
@@ -38,10 +42,48 @@ from nti.app.externalization.error import raise_json_error
 
 from nti.app.externalization.view_mixins import ModeledContentUploadRequestUtilsMixin
 
+from nti.app.metadata.jobs import PENDING
+
+from nti.app.metadata.jobs import JobStatus
+
+from nti.app.metadata.jobs import queue_admin_job
+from nti.app.metadata.jobs import purge_metadata_queues
+
+from nti.app.metadata.metrics import render_prometheus
+from nti.app.metadata.metrics import get_processor_metrics
+
+from nti.app.metadata.processing import LANES
+from nti.app.metadata.processing import BULK_LANE
+from nti.app.metadata.processing import INTERACTIVE_LANE
+from nti.app.metadata.processing import ALL_QUEUE_NAMES
+
+from nti.app.metadata.processing import coalescing_stats
+
+from nti.app.metadata.queues import DEFAULT_SCAN_SIZE
+
+from nti.app.metadata.queues import get_redis
+from nti.app.metadata.queues import queue_stats
+from nti.app.metadata.queues import scan_job_keys
+from nti.app.metadata.queues import iter_job_keys
+
+from nti.app.metadata.reindexer import DEFAULT_BATCH_SIZE as DEFAULT_REBUILD_BATCH_SIZE
+
 from nti.app.metadata.reindexer import reindex
 from nti.app.metadata.reindexer import rebuild_metadata_catalog
 
+from nti.app.metadata.replay import DEFAULT_REPLAY_BATCH_SIZE
+from nti.app.metadata.replay import DEFAULT_SAMPLE_SIZE as DEFAULT_FAILED_SAMPLE_SIZE
+
+from nti.app.metadata.replay import bucket_failed_jobs
+
+from nti.app.metadata.utils import DEFAULT_SAMPLE_SIZE
+from nti.app.metadata.utils import DEFAULT_MAX_SWEEP_AGE
+
 from nti.app.metadata.utils import check_indices
+from nti.app.metadata.utils import resolve_timestamp
+from nti.app.metadata.utils import mime_type_registry
+from nti.app.metadata.utils import write_index_problems
+from nti.app.metadata.utils import incremental_check_indices
 
 from nti.common.string import is_true
 
@@ -50,17 +92,9 @@ from nti.dataserver import authorization as nauth
 from nti.dataserver.interfaces import IDataserver
 from nti.dataserver.interfaces import IShardLayout
 
-from nti.dataserver.metadata.index import IX_MIMETYPE
-
 from nti.externalization.interfaces import LocatedExternalDict
 from nti.externalization.interfaces import StandardExternalFields
 
-from nti.metadata import QUEUE_NAMES
-
-from nti.metadata import metadata_catalogs
-
-from nti.metadata.processing import get_job_queue
-
 from nti.ntiids.ntiids import is_valid_ntiid_string
 from nti.ntiids.ntiids import find_object_with_ntiid
 
@@ -103,6 +137,16 @@ def username_search(search_term):
     return usernames
 
 
+def queue_job(request, name, **kwargs):
+    status = queue_admin_job(name, **kwargs)
+    result = LocatedExternalDict()
+    result.__name__ = request.view_name
+    result.__parent__ = request.context
+    result['JobId'] = status.jobid
+    result['Status'] = PENDING
+    return result
+
+
 @view_config(name='MimeTypes')
 @view_config(name='mime_types')
 @view_defaults(route_name='objects.generic.traversal',
@@ -112,25 +156,111 @@ def username_search(search_term):
                context=MetadataPathAdapter,
                permission=nauth.ACT_NTI_ADMIN)
 class GetMimeTypesView(AbstractAuthenticatedView):
+    """
+    Return the mime types in the metadata catalogs and, with ``counts``,
+    the number of documents of each one.
+    """
 
     def __call__(self):
-        mime_types = set()
-        catalogs = metadata_catalogs()
-        for catalog in catalogs:
-            if not IX_MIMETYPE in catalog:
-                continue
-            index = catalog[IX_MIMETYPE]
-            if not IValueIndex.providedBy(index):
-                continue
-            mime_types.update(index.values_to_documents.keys())
+        counts = is_true(self.request.params.get('counts'))
+        etag, values = mime_type_registry.get_mime_types(counts)
+        if etag in self.request.if_none_match:
+            return hexc.HTTPNotModified()
         result = LocatedExternalDict()
         result.__name__ = self.request.view_name
         result.__parent__ = self.request.context
-        items = result[ITEMS] = sorted(mime_types)
+        items = result[ITEMS] = sorted(values)
         result[ITEM_COUNT] = result[TOTAL] = len(items)
+        if counts:
+            result['Counts'] = dict(values)
+        self.request.response.etag = etag
         return result
 
 
+class WorkersViewMixin(object):
+    """
+    Mixin for views that can spread their work over worker processes.
+
+    The workers are only started by the admin jobs run by the metadata
+    processor, never by the request, which would otherwise be held for
+    the whole run.
+    """
+
+    def _get_workers(self, values, queued=None):
+        try:
+            workers = int(values.get('workers') or 0)
+        except (TypeError, ValueError):
+            raise_json_error(self.request,
+                             hexc.HTTPUnprocessableEntity,
+                             {
+                                 'message': u"Invalid number of workers.",
+                             },
+                             None)
+        queued = is_true(values.get('async')) if queued is None else queued
+        if workers > 1 and not queued:
+            raise_json_error(self.request,
+                             hexc.HTTPUnprocessableEntity,
+                             {
+                                 'message': u"Workers can only be used by async jobs.",
+                             },
+                             None)
+        return workers
+
+
+class LaneViewMixin(object):
+    """
+    Mixin for views that can target a lane of the metadata queues.
+    """
+
+    def _get_lane(self, values):
+        lane = values.get('lane') or BULK_LANE
+        if lane not in LANES:
+            raise_json_error(self.request,
+                             hexc.HTTPUnprocessableEntity,
+                             {
+                                 'message': u"Invalid lane.",
+                             },
+                             None)
+        return lane
+
+
+class QueuesViewMixin(object):
+    """
+    Mixin for views that can target some of the metadata queues.
+    """
+
+    def _get_queue_names(self, values):
+        names = values.get('queues') or values.get('queue')
+        if not names:
+            return ALL_QUEUE_NAMES
+        if isinstance(names, six.string_types):
+            names = names.split(',')
+        names = tuple(names)
+        if not set(names).issubset(ALL_QUEUE_NAMES):
+            raise_json_error(self.request,
+                             hexc.HTTPUnprocessableEntity,
+                             {
+                                 'message': u"Invalid queue.",
+                             },
+                             None)
+        return names
+
+    def _get_number(self, values, name, factory=int, default=None):
+        value = values.get(name)
+        try:
+            value = factory(value) if value else default
+            if value is not None and value < 0:
+                raise ValueError()
+        except (TypeError, ValueError):
+            raise_json_error(self.request,
+                             hexc.HTTPUnprocessableEntity,
+                             {
+                                 'message': u"Invalid %s." % name,
+                             },
+                             None)
+        return value
+
+
 @view_config(name='Reindexer')
 @view_config(name='reindexer')
 @view_defaults(route_name='objects.generic.traversal',
@@ -139,7 +269,9 @@ class GetMimeTypesView(AbstractAuthenticatedView):
                context=MetadataPathAdapter,
                permission=nauth.ACT_NTI_ADMIN)
 class ReindexerView(AbstractAuthenticatedView,
-                    ModeledContentUploadRequestUtilsMixin):
+                    ModeledContentUploadRequestUtilsMixin,
+                    WorkersViewMixin,
+                    LaneViewMixin):
 
     def readInput(self, value=None):
         result = CaseInsensitiveDict()
@@ -148,6 +280,21 @@ class ReindexerView(AbstractAuthenticatedView,
             result.update(**values)
         return result
 
+    def _get_window(self, values):
+        try:
+            since = resolve_timestamp(values.get('since'))
+            until = resolve_timestamp(values.get('until'))
+            if since is not None and until is not None and since > until:
+                raise ValueError()
+        except (TypeError, ValueError):
+            raise_json_error(self.request,
+                             hexc.HTTPUnprocessableEntity,
+                             {
+                                 'message': u"Invalid time window.",
+                             },
+                             None)
+        return since, until
+
     def _do_call(self):
         values = self.readInput()
         term = values.get('term') or values.get('search')
@@ -169,7 +316,39 @@ class ReindexerView(AbstractAuthenticatedView,
         else:
             accept = ()
 
-        result = reindex(accept=accept,
+        # one job per chunk of objects unless told otherwise
+        bulk = values.get('bulk')
+        bulk = True if bulk is None else is_true(bulk)
+        lane = self._get_lane(values)
+        since, until = self._get_window(values)
+        workers = self._get_workers(values)
+
+        if workers > 1:
+            return queue_job(self.request,
+                             'parallel_reindex',
+                             bulk=bulk,
+                             lane=lane,
+                             since=since,
+                             until=until,
+                             workers=workers,
+                             accept=list(accept),
+                             usernames=list(usernames),
+                             system=is_true(system))
+        if is_true(values.get('async')):
+            return queue_job(self.request,
+                             'reindex',
+                             bulk=bulk,
+                             lane=lane,
+                             since=since,
+                             until=until,
+                             accept=list(accept),
+                             usernames=list(usernames),
+                             system=is_true(system))
+        result = reindex(bulk=bulk,
+                         lane=lane,
+                         since=since,
+                         until=until,
+                         accept=accept,
                          usernames=usernames,
                          system=is_true(system))
         return result
@@ -182,7 +361,8 @@ class ReindexerView(AbstractAuthenticatedView,
                context=MetadataPathAdapter,
                permission=nauth.ACT_NTI_ADMIN)
 class CheckIndicesView(AbstractAuthenticatedView,
-                       ModeledContentUploadRequestUtilsMixin):
+                       ModeledContentUploadRequestUtilsMixin,
+                       WorkersViewMixin):
 
     @Lazy
     def intids(self):
@@ -201,17 +381,109 @@ class CheckIndicesView(AbstractAuthenticatedView,
         values = self.readInput()
         all_catalog = is_true(values.get('all'))
         test_broken = is_true(values.get('broken'))
-        check_btrees = is_true(values.get('check'))
+        check_treesets = is_true(values.get('treesets'))
+        check_btrees = check_treesets or is_true(values.get('check'))
         if all_catalog:
             catalog_interface = ICatalogEdit
         else:
             catalog_interface = IDeferredCatalog
+        workers = self._get_workers(values)
+        queued = is_true(values.get('async'))
+        incremental = is_true(values.get('incremental'))
+        dry_run = is_true(values.get('dryRun') or values.get('dry_run'))
+        streamed = dry_run or is_true(values.get('stream'))
+        # streamed and incremental checks only look for missing and broken
+        # objects in this process, and streamed ones cannot be queued
+        if (streamed or incremental) and (check_btrees or workers > 1) \
+                or streamed and (queued or incremental):
+            raise_json_error(self.request,
+                             hexc.HTTPUnprocessableEntity,
+                             {
+                                 'message': u"Unsupported combination of options.",
+                             },
+                             None)
+        if incremental:
+            return self._incremental(values, test_broken, catalog_interface)
+        if streamed:
+            return self._stream(test_broken, catalog_interface, dry_run)
+        if queued:
+            kwargs = {
+                'test_broken': test_broken,
+                'inspect_btrees': check_btrees,
+                'inspect_treesets': check_treesets,
+                'catalog_interface': catalog_interface,
+            }
+            if workers > 1:
+                return queue_job(self.request,
+                                 'parallel_check_indices',
+                                 workers=workers,
+                                 **kwargs)
+            return queue_job(self.request, 'check_indices', **kwargs)
         result = check_indices(catalog_interface=catalog_interface,
                                test_broken=test_broken,
                                intids=self.intids,
-                               inspect_btrees=check_btrees)
+                               inspect_btrees=check_btrees,
+                               inspect_treesets=check_treesets)
         return result
 
+    def _stream(self, test_broken, catalog_interface, dry_run):
+        # written while the connection is open, then streamed from disk
+        fp = tempfile.TemporaryFile()
+        write_index_problems(codecs.getwriter('utf-8')(fp),
+                             dry_run=dry_run,
+                             intids=self.intids,
+                             test_broken=test_broken,
+                             catalog_interface=catalog_interface)
+        fp.seek(0)
+        response = self.request.response
+        response.content_type = 'application/x-ndjson'
+        response.app_iter = FileIter(fp)
+        return response
+
+    def _get_sample_size(self, values):
+        sample_size = values.get('sampleSize') or values.get('sample_size')
+        try:
+            sample_size = int(sample_size) if sample_size else DEFAULT_SAMPLE_SIZE
+            if sample_size < 0:
+                raise ValueError()
+        except (TypeError, ValueError):
+            raise_json_error(self.request,
+                             hexc.HTTPUnprocessableEntity,
+                             {
+                                 'message': u"Invalid sample size.",
+                             },
+                             None)
+        return sample_size
+
+    def _get_max_sweep_age(self, values):
+        max_age = values.get('maxSweepAge')
+        try:
+            max_age = DEFAULT_MAX_SWEEP_AGE if max_age in (None, '') else float(max_age)
+            if max_age < 0:
+                raise ValueError()
+        except (TypeError, ValueError):
+            raise_json_error(self.request,
+                             hexc.HTTPUnprocessableEntity,
+                             {
+                                 'message': u"Invalid sweep age.",
+                             },
+                             None)
+        return max_age
+
+    def _incremental(self, values, test_broken, catalog_interface):
+        kwargs = {
+            'full': is_true(values.get('full')),
+            'test_broken': test_broken,
+            'catalog_interface': catalog_interface,
+            'sample_size': self._get_sample_size(values),
+            'max_sweep_age': self._get_max_sweep_age(values),
+        }
+        if is_true(values.get('async')):
+            return queue_job(self.request,
+                             'incremental_check_indices',
+                             **kwargs)
+        return incremental_check_indices(intids=self.intids, **kwargs)
+
 
 class IndexDocMixin(AbstractAuthenticatedView):
 
@@ -294,10 +566,55 @@ class IndexDocView(IndexDocMixin):
                request_method='POST',
                name="RebuildMetadataCatalog",
                permission=nauth.ACT_NTI_ADMIN)
-class RebuildMetadataCatalogView(AbstractAuthenticatedView):
+class RebuildMetadataCatalogView(AbstractAuthenticatedView,
+                                 ModeledContentUploadRequestUtilsMixin,
+                                 LaneViewMixin):
+
+    def readInput(self, value=None):
+        if self.request.body:
+            values = super(RebuildMetadataCatalogView, self).readInput(value)
+            result = CaseInsensitiveDict(values)
+        else:
+            values = self.request.params
+            result = CaseInsensitiveDict(values)
+        return result
+
+    def _get_batch_size(self, values):
+        batch_size = values.get('batchSize') or values.get('batch_size')
+        try:
+            batch_size = int(batch_size) if batch_size else None
+            if batch_size is not None and batch_size <= 0:
+                raise ValueError()
+        except (TypeError, ValueError):
+            raise_json_error(self.request,
+                             hexc.HTTPUnprocessableEntity,
+                             {
+                                 'message': u"Invalid batch size.",
+                             },
+                             None)
+        return batch_size
 
     def __call__(self):
-        count = rebuild_metadata_catalog()
+        values = self.readInput()
+        resume = is_true(values.get('resume'))
+        batch_size = self._get_batch_size(values)
+        in_place = is_true(values.get('inPlace') or values.get('in_place'))
+        if batch_size or resume:
+            # neither the request nor a queued job own their transaction,
+            # so batched rebuilds are always queued and run by a worker
+            # process that commits each batch
+            return queue_job(self.request,
+                             'batched_rebuild_metadata_catalog',
+                             lane=self._get_lane(values),
+                             batch_size=batch_size or DEFAULT_REBUILD_BATCH_SIZE,
+                             shadow=not in_place,
+                             resume=resume)
+        if is_true(values.get('async')):
+            return queue_job(self.request,
+                             'rebuild_metadata_catalog',
+                             lane=self._get_lane(values),
+                             shadow=not in_place)
+        count = rebuild_metadata_catalog(shadow=not in_place)
         result = LocatedExternalDict()
         result.__name__ = self.request.view_name
         result.__parent__ = self.request.context
@@ -305,6 +622,28 @@ class RebuildMetadataCatalogView(AbstractAuthenticatedView):
         return result
 
 
+@view_config(name='JobStatus')
+@view_config(name='job_status')
+@view_defaults(route_name='objects.generic.traversal',
+               renderer='rest',
+               request_method='GET',
+               context=MetadataPathAdapter,
+               permission=nauth.ACT_NTI_ADMIN)
+class JobStatusView(AbstractAuthenticatedView):
+
+    def __call__(self):
+        request = self.request
+        jobid = request.subpath[0] if request.subpath else None
+        jobid = jobid or request.params.get('jobId')
+        result = JobStatus(jobid).get() if jobid else None
+        if result is None:
+            raise hexc.HTTPNotFound()
+        result = LocatedExternalDict(result)
+        result.__name__ = request.view_name
+        result.__parent__ = request.context
+        return result
+
+
 # queue views
 
 
@@ -316,20 +655,138 @@ class RebuildMetadataCatalogView(AbstractAuthenticatedView):
                context=MetadataPathAdapter,
                permission=nauth.ACT_NTI_ADMIN)
 class QueueJobsView(AbstractAuthenticatedView):
+    """
+    Return the job keys of the metadata queues along with per-queue
+    stats.
 
-    def __call__(self):
-        total = 0
+    With ``summary`` only the stats are returned. With ``queue`` the
+    keys of that queue are returned a page at a time, starting at
+    ``cursor``. Otherwise all the keys are streamed as they are read.
+    """
+
+    @Lazy
+    def redis(self):
+        return get_redis()
+
+    def _batch_size(self):
+        try:
+            result = int(self.request.params.get('batchSize') or DEFAULT_SCAN_SIZE)
+        except ValueError:
+            result = -1
+        if result <= 0:
+            raise_json_error(self.request,
+                             hexc.HTTPUnprocessableEntity,
+                             {
+                                 'message': u"Invalid batch size.",
+                             },
+                             None)
+        return result
+
+    def _result(self):
         result = LocatedExternalDict()
         result.__name__ = self.request.view_name
         result.__parent__ = self.request.context
+        return result
+
+    def _summary(self):
+        total = 0
+        result = self._result()
         items = result[ITEMS] = {}
-        for name in QUEUE_NAMES:
-            queue = get_job_queue(name)
-            items[name] = list(queue.keys())  # snapshopt
-            total += len(items[name])
+        for name in ALL_QUEUE_NAMES:
+            stats = items[name] = queue_stats(self.redis, name)
+            total += stats['Depth']
+        result.update(coalescing_stats(self.redis))
         result[TOTAL] = result[ITEM_COUNT] = total
         return result
 
+    def _page(self, name):
+        if name not in ALL_QUEUE_NAMES:
+            raise hexc.HTTPNotFound()
+        try:
+            cursor = int(self.request.params.get('cursor') or 0)
+        except ValueError:
+            cursor = -1
+        if cursor < 0:
+            raise_json_error(self.request,
+                             hexc.HTTPUnprocessableEntity,
+                             {
+                                 'message': u"Invalid cursor.",
+                             },
+                             None)
+        cursor, keys = scan_job_keys(self.redis, name, cursor,
+                                     self._batch_size())
+        result = self._result()
+        result['Queue'] = name
+        result['Stats'] = queue_stats(self.redis, name)
+        result['NextCursor'] = cursor
+        items = result[ITEMS] = keys
+        result[ITEM_COUNT] = len(items)
+        return result
+
+    def _stream(self, redis, stats, count):
+        total = 0
+        yield '{"%s": {' % ITEMS
+        for idx, name in enumerate(ALL_QUEUE_NAMES):
+            yield '%s%s: [' % (',' if idx else '', json.dumps(name))
+            for jdx, key in enumerate(iter_job_keys(redis, name, count)):
+                yield '%s%s' % (',' if jdx else '', json.dumps(key))
+                total += 1
+            yield ']'
+        yield '}, "Queues": %s, "%s": %s, "%s": %s}' % (json.dumps(stats),
+                                                        TOTAL, total,
+                                                        ITEM_COUNT, total)
+
+    def __call__(self):
+        params = self.request.params
+        if is_true(params.get('summary')):
+            return self._summary()
+        if params.get('queue'):
+            return self._page(params.get('queue'))
+        count = self._batch_size()
+        # read from redis before the response starts, so that its
+        # errors are not streamed after a 200
+        redis = self.redis
+        stats = {name: queue_stats(redis, name) for name in ALL_QUEUE_NAMES}
+        response = self.request.response
+        response.content_type = 'application/json'
+        response.app_iter = (x.encode('utf-8')
+                             for x in self._stream(redis, stats, count))
+        return response
+
+
+@view_config(name='Metrics')
+@view_config(name='metrics')
+@view_defaults(route_name='objects.generic.traversal',
+               renderer='rest',
+               request_method='GET',
+               context=MetadataPathAdapter,
+               permission=nauth.ACT_NTI_ADMIN)
+class MetricsView(AbstractAuthenticatedView):
+    """
+    Return the metrics published by the metadata processors and the
+    current stats of the metadata queues. With ``format=prometheus``
+    the processor metrics are returned in the Prometheus text format.
+    """
+
+    def __call__(self):
+        redis = get_redis()
+        processors = get_processor_metrics(redis)
+        if self.request.params.get('format') == 'prometheus':
+            response = self.request.response
+            response.content_type = 'text/plain'
+            response.text = six.text_type(render_prometheus(processors))
+            return response
+        result = LocatedExternalDict()
+        result.__name__ = self.request.view_name
+        result.__parent__ = self.request.context
+        result['Processors'] = processors
+        result['Queues'] = {
+            name: queue_stats(redis, name) for name in ALL_QUEUE_NAMES
+        }
+        result.update(coalescing_stats(redis))
+        result[ITEM_COUNT] = len(processors)
+        return result
+
 
 @view_config(name='EmptyQueues')
 @view_config(name='empty_queues')
@@ -338,10 +795,120 @@ class QueueJobsView(AbstractAuthenticatedView):
                request_method='POST',
                context=MetadataPathAdapter,
                permission=nauth.ACT_NTI_ADMIN)
-class EmptyQueuesView(AbstractAuthenticatedView):
+class EmptyQueuesView(AbstractAuthenticatedView,
+                      ModeledContentUploadRequestUtilsMixin,
+                      QueuesViewMixin):
+    """
+    Purge the metadata queues, all of them or the ones given in
+    ``queues``, and their failed queues. With ``failedOnly`` only the
+    failed queues are purged.
+
+    The purge runs in chunks as a job of the interactive lane, executed
+    by the metadata processor, and its report can be polled with the
+    returned job id, unless ``wait`` is given.
+    """
+
+    def readInput(self, value=None):
+        result = CaseInsensitiveDict()
+        if self.request.body:
+            values = super(EmptyQueuesView, self).readInput(value=value)
+            result.update(**values)
+        return result
 
     def __call__(self):
-        for name in QUEUE_NAMES:
-            queue = get_job_queue(name)
-            queue.empty()
-        return hexc.HTTPNoContent()
+        values = self.readInput()
+        names = self._get_queue_names(values)
+        failed_only = is_true(values.get('failedOnly'))
+        if is_true(values.get('wait')):
+            result = LocatedExternalDict()
+            result.__name__ = self.request.view_name
+            result.__parent__ = self.request.context
+            result.update(purge_metadata_queues(names, jobs=not failed_only))
+            return result
+        # ahead of the bulk jobs it may purge
+        result = queue_job(self.request,
+                           'purge_queues',
+                           lane=INTERACTIVE_LANE,
+                           names=list(names),
+                           jobs=not failed_only)
+        result['Queues'] = list(names)
+        return result
+
+
+@view_config(name='FailedJobs')
+@view_config(name='failed_jobs')
+@view_defaults(route_name='objects.generic.traversal',
+               renderer='rest',
+               request_method='GET',
+               context=MetadataPathAdapter,
+               permission=nauth.ACT_NTI_ADMIN)
+class FailedJobsView(AbstractAuthenticatedView, QueuesViewMixin):
+    """
+    Sample the failed jobs of the metadata queues, all of them or the
+    ones given in ``queues``, and group them by exception type and mime
+    type.
+    """
+
+    def __call__(self):
+        values = CaseInsensitiveDict(self.request.params)
+        names = self._get_queue_names(values)
+        size = self._get_number(values, 'sampleSize',
+                                default=DEFAULT_FAILED_SAMPLE_SIZE)
+        result = LocatedExternalDict()
+        result.__name__ = self.request.view_name
+        result.__parent__ = self.request.context
+        result.update(bucket_failed_jobs(names, size))
+        result[ITEM_COUNT] = result['Sampled']
+        return result
+
+
+@view_config(name='ReplayFailedJobs')
+@view_config(name='replay_failed_jobs')
+@view_defaults(route_name='objects.generic.traversal',
+               renderer='rest',
+               request_method='POST',
+               context=MetadataPathAdapter,
+               permission=nauth.ACT_NTI_ADMIN)
+class ReplayFailedJobsView(AbstractAuthenticatedView,
+                           ModeledContentUploadRequestUtilsMixin,
+                           WorkersViewMixin,
+                           LaneViewMixin,
+                           QueuesViewMixin):
+    """
+    Replay the failed jobs of the metadata queues, all of them or the
+    ones given in ``queues``, at most ``rate`` jobs per second and
+    ``batchSize`` jobs per transaction. Jobs that fail again go back to
+    the failed queues.
+
+    The jobs are replayed by an admin job queued in the given ``lane``,
+    which starts ``workers`` worker processes if given.
+    """
+
+    def readInput(self, value=None):
+        result = CaseInsensitiveDict()
+        if self.request.body:
+            values = super(ReplayFailedJobsView, self).readInput(value=value)
+            result.update(**values)
+        return result
+
+    def __call__(self):
+        values = self.readInput()
+        names = self._get_queue_names(values)
+        rate = self._get_number(values, 'rate', float)
+        batch_size = self._get_number(values, 'batchSize',
+                                      default=DEFAULT_REPLAY_BATCH_SIZE)
+        workers = self._get_workers(values, queued=True)
+        if workers > 1:
+            return queue_job(self.request,
+                             'parallel_replay_failed_jobs',
+                             rate=rate,
+                             names=list(names),
+                             workers=workers,
+                             batch_size=batch_size,
+                             lane=self._get_lane(values))
+        return queue_job(self.request,
+                         'replay_failed_jobs',
+                         rate=rate,
+                         names=list(names),
+                         batch_size=batch_size,
+                         lane=self._get_lane(values))